@@ -0,0 +1,144 @@
+import os
+import shutil
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Almacenamiento de imágenes compartido por la API y la IA.
+# Este archivo es el mismo en 'geoviality-api/app' y en 'geoviality-ia': si se modifica, cambiar ambos.
+#
+# STORAGE_BACKEND=local -> carpeta 'STORAGE_LOCAL_DIR' (por defecto 'services/imgs')
+# STORAGE_BACKEND=s3    -> bucket 'S3_BUCKET' en cualquier servicio compatible con S3 ('S3_ENDPOINT_URL')
+
+backend = os.getenv("STORAGE_BACKEND", "local").lower()
+
+class AlmacenamientoLocal:
+    """
+    Guarda las imágenes como archivos dentro de 'base_dir'. La clave es el nombre del archivo.
+    """
+
+    def __init__(self, base_dir: str):
+        self.base_dir = base_dir
+        os.makedirs(base_dir, exist_ok=True)
+
+    def ruta(self, key: str) -> str:
+        return os.path.join(self.base_dir, key)
+
+    def guardar(self, key: str, data: bytes) -> None:
+        path = self.ruta(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path) # Quien lea nunca ve un archivo a medio escribir
+
+    def guardar_archivo(self, key: str, archivo) -> None:
+        """
+        Igual que 'guardar', pero copia por partes un archivo abierto en modo binario (por ejemplo un video),
+        sin cargarlo entero en memoria.
+        """
+        path = self.ruta(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            shutil.copyfileobj(archivo, f, 1024 * 1024)
+        os.replace(tmp, path)
+
+    def descargar(self, key: str, destino: str) -> None:
+        shutil.copyfile(self.ruta(key), destino)
+
+    def leer(self, key: str) -> bytes | None:
+        try:
+            with open(self.ruta(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def existe(self, key: str) -> bool:
+        return os.path.exists(self.ruta(key))
+
+    def eliminar(self, key: str) -> None:
+        try:
+            os.remove(self.ruta(key))
+        except FileNotFoundError:
+            pass
+
+    def listar(self, prefijo: str = ""):
+        """
+        Recorre las claves guardadas que empiezan con 'prefijo' (sin los temporales de 'guardar').
+        """
+        for carpeta, _, archivos in os.walk(self.base_dir):
+            for archivo in archivos:
+                key = os.path.relpath(os.path.join(carpeta, archivo), self.base_dir).replace(os.sep, "/")
+                if key.startswith(prefijo) and not key.endswith(".tmp"):
+                    yield key
+
+class AlmacenamientoS3:
+    """
+    Guarda las imágenes como objetos en un bucket S3 (AWS, MinIO, etc.) bajo 'prefijo'.
+    """
+
+    def __init__(self, bucket: str, prefijo: str = "", endpoint_url: str | None = None):
+        import boto3
+        from botocore.exceptions import ClientError
+        self._ClientError = ClientError
+        self.bucket = bucket
+        self.prefijo = prefijo
+        self.client = boto3.client("s3", endpoint_url=endpoint_url)
+
+    def ruta(self, key: str) -> None:
+        return None # No hay archivo local
+
+    def _key(self, key: str) -> str:
+        return self.prefijo + key
+
+    def guardar(self, key: str, data: bytes) -> None:
+        self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=data, ContentType="image/jpeg")
+
+    def guardar_archivo(self, key: str, archivo) -> None:
+        self.client.upload_fileobj(archivo, self.bucket, self._key(key)) # Sube por partes
+
+    def descargar(self, key: str, destino: str) -> None:
+        self.client.download_file(self.bucket, self._key(key), destino)
+
+    def leer(self, key: str) -> bytes | None:
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._key(key))
+            return response["Body"].read()
+        except self._ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+
+    def existe(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+            return True
+        except self._ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return False
+            raise
+
+    def eliminar(self, key: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def listar(self, prefijo: str = ""):
+        """
+        Recorre las claves guardadas que empiezan con 'prefijo', de a una página de la API a la vez.
+        """
+        paginas = self.client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=self._key(prefijo))
+        for pagina in paginas:
+            for objeto in pagina.get("Contents", []):
+                yield objeto["Key"][len(self.prefijo):]
+
+def crear_almacenamiento():
+    if backend == "s3":
+        return AlmacenamientoS3(
+            bucket=os.getenv("S3_BUCKET", "geoviality"),
+            prefijo=os.getenv("S3_PREFIX", "imgs/"),
+            endpoint_url=os.getenv("S3_ENDPOINT_URL")
+        )
+    return AlmacenamientoLocal(os.getenv("STORAGE_LOCAL_DIR", os.path.join(os.getcwd(), "services", "imgs")))
+
+almacenamiento = crear_almacenamiento()
+print(f"Almacenamiento de imágenes: {backend}")
@@ -0,0 +1,75 @@
+import io
+import os
+import zlib
+import threading
+from collections import OrderedDict
+from PIL import Image, ImageDraw, ImageFont
+
+# Cantidad de imágenes anotadas que se mantienen en memoria (las menos pedidas se descartan primero)
+ANOTADAS_CACHE = int(os.getenv("ANOTADAS_CACHE", 256))
+# Calidad JPEG de las imágenes anotadas
+ANOTADAS_CALIDAD_JPEG = int(os.getenv("ANOTADAS_CALIDAD_JPEG", 85))
+
+def color_clase(clase: str) -> tuple[int, int, int]:
+    # Color fijo por clase, el mismo en todas las imágenes
+    valor = zlib.crc32(clase.encode())
+    return (valor & 0xFF) | 0x40, (valor >> 8 & 0xFF) | 0x40, (valor >> 16 & 0xFF) | 0x40
+
+def dibujar(image_data: bytes, detecciones: dict) -> bytes:
+    """
+    Retorna la imagen como JPEG con las cajas de 'detecciones' ({'ancho', 'alto', 'cajas'}, como las guarda la IA)
+    y la clase y confianza de cada una.
+
+    Si la imagen no tiene el tamaño en que se detectaron las cajas, se escalan a su tamaño.
+    """
+    with Image.open(io.BytesIO(image_data)) as imagen:
+        imagen = imagen.convert("RGB")
+    escala_x = imagen.width / detecciones["ancho"] if detecciones.get("ancho") else 1
+    escala_y = imagen.height / detecciones["alto"] if detecciones.get("alto") else 1
+    grosor = max(round((imagen.width + imagen.height) / 2 * 0.003), 2)
+    fuente = ImageFont.load_default()
+    dibujo = ImageDraw.Draw(imagen)
+    for caja in detecciones.get("cajas", []):
+        x_min, y_min, x_max, y_max = caja["caja"]
+        x_min, x_max = x_min * escala_x, x_max * escala_x
+        y_min, y_max = y_min * escala_y, y_max * escala_y
+        color = color_clase(caja["clase"])
+        dibujo.rectangle((x_min, y_min, x_max, y_max), outline=color, width=grosor)
+        texto = f"{caja['clase']} {caja['confianza']:.0f}%"
+        izquierda, arriba, derecha, abajo = dibujo.textbbox((x_min, y_min), texto, font=fuente)
+        arriba_texto = max(y_min - (abajo - arriba) - 2 * grosor, 0)
+        dibujo.rectangle((x_min, arriba_texto, x_min + (derecha - izquierda) + 2 * grosor, arriba_texto + (abajo - arriba) + 2 * grosor), fill=color)
+        dibujo.text((x_min + grosor, arriba_texto + grosor - (arriba - y_min)), texto, fill=(0, 0, 0), font=fuente)
+    salida = io.BytesIO()
+    imagen.save(salida, format="JPEG", quality=ANOTADAS_CALIDAD_JPEG)
+    return salida.getvalue()
+
+class CacheAnotadas:
+    """
+    Imágenes anotadas ya dibujadas, por (id de imagen, versión del modelo), con descarte LRU.
+
+    La versión va en la clave para que una imagen reprocesada con otro modelo se vuelva a dibujar.
+    """
+
+    def __init__(self, capacidad: int = ANOTADAS_CACHE):
+        self.capacidad = capacidad
+        self._imagenes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def obtener(self, clave: tuple) -> bytes | None:
+        with self._lock:
+            imagen = self._imagenes.get(clave)
+            if imagen is not None:
+                self._imagenes.move_to_end(clave)
+            return imagen
+
+    def guardar(self, clave: tuple, imagen: bytes) -> None:
+        if self.capacidad <= 0:
+            return
+        with self._lock:
+            self._imagenes[clave] = imagen
+            self._imagenes.move_to_end(clave)
+            while len(self._imagenes) > self.capacidad:
+                self._imagenes.popitem(last=False)
+
+cache = CacheAnotadas()
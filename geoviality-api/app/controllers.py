@@ -1,13 +1,19 @@
 import uuid
 import os
+import re
 import socket
 import pika
 import dotenv
 import asyncio
 from database import db
+from almacenamiento import almacenamiento
+import anotaciones
+import indice_calles
+import duplicados
 from bson.objectid import ObjectId
 from typing import Annotated
 from fastapi import Depends, HTTPException, status
+from fastapi.responses import FileResponse, Response
 from fastapi.security import OAuth2PasswordBearer
 from jose import jwt
 from jose.exceptions import JWTError, ExpiredSignatureError, JWTClaimsError
@@ -17,10 +23,14 @@ from bson import SON
 from pymongo.errors import PyMongoError
 from pika.exceptions import AMQPError
 import pytz
+import io
+import csv
+from xml.etree import ElementTree
+from PIL import Image, ImageOps
 
 dotenv.load_dotenv()
 
-from models import UserLogin, UserCreate, UserUpdate, TokenData, UserResponse, UserDB, User, PhotoQueue, PhotoSave, ListUserResponse, Geometry, SidewalksDB, Properties
+from models import UserLogin, UserCreate, UserUpdate, TokenData, UserResponse, UserDB, User, PhotoQueue, VideoQueue, PhotoSave, ListUserResponse, Geometry, SidewalksDB, Properties
 
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
@@ -36,6 +46,12 @@ event_queue2 = asyncio.Queue()
 
 chile_timezone = pytz.timezone("America/Santiago")
 
+# Normalización de las imágenes al recibirlas: lado mayor máximo en píxeles (0 = no se reduce) y calidad JPEG
+IMG_MAX_LADO = int(os.getenv("IMG_MAX_LADO", 1280))
+IMG_CALIDAD_JPEG = int(os.getenv("IMG_CALIDAD_JPEG", 85))
+# Si es "True", la foto original se guarda en el almacenamiento como 'originales/<id>.jpg'
+IMG_GUARDAR_ORIGINAL = os.getenv("IMG_GUARDAR_ORIGINAL", "False").lower() == "true"
+
 ##################################################################################
 # FUNCIONES IMAGENES
 ##################################################################################
@@ -44,6 +60,14 @@ chile_timezone = pytz.timezone("America/Santiago")
 def create_uuid() -> str:
     return str(uuid.uuid4())
 
+# Formato de los ids de imagen: un UUID de 'create_uuid', o '<uuid>-<frame>' para los frames de un video
+FORMATO_ID_IMAGEN = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}(-[0-9]{6})?")
+
+# Indica si 'image_id' tiene el formato de los ids que genera la API. Se revisa antes de usarlo en
+# rutas de campos de Mongo ('properties.detecciones.<id>'), donde un '.' o un '$' cambiarían el campo.
+def id_imagen_valido(image_id: str) -> bool:
+    return FORMATO_ID_IMAGEN.fullmatch(image_id) is not None
+
 # Crea los directorios para almacenar las imágenes
 def create_directories() -> None:
     base_dir = os.path.join(os.getcwd(), "services")
@@ -58,6 +82,95 @@ def create_directories() -> None:
         os.makedirs(imgs_dir, exist_ok=True)
     print("     -[API] Directorio de imágenes creado en: ", imgs_dir)
 
+# Normaliza una foto recibida: aplica la orientación EXIF, la reduce a 'IMG_MAX_LADO' y la recodifica como JPEG
+def normalizar_imagen(image_data: bytes) -> bytes:
+    """
+    Retorna la imagen derecha (según su EXIF), con el lado mayor de a lo más 'IMG_MAX_LADO' píxeles y
+    recodificada como JPEG con calidad 'IMG_CALIDAD_JPEG', sin metadatos.
+
+    Si los bytes no son una imagen que Pillow pueda abrir, retorna los bytes originales.
+    """
+    try:
+        with Image.open(io.BytesIO(image_data)) as imagen:
+            imagen.draft("RGB", (IMG_MAX_LADO, IMG_MAX_LADO) if IMG_MAX_LADO > 0 else imagen.size) # JPEG: decodifica ya reducida
+            imagen = ImageOps.exif_transpose(imagen)
+            if imagen.mode != "RGB":
+                imagen = imagen.convert("RGB")
+            if IMG_MAX_LADO > 0:
+                imagen.thumbnail((IMG_MAX_LADO, IMG_MAX_LADO), Image.LANCZOS)
+            salida = io.BytesIO()
+            imagen.save(salida, format="JPEG", quality=IMG_CALIDAD_JPEG, optimize=True)
+    except Exception as e:
+        print(f"    -[API] No se pudo normalizar la imagen, se usa tal cual: {e}")
+        return image_data
+    normalizada = salida.getvalue()
+    print(f"    -[API] Imagen normalizada a {imagen.width}x{imagen.height}: {len(image_data) / 1e3:.0f} kB -> {len(normalizada) / 1e3:.0f} kB.")
+    return normalizada
+
+# Guarda la foto original si 'IMG_GUARDAR_ORIGINAL' está activo
+def guardar_original(image_id: str, image_data: bytes) -> None:
+    if IMG_GUARDAR_ORIGINAL:
+        almacenamiento.guardar(f"originales/{image_id}.jpg", image_data)
+
+# Agrega la imagen 'id_imagen' al punto que contiene la imagen 'id_original' (para fotos duplicadas)
+def agregar_a_punto_de_imagen(id_original: str, id_imagen: str) -> str | None:
+    """
+    Retorna el id del punto al que se agregó la imagen, o None si 'id_original' no pertenece a ningún punto
+    (no tuvo detecciones o la IA aún no la procesa).
+
+    La imagen toma las detecciones de la original, así se puede descargar anotada como las demás.
+    """
+    try:
+        punto = db.processed_geojson.find_one_and_update(
+            {"properties.images": id_original},
+            {
+                "$addToSet": {"properties.images": id_imagen},
+                "$set": {"properties.last_update": datetime.now()}
+            },
+            projection={"_id": 1, f"properties.detecciones.{id_original}": 1}
+        )
+    except PyMongoError as e:
+        print(f"    -[API] Error al agregar la imagen '{id_imagen}' al punto de '{id_original}': {e}")
+        return None
+    if punto is None:
+        return None
+    detecciones = (punto.get("properties", {}).get("detecciones") or {}).get(id_original)
+    if detecciones is not None:
+        try:
+            db.processed_geojson.update_one(
+                {"_id": punto["_id"]},
+                {"$set": {f"properties.detecciones.{id_imagen}": detecciones}}
+            )
+        except PyMongoError as e:
+            # La imagen ya quedó en el punto: solo se descargará sin anotar
+            print(f"    -[API] Error al copiar las detecciones de '{id_original}' a '{id_imagen}': {e}")
+    print(f"    -[API] Imagen '{id_imagen}' duplicada de '{id_original}', agregada al punto '{punto['_id']}'.")
+    return punto["_id"]
+
+# Trabajo síncrono de una foto recibida (se corre fuera del event loop con 'run_in_threadpool')
+def preparar_imagen(image_id: str, image_data: bytes) -> tuple[bytes, int | None]:
+    """
+    Guarda la original, normaliza la foto y calcula su dHash (si la detección de duplicados está activa).
+
+    Retorna la foto normalizada y su hash (o None).
+    """
+    guardar_original(image_id, image_data)
+    image_data = normalizar_imagen(image_data)
+    hash = duplicados.dhash(image_data) if duplicados.DUP_ACTIVO else None
+    return image_data, hash
+
+# Guarda una foto duplicada de 'id_original' y la agrega a su punto, sin pasar por la IA
+def agregar_duplicado(id_original: str, image_id: str, image_data: bytes, hash: int, lon: float, lat: float) -> bool:
+    """
+    Retorna False (y no deja nada guardado) si 'id_original' no pertenece a ningún punto.
+    """
+    almacenamiento.guardar(f"{image_id}.jpg", image_data)
+    if agregar_a_punto_de_imagen(id_original, image_id):
+        duplicados.registrar(db.image_hashes, hash, image_id, lon, lat)
+        return True
+    almacenamiento.eliminar(f"{image_id}.jpg")
+    return False
+
 # Obtiene la IP local
 def get_local_ip() -> str:
     print("     -[API] Usando IP LOCAL - IP...")
@@ -71,19 +184,34 @@ def get_local_ip() -> str:
         s.close()
     return ip
 
-# Envia los datos a la cola de RabbitMQ
-def send_to_queue(data: PhotoQueue) -> bool:
-    print (f"     -[API] Enviando datos: {data.id} ...") 
-    print (f"     -[API] Enviando datos: {data.model_dump().keys()} ...")
-    message = data.model_dump_json()
+# Las imágenes se publican en el exchange 'images' (topic) con la ruta de su modo como routing key.
+# Cada ruta tiene su cola 'images.<ruta>', así cada grupo de workers de IA atiende un solo modelo
+# (ver 'colas.py' en la IA; IA_RUTAS elige qué rutas consume cada worker). Los videos van por la ruta 'video'.
+EXCHANGE_IMAGENES = 'images'
+RUTAS_IMAGENES = ('auto', 'peaton')
+RUTA_VIDEOS = 'video'
+
+# Ruta de una imagen según su modo: 'auto' va al modelo de vehiculo, el resto al de peaton
+def ruta_imagen(modo: str) -> str:
+    return 'auto' if modo == 'auto' else 'peaton'
+
+# Declara el exchange y las colas de todas las rutas, para que una imagen espere en su cola aunque no haya workers
+def declarar_colas(channel) -> None:
+    channel.exchange_declare(exchange=EXCHANGE_IMAGENES, exchange_type='topic', durable=True)
+    for ruta in RUTAS_IMAGENES + (RUTA_VIDEOS,):
+        channel.queue_declare(queue=f"{EXCHANGE_IMAGENES}.{ruta}", durable=True)
+        channel.queue_bind(queue=f"{EXCHANGE_IMAGENES}.{ruta}", exchange=EXCHANGE_IMAGENES, routing_key=ruta)
+
+# Publica 'message' en la ruta 'ruta' del exchange de imágenes
+def publicar(ruta: str, message: str) -> bool:
     try:
         conn = pika.BlockingConnection(pika.ConnectionParameters('rabbitmq'))
         channel = conn.channel()
-        channel.queue_declare(queue='images', durable=True)
-        print(f"    -[API] Enviando datos a la cola de RabbitMQ...")
+        declarar_colas(channel)
+        print(f"    -[API] Enviando datos a la cola de RabbitMQ (ruta '{ruta}')...")
         channel.basic_publish(
-            exchange='',
-            routing_key='images',
+            exchange=EXCHANGE_IMAGENES,
+            routing_key=ruta,
             body=message,
             properties=pika.BasicProperties(
                 delivery_mode=2,
@@ -100,15 +228,97 @@ def send_to_queue(data: PhotoQueue) -> bool:
         print(f"    -[API] Error al enviar datos a la cola de RabbitMQ: {e}")
         return False
 
-# Recibe la imagen de la IA y la guarda
+# Envia los datos a la cola de RabbitMQ
+def send_to_queue(data: PhotoQueue) -> bool:
+    print (f"     -[API] Enviando datos: {data.id} ...") 
+    print (f"     -[API] Enviando datos: {data.model_dump().keys()} ...")
+    return publicar(ruta_imagen(data.modo), data.model_dump_json())
+
+# Envia un video (ya guardado en el almacenamiento) y su track GPS a la cola de videos
+def send_video_to_queue(data: VideoQueue) -> bool:
+    print(f"     -[API] Enviando video: {data.id} ({len(data.track)} puntos GPS) ...")
+    return publicar(RUTA_VIDEOS, data.model_dump_json())
+
+# Lee un track GPS en GPX o CSV (columnas de tiempo, latitud y longitud, con encabezado) y retorna sus puntos
+# como [segundos desde 'inicio', latitud, longitud] ordenados por tiempo. En el CSV el tiempo puede venir
+# en segundos desde el inicio del video o como fecha ISO.
+def leer_track(data: bytes, inicio: datetime) -> list[list[float]]:
+    if inicio.tzinfo is None:
+        inicio = inicio.astimezone() # Hora local del servidor (TZ)
+
+    def segundos(valor: str) -> float:
+        try:
+            return float(valor)
+        except ValueError:
+            fecha = datetime.fromisoformat(valor.strip().replace("Z", "+00:00"))
+            if fecha.tzinfo is None:
+                fecha = fecha.astimezone()
+            return (fecha - inicio).total_seconds()
+
+    puntos = []
+    texto = data.decode("utf-8-sig").strip()
+    if texto.startswith("<"):
+        raiz = ElementTree.fromstring(texto)
+        for punto in raiz.iter():
+            if not punto.tag.endswith("trkpt"):
+                continue
+            tiempo = next((hijo.text for hijo in punto if hijo.tag.endswith("time")), None)
+            if tiempo:
+                puntos.append([segundos(tiempo), float(punto.get("lat")), float(punto.get("lon"))])
+    else:
+        filas = csv.DictReader(io.StringIO(texto))
+        columnas = {c.strip().lower(): c for c in filas.fieldnames or []}
+        tiempo = next((columnas[c] for c in ("t", "time", "tiempo", "segundos", "timestamp") if c in columnas), None)
+        latitud = next((columnas[c] for c in ("lat", "latitude", "latitud") if c in columnas), None)
+        longitud = next((columnas[c] for c in ("lon", "lng", "longitude", "longitud") if c in columnas), None)
+        if not (tiempo and latitud and longitud):
+            raise ValueError("El CSV del track necesita columnas de tiempo, latitud y longitud")
+        for fila in filas:
+            puntos.append([segundos(fila[tiempo]), float(fila[latitud]), float(fila[longitud])])
+    return sorted(puntos)
+
+# Recibe la imagen de la IA y la guarda (ruta antigua, la IA ahora escribe directo en el almacenamiento)
 def receive_image_from_IA(photo: PhotoSave)-> None:
     image_filename = photo.id
     image = photo.image.encode('latin1')
-    image_path = f"services/imgs/{image_filename}.jpg"
-    with open(image_path, "wb") as f:
-        f.write(image)
+    almacenamiento.guardar(f"{image_filename}.jpg", image)
     print(f"    -[API] Imagen '{image_filename}' recibida y guardada en 'imgs'.")
 
+# Arma la respuesta con la imagen 'key' del almacenamiento, o None si no existe
+def respuesta_imagen(key: str) -> Response | None:
+    ruta = almacenamiento.ruta(key)
+    if ruta is not None:
+        if not os.path.exists(ruta):
+            return None
+        return FileResponse(ruta)
+    contenido = almacenamiento.leer(key)
+    if contenido is None:
+        return None
+    return Response(content=contenido, media_type="image/jpeg")
+
+# Arma la respuesta con la imagen 'image_id' con sus detecciones dibujadas, o None si la imagen no existe
+# (o si el id no tiene el formato de la API).
+# Si la imagen no tiene detecciones guardadas se responde la imagen tal cual.
+def respuesta_imagen_anotada(image_id: str) -> Response | None:
+    if not id_imagen_valido(image_id):
+        return None
+    punto = db.processed_geojson.find_one(
+        {"properties.images": image_id},
+        projection={f"properties.detecciones.{image_id}": 1}
+    )
+    detecciones = ((punto or {}).get("properties", {}).get("detecciones") or {}).get(image_id)
+    if not detecciones or not detecciones.get("cajas"):
+        return respuesta_imagen(f"{image_id}.jpg")
+    clave = (image_id, detecciones.get("modelo"))
+    anotada = anotaciones.cache.obtener(clave)
+    if anotada is None:
+        contenido = almacenamiento.leer(f"{image_id}.jpg")
+        if contenido is None:
+            return None
+        anotada = anotaciones.dibujar(contenido, detecciones)
+        anotaciones.cache.guardar(clave, anotada)
+    return Response(content=anotada, media_type="image/jpeg")
+
 ##################################################################################
 # TOKEN FUNCS
 ##################################################################################
@@ -283,8 +493,13 @@ def read_all_users_from_mongodb() -> list[UserResponse]:
 # Encuentra la calle más cercana a un punto dado
 def encontrar_calle_mas_cercana(punto: Geometry, max_distance=30) -> dict:
     """
-    Encuentra la calle más cercana a un punto dado usando una consulta geoespacial.
+    Encuentra la calle más cercana a un punto dado.
+
+    Usa el índice de calles en memoria si está cargado; si no, una consulta geoespacial a la BD.
     """
+    if indice_calles.listo():
+        lon, lat = punto.coordinates[:2]
+        return indice_calles.calle_mas_cercana(lon, lat, max_distance)
     try:
         calle = db.streets.find_one({
             "geometry": {
@@ -0,0 +1,134 @@
+import io
+import os
+import math
+import threading
+from datetime import datetime, timedelta
+from PIL import Image
+
+# Si es "False", todas las imágenes se mandan a la IA
+DUP_ACTIVO = os.getenv("DUP_ACTIVO", "True").lower() == "true"
+# Una imagen es duplicada de otra si sus hashes difieren en a lo más 'DUP_HAMMING_MAX' bits de 64...
+DUP_HAMMING_MAX = int(os.getenv("DUP_HAMMING_MAX", 6))
+# ...y fue tomada a menos de 'DUP_DISTANCIA_M' metros, dentro de los últimos 'DUP_VENTANA_DIAS' días
+DUP_DISTANCIA_M = float(os.getenv("DUP_DISTANCIA_M", 10))
+DUP_VENTANA_DIAS = float(os.getenv("DUP_VENTANA_DIAS", 30))
+
+RADIO_TIERRA_M = 6371008.8
+METROS_POR_GRADO = 111320.0
+
+def dhash(image_data: bytes) -> int | None:
+    """
+    Hash perceptual (dHash) de 64 bits de la imagen: se reduce a 9x8 en escala de grises y cada bit
+    indica si un píxel es más claro que su vecino de la derecha. Fotos casi iguales (otra compresión,
+    otro tamaño, pequeños cambios de luz) dan hashes a pocos bits de distancia.
+
+    Retorna None si los bytes no son una imagen.
+    """
+    try:
+        with Image.open(io.BytesIO(image_data)) as imagen:
+            imagen.draft("L", (64, 64))
+            pixeles = imagen.convert("L").resize((9, 8), Image.LANCZOS).tobytes()
+    except Exception:
+        return None
+    valor = 0
+    for fila in range(8):
+        for columna in range(8):
+            valor = (valor << 1) | (pixeles[fila * 9 + columna] > pixeles[fila * 9 + columna + 1])
+    return valor
+
+def distancia_m(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+    p1 = math.radians(lat1)
+    p2 = math.radians(lat2)
+    a = math.sin((p2 - p1) / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 2 * RADIO_TIERRA_M * math.asin(math.sqrt(a))
+
+def _a_int64(valor: int) -> int:
+    # MongoDB guarda enteros de 64 bits con signo
+    return valor - (1 << 64) if valor >= (1 << 63) else valor
+
+def _de_int64(valor: int) -> int:
+    return valor + (1 << 64) if valor < 0 else valor
+
+class IndiceHashes:
+    """
+    Hashes de las imágenes recientes agrupados en una grilla de celdas de 'DUP_DISTANCIA_M' metros.
+
+    Buscar un duplicado revisa solo las 9 celdas alrededor del punto y compara la distancia de Hamming
+    de los hashes que hay en ellas. Las entradas más antiguas que la ventana se descartan al pasar.
+    """
+
+    def __init__(self, tamano_celda: float = DUP_DISTANCIA_M):
+        self.dlat = tamano_celda / METROS_POR_GRADO
+        self._celdas = {} # (fila, columna) -> [(hash, id imagen, lon, lat, fecha)]
+        self._lock = threading.Lock()
+
+    def _dlon(self, fila: int) -> float:
+        return self.dlat / max(math.cos(math.radians((fila + 0.5) * self.dlat)), 0.01)
+
+    def _celda(self, lon: float, lat: float) -> tuple[int, int]:
+        fila = math.floor(lat / self.dlat)
+        return fila, math.floor(lon / self._dlon(fila))
+
+    def agregar(self, hash: int, image_id: str, lon: float, lat: float, fecha: datetime):
+        with self._lock:
+            self._celdas.setdefault(self._celda(lon, lat), []).append((hash, image_id, lon, lat, fecha))
+
+    def buscar(self, hash: int, lon: float, lat: float) -> str | None:
+        """
+        Retorna el id de la imagen reciente más parecida a 'hash' tomada cerca de (lon, lat), o None.
+        """
+        limite = datetime.now() - timedelta(days=DUP_VENTANA_DIAS)
+        fila, columna = self._celda(lon, lat)
+        mejor = None
+        mejor_distancia = DUP_HAMMING_MAX
+        with self._lock:
+            for f in (fila - 1, fila, fila + 1):
+                # Las filas vecinas tienen otro ancho de celda: se busca la columna de la misma longitud
+                c = columna if f == fila else math.floor(lon / self._dlon(f))
+                for celda in ((f, c - 1), (f, c), (f, c + 1)):
+                    entradas = self._celdas.get(celda)
+                    if not entradas:
+                        continue
+                    entradas[:] = [e for e in entradas if e[4] >= limite]
+                    for h, image_id, plon, plat, _ in entradas:
+                        bits = (h ^ hash).bit_count()
+                        if bits <= mejor_distancia and distancia_m(lon, lat, plon, plat) <= DUP_DISTANCIA_M:
+                            mejor = image_id
+                            mejor_distancia = bits
+        return mejor
+
+indice = IndiceHashes()
+
+def cargar(collection) -> None:
+    """
+    Carga en el índice los hashes de la ventana guardados en 'collection' ('image_hashes').
+    """
+    if not DUP_ACTIVO:
+        return
+    limite = datetime.now() - timedelta(days=DUP_VENTANA_DIAS)
+    cantidad = 0
+    try:
+        collection.create_index("date")
+        for doc in collection.find({"date": {"$gte": limite}}):
+            lon, lat = doc["geometry"]["coordinates"][:2]
+            indice.agregar(_de_int64(doc["hash"]), doc["_id"], lon, lat, doc["date"])
+            cantidad += 1
+    except Exception as e:
+        print(f"    -[API] Error al cargar los hashes de imágenes: {e}")
+    print(f"    -[API] {cantidad} hashes de imágenes recientes cargados.")
+
+def registrar(collection, hash: int, image_id: str, lon: float, lat: float) -> None:
+    """
+    Agrega el hash de la imagen al índice y lo guarda en 'collection'.
+    """
+    fecha = datetime.now()
+    indice.agregar(hash, image_id, lon, lat, fecha)
+    try:
+        collection.insert_one({
+            "_id": image_id,
+            "hash": _a_int64(hash),
+            "geometry": {"type": "Point", "coordinates": [lon, lat]},
+            "date": fecha,
+        })
+    except Exception as e:
+        print(f"    -[API] Error al guardar el hash de la imagen '{image_id}': {e}")
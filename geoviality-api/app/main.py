@@ -8,6 +8,9 @@ from fastapi.middleware.cors import CORSMiddleware
 load_dotenv()
 
 from controllers import create_directories
+from database import db
+import indice_calles
+import duplicados
 from routes import router as api_router
 
 # Si USE_NGROK es "True" o no se especifica en .env, se usará NGROK (default)
@@ -17,6 +20,8 @@ if useNgrok.lower() == "true":
 # La unica forma de usar IP local es si USE_NGROK es "False" en el .env
 
 create_directories()
+indice_calles.iniciar(db.streets)
+duplicados.cargar(db.image_hashes)
 
 app = FastAPI()
 
@@ -17,11 +17,39 @@ class PhotoQueue(BaseModel):
     modo: str
     user: str
 
+# Modelo para el envío de un video a la cola: el video queda en el almacenamiento bajo 'key'
+# y 'track' son los puntos GPS [segundos desde el inicio del video, latitud, longitud]
+class VideoQueue(BaseModel):
+    id: str
+    key: str
+    track: list[list[float]]
+    date: datetime
+    modo: str
+    user: str
+
 # Modelo para recibir la foto de la IA
 class PhotoSave(BaseModel):
     image: str
     id: str
 
+# Aviso de la IA: la imagen 'id' ya está en el almacenamiento bajo 'key'
+class PhotoReady(BaseModel):
+    id: str
+    key: str
+
+# Una detección de la IA: clase, confianza (%) y caja [x_min, y_min, x_max, y_max] en píxeles
+class Deteccion(BaseModel):
+    clase: str
+    confianza: float
+    caja: list[float]
+
+# Detecciones de una imagen, con la versión del modelo y el tamaño de la imagen en que están las cajas
+class DeteccionesImagen(BaseModel):
+    modelo: str
+    ancho: int
+    alto: int
+    cajas: list[Deteccion]
+
 # Propiedades GeoJSON
 class Properties(BaseModel):
     id: str
@@ -34,6 +62,7 @@ class Properties(BaseModel):
     estado: int
     observaciones: str
     last_update: datetime
+    detecciones: dict[str, DeteccionesImagen] = {} # id de imagen -> sus detecciones
 
 # Geometry GeoJSON
 class Geometry(BaseModel):
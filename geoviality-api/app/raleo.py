@@ -0,0 +1,94 @@
+import os
+import math
+import threading
+from datetime import datetime, timezone
+
+# Fotos del modo 'auto': se descarta la foto que esté a menos de 'RALEO_DISTANCIA_M' metros o a menos de
+# 'RALEO_INTERVALO_SEG' segundos de la última aceptada del mismo usuario (0 desactiva cada criterio)
+RALEO_ACTIVO = os.getenv("RALEO_ACTIVO", "True").lower() == "true"
+RALEO_DISTANCIA_M = float(os.getenv("RALEO_DISTANCIA_M", 10))
+RALEO_INTERVALO_SEG = float(os.getenv("RALEO_INTERVALO_SEG", 0))
+# Pasado este tiempo desde la última aceptada, la siguiente se acepta siempre (otro recorrido por el mismo lugar)
+RALEO_REINICIO_SEG = float(os.getenv("RALEO_REINICIO_SEG", 600))
+
+RADIO_TIERRA_M = 6371008.8
+
+def distancia_m(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+    p1 = math.radians(lat1)
+    p2 = math.radians(lat2)
+    a = math.sin((p2 - p1) / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(math.radians(lon2 - lon1) / 2) ** 2
+    return 2 * RADIO_TIERRA_M * math.asin(math.sqrt(a))
+
+def _utc(fecha: datetime) -> datetime:
+    if fecha.tzinfo is not None:
+        return fecha.astimezone(timezone.utc).replace(tzinfo=None)
+    return fecha
+
+class Raleo:
+    """
+    Decide qué fotos del modo 'auto' pasan a la IA, para que la carga dependa de los kilómetros
+    recorridos y no de la cantidad de fotos que manda el celular.
+
+    Guarda por usuario la última foto aceptada (posición y fecha de captura) y los contadores de
+    fotos aceptadas y descartadas.
+    """
+
+    def __init__(self):
+        self._ultima = {} # usuario -> (lon, lat, fecha)
+        self._anterior = {} # usuario -> la última aceptada antes de '_ultima' (para 'deshacer')
+        self._contadores = {} # usuario -> {'aceptadas', 'descartadas'}
+        self._lock = threading.Lock()
+
+    def aceptar(self, usuario: str, lon: float, lat: float, fecha: datetime) -> bool:
+        """
+        Retorna True si la foto debe procesarse (y la deja como la última aceptada del usuario).
+        """
+        fecha = _utc(fecha)
+        with self._lock:
+            contadores = self._contadores.setdefault(usuario, {"aceptadas": 0, "descartadas": 0})
+            ultima = self._ultima.get(usuario)
+            aceptada = True
+            if ultima is not None:
+                ulon, ulat, ufecha = ultima
+                segundos = abs((fecha - ufecha).total_seconds())
+                if segundos < RALEO_REINICIO_SEG:
+                    cerca = RALEO_DISTANCIA_M > 0 and distancia_m(lon, lat, ulon, ulat) < RALEO_DISTANCIA_M
+                    seguida = RALEO_INTERVALO_SEG > 0 and segundos < RALEO_INTERVALO_SEG
+                    aceptada = not (cerca or seguida)
+            if aceptada:
+                self._anterior[usuario] = ultima
+                self._ultima[usuario] = (lon, lat, fecha)
+                contadores["aceptadas"] += 1
+            else:
+                contadores["descartadas"] += 1
+            return aceptada
+
+    def deshacer(self, usuario: str, lon: float, lat: float, fecha: datetime):
+        """
+        Revierte un 'aceptar' de una foto que al final no se pudo enviar a la IA.
+
+        La última aceptada vuelve a ser la anterior solo si la foto sigue siendo la última del usuario;
+        si ya se aceptó otra después, se deja esa.
+        """
+        fecha = _utc(fecha)
+        with self._lock:
+            contadores = self._contadores.get(usuario)
+            if contadores is not None and contadores["aceptadas"] > 0:
+                contadores["aceptadas"] -= 1
+            if self._ultima.get(usuario) == (lon, lat, fecha):
+                anterior = self._anterior.pop(usuario, None)
+                if anterior is None:
+                    self._ultima.pop(usuario, None)
+                else:
+                    self._ultima[usuario] = anterior
+
+    def contadores(self, usuario: str | None = None) -> dict:
+        """
+        Retorna {usuario: {'aceptadas', 'descartadas'}} de todos los usuarios, o solo de 'usuario'.
+        """
+        with self._lock:
+            if usuario is not None:
+                return {usuario: dict(self._contadores.get(usuario, {"aceptadas": 0, "descartadas": 0}))}
+            return {u: dict(c) for u, c in self._contadores.items()}
+
+raleo = Raleo()
@@ -1,7 +1,7 @@
 from fastapi import APIRouter, File, UploadFile, Request, Depends, status, Form, WebSocket, WebSocketDisconnect
 from datetime import datetime, timedelta
 import os
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import FileResponse, StreamingResponse, Response
 from fastapi.exceptions import HTTPException
 from fastapi.security import OAuth2PasswordRequestForm
 import dotenv
@@ -11,12 +11,17 @@ import pytz
 dotenv.load_dotenv()
 
 from database import db
-from controllers import create_uuid, send_to_queue
+from almacenamiento import almacenamiento
+import indice_calles
+from controllers import create_uuid, send_to_queue, send_video_to_queue, leer_track, preparar_imagen, agregar_duplicado
+import duplicados
+from raleo import raleo, RALEO_ACTIVO
+from fastapi.concurrency import run_in_threadpool
 from controllers import create_user_to_mongodb, read_user_from_mongodb, update_user_to_mongodb, delete_user_from_mongodb
-from controllers import authenticate_user, create_access_token, get_current_active_user, receive_image_from_IA
+from controllers import authenticate_user, create_access_token, get_current_active_user, receive_image_from_IA, respuesta_imagen, respuesta_imagen_anotada, id_imagen_valido
 from controllers import read_all_users_from_mongodb,modificar_calles , event_generator1, event_generator2 , obtener_datos_historicos, eliminar_de_calles, test, encontrar_calle_mas_cercana
 from controllers import ACCESS_TOKEN_EXPIRE_MINUTES, event_queue1, event_queue2 , procesar
-from models import UserCreate, UserUpdate, Token, UserSol, UserLogin, User, PhotoQueue, InfoUpdate, PhotoSave, Geometry
+from models import UserCreate, UserUpdate, Token, UserSol, UserLogin, User, PhotoQueue, VideoQueue, InfoUpdate, PhotoSave, PhotoReady, Geometry
 from models import UserResponse, DataResponse, PhotoDB, BoundingBox, DatosHistoricos, DatosHistoricosResponse, SidewalksDB
 
 router = APIRouter()
@@ -39,8 +44,35 @@ async def upload_image(
     user: User = Depends(get_current_active_user)
 ):
     date = datetime.fromisoformat(date)
+
+    # Modo 'auto': se descartan las fotos muy cercanas a la última aceptada del mismo usuario
+    raleada = modo == 'auto' and RALEO_ACTIVO
+    if raleada and not raleo.aceptar(user.username, longitude, latitude, date):
+        return {"message": "Photo skipped: too close to the previous one", "skipped": True}
+
+    try:
+        return await guardar_y_enviar_imagen(image, latitude, longitude, date, modo, user)
+    except BaseException:
+        # La foto no llegó a la IA: no cuenta como aceptada, así la siguiente se compara con la anterior
+        if raleada:
+            raleo.deshacer(user.username, longitude, latitude, date)
+        raise
+
+# Guarda la imagen y la envía a la cola de RabbitMQ (o la agrega al punto de una foto casi igual)
+async def guardar_y_enviar_imagen(image: UploadFile, latitude: float, longitude: float, date: datetime, modo: str, user: User):
     _id = create_uuid()
     image_data = await image.read()
+    # Disco, Pillow, MongoDB y RabbitMQ van en el threadpool para no frenar el event loop con otras subidas
+    image_data, hash = await run_in_threadpool(preparar_imagen, _id, image_data)
+
+    # Foto casi igual a una reciente del mismo lugar: se agrega al punto de esa foto sin pasar por la IA
+    if hash is not None:
+        original = duplicados.indice.buscar(hash, longitude, latitude)
+        if original is not None:
+            if await run_in_threadpool(agregar_duplicado, original, _id, image_data, hash, longitude, latitude):
+                await publicar_punto(_id)
+                return {"message": f"Photo uploaded successfully with id: {_id}", "duplicate_of": original}
+
     photo_data = PhotoQueue(
         id = _id,
         image = image_data.decode('latin1'),
@@ -51,12 +83,61 @@ async def upload_image(
         user= user.username
     )
     print( f"    - [API] Enviando imagen '{_id}' a la cola de RabbitMQ.")
-    res = send_to_queue(photo_data)
+    res = await run_in_threadpool(send_to_queue, photo_data)
     if res:
+        if hash is not None:
+            await run_in_threadpool(duplicados.registrar, db.image_hashes, hash, _id, longitude, latitude)
         return {"message": f"Photo uploaded successfully with id: {_id}"}
     else:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Error uploading data")
 
+# Sube un video de dashcam con su track GPS (GPX o CSV) y lo envía a la cola de videos.
+# La IA muestrea frames del video según la distancia recorrida o los cambios de escena, y cada frame
+# con detecciones queda como una imagen más (con id '<id del video>-<frame>'). Se procesa como modo 'auto'.
+@router.post("/upload/video")
+async def upload_video(
+    video: UploadFile = File(...),
+    track: UploadFile = File(...),
+    date: str = Form(...),
+    user: User = Depends(get_current_active_user)
+):
+    date = datetime.fromisoformat(date)
+    try:
+        puntos = leer_track(await track.read(), date)
+    except Exception as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid GPS track: {e}")
+    if len(puntos) < 2:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="The GPS track needs at least 2 points")
+
+    _id = create_uuid()
+    extension = os.path.splitext(video.filename or "")[1].lower() or ".mp4"
+    key = f"video-{_id}{extension}"
+    # El video se copia por partes al almacenamiento, sin cargarlo entero en memoria
+    await run_in_threadpool(almacenamiento.guardar_archivo, key, video.file)
+
+    video_data = VideoQueue(
+        id = _id,
+        key = key,
+        track = puntos,
+        date = date,
+        modo = 'auto',
+        user = user.username
+    )
+    print( f"    - [API] Enviando video '{_id}' a la cola de RabbitMQ.")
+    if send_video_to_queue(video_data):
+        return {"message": f"Video uploaded successfully with id: {_id}", "track_points": len(puntos)}
+    almacenamiento.eliminar(key)
+    raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Error uploading data")
+
+# Fotos del modo 'auto' aceptadas y descartadas por usuario
+@router.get("/data/thinning")
+async def get_thinning(user: User = Depends(get_current_active_user)) -> dict:
+    return raleo.contadores()
+
+@router.get("/data/thinning/{username}")
+async def get_thinning_user(username: str, user: User = Depends(get_current_active_user)) -> dict:
+    return raleo.contadores(username)
+
 # Obtiene información de las imágenes procesadas desde la base de datos
 @router.get("/data/processed_info")
 async def get_processed_info(user: User = Depends(get_current_active_user)) -> list[PhotoDB]:
@@ -77,14 +158,20 @@ async def get_processed_info_type(request: Request, user: User = Depends(get_cur
     except:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Type not found")
 
-# Descarga la imagen 'image_id' de 'post_pro'
+# Descarga la imagen 'image_id' del almacenamiento de imágenes.
+# Con '?anotada=true' se responde con las detecciones de la IA dibujadas encima (se dibujan al pedirlas y quedan en caché)
 @router.get("/download/get_image/{image_id}")
-async def download_image(request: Request, user: User = Depends(get_current_active_user)) -> FileResponse:
+async def download_image(request: Request, anotada: bool = False, user: User = Depends(get_current_active_user)) -> Response:
     image_id = request.path_params['image_id']
-    file_path = os.path.join(os.getcwd(),f"services/imgs/{image_id}.jpg")
-    if not os.path.exists(file_path):
+    if not id_imagen_valido(image_id):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Image not found")
-    return FileResponse(file_path)
+    if anotada:
+        respuesta = await run_in_threadpool(respuesta_imagen_anotada, image_id)
+    else:
+        respuesta = respuesta_imagen(f"{image_id}.jpg")
+    if respuesta is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Image not found")
+    return respuesta
 
 # Obtiene información de una imagen procesada de la IA
 @router.get("/data/point/{id}")
@@ -95,18 +182,47 @@ async def get_point(request: Request, user: User = Depends(get_current_active_us
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Point not found")
     return PhotoDB(**point)
 
-# Obtener una imagen procesada de la IA
-@router.post("/data/processed_image")
-async def get_processed_image(data: PhotoSave):
-    receive_image_from_IA(data)
-    photo = db.processed_geojson.find_one({"properties.images": data.id})
+# Publica en las colas de eventos el punto al que pertenece la imagen 'image_id'
+async def publicar_punto(image_id: str):
+    photo = db.processed_geojson.find_one({"properties.images": image_id})
     if photo is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Photo not found")
     photo = PhotoDB(**photo)
     await event_queue1.put(photo.model_dump_json())
     await event_queue2.put(photo.model_dump_json())
+
+# Obtener una imagen procesada de la IA
+@router.post("/data/processed_image")
+async def get_processed_image(data: PhotoSave):
+    receive_image_from_IA(data)
+    await publicar_punto(data.id)
+    return {"message": "Image received successfully"}
+
+# Aviso de la IA: la imagen procesada ya está en el almacenamiento
+@router.post("/data/processed_image/ready")
+async def processed_image_ready(data: PhotoReady):
+    if not almacenamiento.existe(data.key):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Image not found in storage")
+    await publicar_punto(data.id)
     return {"message": "Image received successfully"}
 
+# Varios avisos de la IA en una petición; retorna los ids publicados y el error de los que no
+@router.post("/data/processed_image/ready/batch")
+async def processed_images_ready(data: list[PhotoReady]):
+    ok = []
+    errores = {}
+    for photo in data:
+        if not almacenamiento.existe(photo.key):
+            errores[photo.id] = "Image not found in storage"
+            continue
+        try:
+            await publicar_punto(photo.id)
+        except HTTPException as e:
+            errores[photo.id] = e.detail
+            continue
+        ok.append(photo.id)
+    return {"ok": ok, "errores": errores}
+
 @router.get("/data/processed_info/date/{year}/{month}")
 async def get_processed_info_date(year: int, month: int, user: User = Depends(get_current_active_user)) -> List[PhotoDB]:
     year = int(year)
@@ -295,6 +411,20 @@ async def get_streets(bbox: BoundingBox, user: User = Depends(get_current_active
     streets = list(db.streets.find(query, {"_id": 0}))
     return streets
 
+# Recarga el índice de calles en memoria (usar después de modificar la colección 'streets') y avisa a
+# los workers de la IA y a los demás procesos de la API para que recarguen el suyo
+@router.post("/data/streets/refresh")
+async def refresh_streets(user: User = Depends(get_current_active_user)):
+    try:
+        calles = await run_in_threadpool(indice_calles.refrescar, db.streets)
+    except Exception as e:
+        print(f"    -[API] Error al refrescar el índice de calles: {e}")
+        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Error refreshing streets index")
+    if not await run_in_threadpool(indice_calles.avisar_refresco):
+        # Los demás procesos lo recargan en su próximo refresco periódico ('CALLES_INDICE_REFRESCO_SEG')
+        return {"message": f"Streets index refreshed with {calles} streets (other processes not notified)"}
+    return {"message": f"Streets index refreshed with {calles} streets"}
+
 ##################################################################################
 # RUTA DE EVENTOS
 ##################################################################################
@@ -381,9 +511,7 @@ async def upload_sidewalks(
     
     if res:
         image = await image.read()
-        image_path = f"services/imgs/{id}.jpg"
-        with open(image_path, "wb") as f:
-            f.write(image)
+        almacenamiento.guardar(f"{id}.jpg", image)
         print(f"    [API] imagen guardada con el id: {id}")
         return {" message": f"Sidewalk uploaded successfully with id: {id}"}
     else: 
@@ -0,0 +1,76 @@
+import os
+import sys
+import time
+import atexit
+import signal
+import contextlib
+
+# Archivo que existe solo mientras el worker está listo para consumir (modelos cargados y calentados,
+# conectado a RabbitMQ). Lo usa el healthcheck del contenedor. Queda fuera de 'imgs' para que no
+# sobreviva en el volumen del host si el contenedor muere.
+ruta_listo = os.getenv('IA_LISTO_RUTA', '/tmp/ia-listo')
+
+_inicio = time.perf_counter() # Al importar este módulo (lo primero que hace 'main.py')
+tiempos = {} # fase -> segundos
+
+def limpiar():
+    """
+    Borra el archivo de listo que haya quedado de una ejecución anterior.
+    """
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(ruta_listo)
+
+@contextlib.contextmanager
+def fase(nombre: str):
+    """
+    Mide la duración de una fase del arranque y la deja en 'tiempos':
+
+        with arranque.fase('modelos'):
+            ...
+    """
+    inicio = time.perf_counter()
+    try:
+        yield
+    finally:
+        tiempos[nombre] = time.perf_counter() - inicio
+        print(f"    - [IA] Arranque: fase '{nombre}' en {tiempos[nombre]:.2f} s.")
+
+def registrar(nombre: str, segundos: float):
+    """
+    Registra una fase medida por fuera de 'fase' (por ejemplo, en otro hilo).
+    """
+    tiempos[nombre] = segundos
+
+def desde_inicio() -> float:
+    return time.perf_counter() - _inicio
+
+def marcar_listo():
+    """
+    Imprime el resumen de tiempos del arranque, los publica como métricas y crea el archivo de listo.
+    """
+    import metricas
+    total = desde_inicio()
+    for nombre, segundos in tiempos.items():
+        metricas.arranque.labels(nombre).set(segundos)
+    metricas.arranque.labels('total').set(total)
+    metricas.listo.set(1)
+    detalle = ', '.join(f"{nombre} {segundos:.2f} s" for nombre, segundos in tiempos.items())
+    print(f"    - [IA] Listo para consumir en {total:.2f} s ({detalle}).")
+    os.makedirs(os.path.dirname(ruta_listo) or '.', exist_ok=True)
+    with open(ruta_listo, 'w') as f:
+        f.write(f"{os.getpid()} {total:.2f}\n")
+    atexit.register(limpiar)
+
+def _terminar(senal, frame):
+    print(f"    - [IA] Señal {signal.Signals(senal).name} recibida, terminando...")
+    sys.exit(0)
+
+def instalar_senales():
+    """
+    Hace que SIGTERM ('docker stop') termine el proceso con 'sys.exit', así corren los 'atexit'
+    (escribir y cerrar el log de detecciones, borrar el archivo de listo). Como PID 1 del contenedor,
+    sin esto el proceso ignora SIGTERM y docker lo termina con SIGKILL, sin cerrar nada.
+
+    Se llama desde el hilo principal de cada proceso.
+    """
+    signal.signal(signal.SIGTERM, _terminar)
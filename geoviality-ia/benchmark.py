@@ -0,0 +1,574 @@
+"""
+Benchmark del worker de IA sin RabbitMQ, sin Atlas y sin la API.
+
+Los mensajes salen de una cola en memoria y entran por el mismo camino que en producción
+('main.callback', 'main.procesar_lote' o el pipeline), con:
+
+    - una BD en memoria (o una MongoDB local con --mongo) con calles sintéticas alrededor de las fotos,
+    - una API de mentira en un puerto local que responde OK a los avisos,
+    - un modelo falso determinista (o los pesos reales con --pesos-auto / --pesos-peaton).
+
+Reporta imágenes por segundo, percentiles de cada etapa (de las métricas de 'metricas.py'), latencia
+de punta a punta por mensaje y memoria máxima, como JSON con el commit del repositorio, para poder
+comparar corridas entre commits (--comparar otra.json).
+
+    python benchmark.py --sinteticas 500 --modo lotes --salida resultado.json
+    python benchmark.py --imagenes carpeta/ --pesos-auto pesos.pt --comparar resultado.json
+"""
+import os
+import sys
+import json
+import time
+import types
+import queue
+import random
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+
+EXTENSIONES = ('.jpg', '.jpeg', '.png')
+CLASES = ['hoyo', 'hoyo con agua', 'cocodrilo', 'cocodrilo con agua', 'lomo de toro', 'grieta', 'longitudinal']
+# Centro de las coordenadas sintéticas (Santiago)
+LATITUD, LONGITUD = -33.4489, -70.6693
+METROS_POR_GRADO = 111320.0
+
+def _argumentos():
+    parser = argparse.ArgumentParser(description="Benchmark del worker de IA con dependencias locales")
+    parser.add_argument('--imagenes', help="Carpeta con imágenes de ejemplo (si no, se generan sintéticas)")
+    parser.add_argument('--sinteticas', type=int, default=300, help="Cantidad de mensajes a procesar")
+    parser.add_argument('--resolucion', default='1280x720', help="Tamaño de las imágenes sintéticas (ancho x alto)")
+    parser.add_argument('--calentamiento', type=int, default=10, help="Mensajes iniciales que no se miden")
+    parser.add_argument('--modo', choices=['simple', 'lotes', 'pipeline'], default='simple', help="Modo de consumo a medir")
+    parser.add_argument('--lote', type=int, default=8, help="Tamaño de lote (modos 'lotes' y 'pipeline')")
+    parser.add_argument('--prefetch', type=int, default=16, help="Mensajes en vuelo (modo 'pipeline')")
+    parser.add_argument('--modo-imagen', choices=['auto', 'peaton', 'mezcla'], default='mezcla', help="'modo' de los mensajes")
+    parser.add_argument('--pesos-auto', help="Pesos reales del modelo de vehiculo (si no, modelo falso)")
+    parser.add_argument('--pesos-peaton', help="Pesos reales del modelo de peaton (si no, modelo falso)")
+    parser.add_argument('--proporcion-detecciones', type=float, default=0.5, help="Modelo falso: fracción de imágenes con detecciones")
+    parser.add_argument('--latencia-modelo-ms', type=float, default=0.0, help="Modelo falso: tiempo extra por imagen")
+    parser.add_argument('--mongo', help="URI de una MongoDB local (si no, BD en memoria)")
+    parser.add_argument('--latencia-mongo-ms', type=float, default=0.0, help="BD en memoria: espera por cada 'bulk_write'")
+    parser.add_argument('--latencia-api-ms', type=float, default=0.0, help="API de mentira: espera por petición")
+    parser.add_argument('--semilla', type=int, default=1234)
+    parser.add_argument('--salida', help="Archivo donde guardar el resultado JSON")
+    parser.add_argument('--comparar', help="Resultado JSON de otra corrida para comparar")
+    return parser.parse_args()
+
+# BD en memoria
+
+class ColeccionMemoria:
+    """
+    Lo que el worker usa de una colección de pymongo: 'bulk_write', 'find', 'find_one', 'watch' y 'create_index'.
+
+    Los 'InsertOne' se guardan; el resto de las operaciones solo se cuentan.
+    """
+
+    def __init__(self, nombre: str, latencia_ms: float):
+        self.nombre = nombre
+        self.latencia_ms = latencia_ms
+        self.documentos = {}
+        self.operaciones = 0
+        self._lock = threading.Lock()
+
+    def bulk_write(self, operaciones, ordered=True):
+        if self.latencia_ms:
+            time.sleep(self.latencia_ms / 1000)
+        with self._lock:
+            for operacion in operaciones:
+                documento = getattr(operacion, '_doc', None)
+                if type(operacion).__name__ == 'InsertOne' and documento is not None:
+                    self.documentos.setdefault(documento.get('_id', len(self.documentos)), documento)
+                self.operaciones += 1
+
+    def insert_many(self, documentos):
+        with self._lock:
+            for documento in documentos:
+                self.documentos[documento.get('_id', len(self.documentos))] = documento
+
+    def find(self, filtro=None, proyeccion=None):
+        with self._lock:
+            return list(self.documentos.values())
+
+    def find_one(self, filtro=None, *args, **kwargs):
+        return None
+
+    def watch(self, *args, **kwargs):
+        from pymongo.errors import PyMongoError
+        raise PyMongoError("la BD en memoria no tiene change streams")
+
+    def create_index(self, *args, **kwargs):
+        return None
+
+class BDMemoria:
+    def __init__(self, latencia_ms: float):
+        self.latencia_ms = latencia_ms
+        self._colecciones = {}
+
+    def __getitem__(self, nombre: str) -> ColeccionMemoria:
+        if nombre not in self._colecciones:
+            self._colecciones[nombre] = ColeccionMemoria(nombre, self.latencia_ms)
+        return self._colecciones[nombre]
+
+    def __getattr__(self, nombre: str) -> ColeccionMemoria:
+        if nombre.startswith('_'):
+            raise AttributeError(nombre)
+        return self[nombre]
+
+def calles_sinteticas(paso_m: float = 100, cantidad: int = 30) -> list[dict]:
+    """
+    Grilla de calles (norte-sur y este-oeste) cada 'paso_m' metros alrededor del centro.
+    """
+    dlat = paso_m / METROS_POR_GRADO
+    dlon = dlat / np.cos(np.radians(LATITUD))
+    mitad = cantidad // 2
+    calles = []
+    for i in range(-mitad, mitad + 1):
+        calles.append({
+            "id": f"ns-{i}", "properties": {"name": f"Calle {i}"},
+            "geometry": {"type": "LineString", "coordinates": [
+                [LONGITUD + i * dlon, LATITUD - mitad * dlat], [LONGITUD + i * dlon, LATITUD + mitad * dlat]
+            ]}
+        })
+        calles.append({
+            "id": f"eo-{i}", "properties": {"name": f"Avenida {i}"},
+            "geometry": {"type": "LineString", "coordinates": [
+                [LONGITUD - mitad * dlon, LATITUD + i * dlat], [LONGITUD + mitad * dlon, LATITUD + i * dlat]
+            ]}
+        })
+    return calles
+
+# API de mentira
+
+class APIFalsa(BaseHTTPRequestHandler):
+    latencia_ms = 0.0
+    avisos = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        cuerpo = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'null')
+        if self.latencia_ms:
+            time.sleep(self.latencia_ms / 1000)
+        cantidad = len(cuerpo) if isinstance(cuerpo, list) else 1
+        with APIFalsa.lock:
+            APIFalsa.avisos += cantidad
+        respuesta = json.dumps({"ok": cantidad, "errores": {}}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(respuesta)))
+        self.end_headers()
+        self.wfile.write(respuesta)
+
+    def log_message(self, *args):
+        pass
+
+def iniciar_api_falsa(latencia_ms: float) -> int:
+    APIFalsa.latencia_ms = latencia_ms
+    servidor = ThreadingHTTPServer(('127.0.0.1', 0), APIFalsa)
+    threading.Thread(target=servidor.serve_forever, name='api-falsa', daemon=True).start()
+    return servidor.server_address[1]
+
+# Modelo falso
+
+class ModeloFalso:
+    """
+    Modelo determinista con la interfaz de YOLO que usa el worker ('names' y 'predict').
+
+    Si una imagen tiene detecciones, y cuáles, depende solo de su contenido: la misma imagen da
+    siempre el mismo resultado. Hace el mismo preprocesamiento (letterbox a 640) que un modelo real.
+    """
+
+    def __init__(self, proporcion: float, latencia_ms: float):
+        self.names = dict(enumerate(CLASES))
+        self.proporcion = proporcion
+        self.latencia_ms = latencia_ms
+
+    def predict(self, frames, conf=0.25, **_):
+        from modelo_onnx import ResultadoONNX, letterbox
+        resultados = []
+        for frame in frames:
+            letterbox(frame, (640, 640))
+            semilla = zlib.crc32(np.ascontiguousarray(frame[::32, ::32]).tobytes())
+            azar = random.Random(semilla)
+            cajas, puntajes, clases = [], [], []
+            if azar.random() < self.proporcion:
+                alto, ancho = frame.shape[:2]
+                for _ in range(azar.randint(1, 3)):
+                    x, y = azar.uniform(0, ancho * 0.8), azar.uniform(0, alto * 0.8)
+                    cajas.append([x, y, x + azar.uniform(20, ancho * 0.2), y + azar.uniform(20, alto * 0.2)])
+                    puntajes.append(azar.uniform(0.7, 0.99))
+                    clases.append(azar.randrange(len(CLASES)))
+            resultados.append(ResultadoONNX(
+                frame, np.array(cajas, dtype=np.float32).reshape(-1, 4),
+                np.array(puntajes, dtype=np.float32), np.array(clases, dtype=np.float32), self.names
+            ))
+        if self.latencia_ms:
+            time.sleep(self.latencia_ms * len(frames) / 1000)
+        return resultados
+
+# Mensajes
+
+def imagenes_de_carpeta(carpeta: str) -> list[bytes]:
+    rutas = [os.path.join(carpeta, f) for f in sorted(os.listdir(carpeta)) if f.lower().endswith(EXTENSIONES)]
+    imagenes = []
+    for ruta in rutas:
+        with open(ruta, 'rb') as f:
+            imagenes.append(f.read())
+    if not imagenes:
+        raise SystemExit(f"No hay imágenes en '{carpeta}'")
+    return imagenes
+
+def imagenes_sinteticas(cantidad: int, resolucion: str, semilla: int) -> list[bytes]:
+    """
+    JPEGs con textura de asfalto (ruido suavizado) y algunas manchas y líneas, distintos entre sí.
+    """
+    ancho, alto = (int(v) for v in resolucion.lower().split('x'))
+    generador = np.random.default_rng(semilla)
+    imagenes = []
+    for _ in range(cantidad):
+        ruido = generador.normal(110, 25, (alto // 4, ancho // 4, 1)).clip(0, 255).astype(np.uint8)
+        frame = cv2.resize(cv2.GaussianBlur(ruido, (5, 5), 0), (ancho, alto))
+        frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+        for _ in range(generador.integers(1, 6)):
+            centro = (int(generador.integers(0, ancho)), int(generador.integers(alto // 2, alto)))
+            cv2.ellipse(frame, centro, (int(generador.integers(20, 120)), int(generador.integers(10, 50))), 0, 0, 360,
+                        (40, 40, 45), -1)
+        cv2.line(frame, (ancho // 2, alto), (ancho // 2 + int(generador.integers(-200, 200)), alto // 2), (220, 220, 220), 8)
+        imagenes.append(cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 85])[1].tobytes())
+    return imagenes
+
+def mensajes(imagenes: list[bytes], cantidad: int, modo_imagen: str, semilla: int) -> list[bytes]:
+    """
+    Cuerpos de mensajes como los que publica la API: un recorrido con pasos de ~5 m, así que hay
+    imágenes que caen sobre irregularidades ya creadas.
+    """
+    azar = random.Random(semilla)
+    lat, lon = LATITUD, LONGITUD
+    cuerpos = []
+    for i in range(cantidad):
+        lat += azar.uniform(-5, 5) / METROS_POR_GRADO
+        lon += azar.uniform(-5, 5) / METROS_POR_GRADO
+        modo = modo_imagen if modo_imagen != 'mezcla' else ('auto' if i % 2 == 0 else 'peaton')
+        cuerpos.append(json.dumps({
+            'id': f'bench-{semilla}-{i:06d}',
+            'latitude': lat,
+            'longitude': lon,
+            'date': '2024-01-01T12:00:00',
+            'type': [],
+            'modo': modo,
+            'user': 'benchmark',
+            'image': imagenes[i % len(imagenes)].decode('latin1'),
+        }).encode())
+    return cuerpos
+
+# Medición
+
+class SerieMedida:
+    def __init__(self, original, muestras: list):
+        self.original = original
+        self.muestras = muestras
+
+    def observe(self, valor: float):
+        self.muestras.append(valor)
+        self.original.observe(valor)
+
+    def time(self):
+        serie = self
+
+        class _Medicion:
+            def __enter__(self):
+                self.inicio = time.perf_counter()
+
+            def __exit__(self, *exc):
+                serie.observe(time.perf_counter() - self.inicio)
+        return _Medicion()
+
+class HistogramaMedido:
+    """
+    Envuelve un Histogram de 'metricas.py' guardando además cada observación, para calcular percentiles exactos.
+    """
+
+    def __init__(self, original):
+        self.original = original
+        self.muestras = {}
+
+    def labels(self, *valores):
+        return SerieMedida(self.original.labels(*valores), self.muestras.setdefault(':'.join(valores), []))
+
+    def limpiar(self):
+        for muestras in self.muestras.values():
+            muestras.clear()
+
+def percentiles(muestras: list, escala: float = 1000) -> dict:
+    valores = np.array(muestras) * escala
+    return {
+        'n': int(valores.size),
+        'media': round(float(valores.mean()), 3),
+        'p50': round(float(np.percentile(valores, 50)), 3),
+        'p90': round(float(np.percentile(valores, 90)), 3),
+        'p99': round(float(np.percentile(valores, 99)), 3),
+        'max': round(float(valores.max()), 3),
+    }
+
+class Metodo:
+    def __init__(self, tag: int):
+        self.delivery_tag = tag
+        self.redelivered = False
+
+class CanalFalso:
+    """
+    Canal de pika en memoria: registra acks y nacks y la latencia de cada mensaje desde que se entregó.
+    """
+
+    def __init__(self):
+        self.entregados = {}
+        self.latencias = []
+        self.acks = 0
+        self.nacks = 0
+        self.terminado = threading.Condition()
+
+    def entregar(self, tag: int):
+        with self.terminado:
+            self.entregados[tag] = time.perf_counter()
+
+    def _terminar(self, tag: int):
+        with self.terminado:
+            self.latencias.append(time.perf_counter() - self.entregados.pop(tag))
+            self.terminado.notify_all()
+
+    def basic_ack(self, delivery_tag):
+        self.acks += 1
+        self._terminar(delivery_tag)
+
+    def basic_nack(self, delivery_tag, requeue=True):
+        self.nacks += 1
+        self._terminar(delivery_tag)
+
+    def esperar(self, pendientes_maximos: int = 0):
+        with self.terminado:
+            self.terminado.wait_for(lambda: len(self.entregados) <= pendientes_maximos)
+
+class ConexionFalsa:
+    """
+    Lo que el pipeline usa de la conexión de pika: las confirmaciones se ejecutan en el momento.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def add_callback_threadsafe(self, callback):
+        with self._lock:
+            callback()
+
+def commit_actual() -> dict:
+    carpeta = os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=carpeta, capture_output=True, text=True).stdout.strip()
+        cambios = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=carpeta, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return {'commit': None, 'modificado': None}
+    return {'commit': commit or None, 'modificado': bool(cambios)}
+
+# Corrida
+
+def preparar_entorno(args, directorio: str, puerto_api: int):
+    """
+    Variables de entorno de los módulos del worker: se definen antes de importarlos.
+    """
+    os.environ.update({
+        'HOST': '127.0.0.1',
+        'PORT': str(puerto_api),
+        'STORAGE_BACKEND': 'local',
+        'STORAGE_LOCAL_DIR': os.path.join(directorio, 'almacenamiento'),
+        'IA_OUTBOX_RUTA': os.path.join(directorio, 'outbox.db'),
+        'IA_MODO_CONSUMO': args.modo,
+        'IA_LOTE_TAMANO': str(args.lote),
+        'IA_PREFETCH': str(args.prefetch),
+        'IA_METRICAS_PUERTO': '0',
+        'IA_REVISION_MODELOS_SEG': '0',
+        'CALLES_INDICE_REFRESCO_SEG': '0',
+    })
+    if args.mongo:
+        os.environ['MONGODB_URI'] = args.mongo
+        os.environ.setdefault('DATABASE_NAME', 'geoviality_benchmark')
+    else:
+        bd = BDMemoria(args.latencia_mongo_ms)
+        bd.streets.insert_many(calles_sinteticas())
+        sys.modules['database'] = types.SimpleNamespace(db=bd)
+
+def preparar_modelos(args):
+    import registro_modelos
+    pesos = {'auto': args.pesos_auto, 'peaton': args.pesos_peaton}
+    reales = {modo: ruta for modo, ruta in pesos.items() if ruta}
+    if reales:
+        registro_modelos.cargar_modelos(reales)
+    for modo in pesos:
+        if modo not in reales:
+            registro_modelos.backends[modo] = 'falso'
+            registro_modelos._modelos[modo] = ModeloFalso(args.proporcion_detecciones, args.latencia_modelo_ms)
+            registro_modelos._versiones[modo] = 'falso'
+    return {modo: (os.path.basename(reales[modo]) if modo in reales else 'falso') for modo in pesos}
+
+def consumir(args, cuerpos: list[bytes], canal: CanalFalso, inicio_tag: int):
+    """
+    Pasa 'cuerpos' por el modo de consumo elegido y espera a que todos queden confirmados.
+    """
+    import main
+    cola = queue.Queue()
+    for i, cuerpo in enumerate(cuerpos):
+        cola.put((Metodo(inicio_tag + i), cuerpo))
+
+    if args.modo == 'simple':
+        while not cola.empty():
+            method, body = cola.get()
+            canal.entregar(method.delivery_tag)
+            main.callback(canal, method, None, body)
+    elif args.modo == 'lotes':
+        while not cola.empty():
+            lote = []
+            while len(lote) < args.lote and not cola.empty():
+                method, body = cola.get()
+                canal.entregar(method.delivery_tag)
+                lote.append((method, body))
+            main.procesar_lote(canal, lote)
+    else:
+        pipeline = consumir.pipeline
+        while not cola.empty():
+            # El prefetch de RabbitMQ acota los mensajes en vuelo
+            canal.esperar(args.prefetch - 1)
+            method, body = cola.get()
+            canal.entregar(method.delivery_tag)
+            pipeline.recibir(canal, method, None, body)
+    canal.esperar(0)
+
+def correr(args) -> dict:
+    directorio = tempfile.mkdtemp(prefix='geoviality-benchmark-')
+    puerto_api = iniciar_api_falsa(args.latencia_api_ms)
+    preparar_entorno(args, directorio, puerto_api)
+    os.chdir(directorio)
+
+    import metricas
+    metricas.etapas = HistogramaMedido(metricas.etapas)
+    metricas.inferencia = HistogramaMedido(metricas.inferencia)
+    import main
+    from funcs import create_directories, outbox_api
+    from database import db
+    import indice_irregularidades
+    import indice_calles
+
+    create_directories()
+    modelos = preparar_modelos(args)
+    indice_irregularidades.iniciar(db.processed_geojson)
+    indice_calles.iniciar(db.streets, avisos=False)
+    outbox_api().iniciar_envio()
+
+    canal = CanalFalso()
+    if args.modo == 'pipeline':
+        from pipeline import Pipeline
+        consumir.pipeline = Pipeline(ConexionFalsa(), canal, main.confianza, main.path_post, main.path_csv,
+                                     args.lote, args.prefetch, main.guardar_pre)
+
+    if args.imagenes:
+        imagenes = imagenes_de_carpeta(args.imagenes)
+    else:
+        imagenes = imagenes_sinteticas(min(args.sinteticas, 64), args.resolucion, args.semilla)
+    cuerpos = mensajes(imagenes, args.calentamiento + args.sinteticas, args.modo_imagen, args.semilla)
+
+    salida_original = sys.stdout
+    sys.stdout = open(os.devnull, 'w') # Los prints por imagen del worker distorsionan la medición
+    try:
+        consumir(args, cuerpos[:args.calentamiento], canal, 0)
+        metricas.etapas.limpiar()
+        metricas.inferencia.limpiar()
+        canal.latencias.clear()
+        acks, nacks = canal.acks, canal.nacks
+        avisos_iniciales = APIFalsa.avisos
+
+        inicio = time.perf_counter()
+        consumir(args, cuerpos[args.calentamiento:], canal, args.calentamiento)
+        duracion = time.perf_counter() - inicio
+
+        # El log y los avisos se escriben en segundo plano: se espera a que terminen (sin contarlo en la duración)
+        from log_detecciones import log_en
+        log_en(os.path.join(main.path_csv, 'detecciones')).cerrar()
+        limite = time.monotonic() + 30
+        while outbox_api().pendientes() and time.monotonic() < limite:
+            time.sleep(0.05)
+    finally:
+        sys.stdout.close()
+        sys.stdout = salida_original
+
+    procesados = args.sinteticas
+    return {
+        **commit_actual(),
+        'fecha': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'configuracion': {
+            'modo': args.modo,
+            'lote': args.lote,
+            'prefetch': args.prefetch,
+            'mensajes': procesados,
+            'calentamiento': args.calentamiento,
+            'imagenes': args.imagenes or f"sinteticas {args.resolucion}",
+            'modelos': modelos,
+            'bd': 'mongo' if args.mongo else f"memoria ({args.latencia_mongo_ms} ms)",
+            'latencia_api_ms': args.latencia_api_ms,
+            'semilla': args.semilla,
+        },
+        'sistema': {
+            'python': platform.python_version(),
+            'plataforma': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'duracion_s': round(duracion, 3),
+        'imagenes_por_segundo': round(procesados / duracion, 2),
+        'confirmados': canal.acks - acks,
+        'rechazados': canal.nacks - nacks,
+        'avisos_api': APIFalsa.avisos - avisos_iniciales,
+        'latencia_mensaje_ms': percentiles(canal.latencias),
+        'etapas_ms': {etapa: percentiles(m) for etapa, m in sorted(metricas.etapas.muestras.items()) if m},
+        'inferencia_ms': {modelo: percentiles(m) for modelo, m in sorted(metricas.inferencia.muestras.items()) if m},
+        'memoria_maxima_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+def comparar(actual: dict, anterior: dict):
+    print(f"\nComparación con {anterior.get('commit') or '?'} ({anterior.get('fecha')}):")
+    if anterior.get('configuracion') != actual['configuracion']:
+        print("Atención: las corridas tienen distinta configuración, los números no son comparables directamente.")
+    print(f"{'':<34}{'anterior':>12}{'actual':>12}{'cambio':>12}")
+
+    def fila(nombre, a, b):
+        if a is None or b is None:
+            return
+        cambio = f"{(b - a) / a:+.1%}" if a else '-'
+        print(f"{nombre:<34}{a:>12.2f}{b:>12.2f}{cambio:>12}")
+
+    fila('imágenes/s', anterior.get('imagenes_por_segundo'), actual['imagenes_por_segundo'])
+    fila('mensaje p50 ms', anterior.get('latencia_mensaje_ms', {}).get('p50'), actual['latencia_mensaje_ms']['p50'])
+    fila('mensaje p99 ms', anterior.get('latencia_mensaje_ms', {}).get('p99'), actual['latencia_mensaje_ms']['p99'])
+    for grupo in ('etapas_ms', 'inferencia_ms'):
+        for nombre, valores in actual[grupo].items():
+            fila(f"{nombre} p50 ms", anterior.get(grupo, {}).get(nombre, {}).get('p50'), valores['p50'])
+    fila('memoria máxima MB', anterior.get('memoria_maxima_mb'), actual['memoria_maxima_mb'])
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    args = _argumentos()
+    # La corrida se hace dentro de una carpeta temporal: las rutas se resuelven antes
+    for nombre in ('imagenes', 'pesos_auto', 'pesos_peaton', 'salida', 'comparar'):
+        if getattr(args, nombre):
+            setattr(args, nombre, os.path.abspath(getattr(args, nombre)))
+    resultado = correr(args)
+    print(json.dumps(resultado, indent=2, ensure_ascii=False))
+    if args.salida:
+        with open(args.salida, 'w') as f:
+            json.dump(resultado, f, indent=2, ensure_ascii=False)
+    if args.comparar:
+        with open(args.comparar) as f:
+            comparar(resultado, json.load(f))
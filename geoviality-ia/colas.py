@@ -0,0 +1,50 @@
+import os
+
+# La API publica cada imagen en el exchange 'images' (topic) con su ruta como routing key
+# ('auto' o 'peaton', ver 'ruta_de'), y cada ruta tiene su cola durable 'images.<ruta>'.
+# Los videos van por la ruta 'video' (ver 'video.py').
+EXCHANGE = 'images'
+RUTAS_IMAGENES = ('auto', 'peaton')
+RUTA_VIDEOS = 'video'
+RUTAS = RUTAS_IMAGENES + (RUTA_VIDEOS,)
+
+# Rutas que atiende este worker, separadas por coma: por ejemplo 'auto', 'peaton', 'auto,video' o 'auto,peaton'.
+# Un worker con una sola ruta carga un solo modelo, y cada grupo de workers se escala por separado.
+rutas = [r.strip().lower() for r in os.getenv('IA_RUTAS', ','.join(RUTAS_IMAGENES)).split(',') if r.strip()]
+for _ruta in rutas:
+    if _ruta not in RUTAS:
+        raise ValueError(f"Ruta desconocida en IA_RUTAS: '{_ruta}' (válidas: {', '.join(RUTAS)})")
+
+def ruta_de(modo: str) -> str:
+    """
+    Ruta (y modelo) que corresponde al 'modo' de una imagen: 'auto' usa el de vehiculo, el resto el de peaton.
+    """
+    return 'auto' if modo == 'auto' else 'peaton'
+
+def cola(ruta: str) -> str:
+    return f'{EXCHANGE}.{ruta}'
+
+def declarar(channel):
+    """
+    Declara el exchange y las colas de todas las rutas con sus bindings (la API hace lo mismo al publicar).
+
+    Se declaran todas, no solo las de este worker, para que las imágenes de una ruta sin workers
+    esperen en su cola en vez de perderse.
+    """
+    channel.exchange_declare(exchange=EXCHANGE, exchange_type='topic', durable=True)
+    for ruta in RUTAS:
+        channel.queue_declare(queue=cola(ruta), durable=True)
+        channel.queue_bind(queue=cola(ruta), exchange=EXCHANGE, routing_key=ruta)
+
+def suscribir(channel, on_message_callback, prefetch: int):
+    """
+    Declara las colas y consume las de las rutas de imágenes de este worker ('IA_RUTAS') con 'on_message_callback'.
+
+    El prefetch es del canal ('global_qos'), así que acota los mensajes en vuelo entre todas las rutas.
+    """
+    declarar(channel)
+    channel.basic_qos(prefetch_count=prefetch, global_qos=True)
+    for ruta in rutas:
+        if ruta in RUTAS_IMAGENES:
+            channel.basic_consume(queue=cola(ruta), on_message_callback=on_message_callback)
+    print(f"    - [IA] Suscrito a las rutas: {', '.join(rutas)}.")
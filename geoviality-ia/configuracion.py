@@ -0,0 +1,11 @@
+import os
+
+# Configuración de los modelos que comparten el worker ('main.py') y las herramientas offline ('reprocesar.py').
+# Importar este módulo no carga nada ni se conecta a nada.
+
+modelo_IA_auto = os.getcwd() + '/Modelo 2 (Fuerte en Seco)/Vista_Vehiculo_V3.pt'
+modelo_IA_peaton = os.getcwd() + '/Modelo 2 (Fuerte en Seco)/Vista_Peaton_General_V3_Refactorizado_Cris.pt'
+modelos_IA = {'auto': modelo_IA_auto, 'peaton': modelo_IA_peaton}
+confianza = 0.65
+path_post = os.getcwd() + '/imgs/post/'
+path_csv = os.getcwd() + '/imgs/' # El log de detecciones queda en 'imgs/detecciones'
@@ -0,0 +1,208 @@
+import os
+import sys
+import json
+import time
+import cv2
+import numpy as np
+from modelo_onnx import ModeloONNX, onnx_actualizado, iou_cajas
+
+EXTENSIONES = ('.jpg', '.jpeg', '.png')
+# Tolerancias de la variante INT8 respecto del modelo float (ver 'fuera_de_tolerancia')
+ACUERDO_MINIMO = 0.9
+IOU_MEDIO_MINIMO = 0.8
+DIFERENCIA_CONFIANZA_MAXIMA = 0.05
+
+def ruta_int8(ruta_pt: str) -> str:
+    """
+    Ruta de la variante INT8 que corresponde a un archivo de pesos '.pt' ('<nombre>-int8.onnx').
+    """
+    return os.path.splitext(ruta_pt)[0] + '-int8.onnx'
+
+def _imagenes(carpeta: str) -> list[str]:
+    return [os.path.join(carpeta, f) for f in sorted(os.listdir(carpeta)) if f.lower().endswith(EXTENSIONES)]
+
+class LectorCalibracion:
+    """
+    Entrega a ONNX Runtime las imágenes de 'carpeta', preprocesadas igual que en la inferencia,
+    para calibrar los rangos de las activaciones en la cuantización estática.
+    """
+
+    def __init__(self, modelo: ModeloONNX, carpeta: str, maximo: int):
+        self.modelo = modelo
+        self.imagenes = iter(_imagenes(carpeta)[:maximo])
+
+    def get_next(self):
+        for ruta in self.imagenes:
+            frame = cv2.imread(ruta)
+            if frame is not None:
+                entrada, _ = self.modelo.preprocesar([frame])
+                return {self.modelo.entrada: entrada}
+        return None
+
+def cuantizar(ruta_pt: str, tipo: str = 'dinamica', carpeta_calibracion: str | None = None, maximo_calibracion: int = 300) -> str:
+    """
+    Genera la variante INT8 del modelo ONNX de 'ruta_pt' (exportándolo antes si hace falta) y retorna su ruta.
+
+    tipo: 'dinamica' (solo los pesos, sin calibración) o 'estatica' (pesos y activaciones, calibradas
+    con hasta 'maximo_calibracion' imágenes de 'carpeta_calibracion').
+    """
+    import onnx
+    from onnxruntime.quantization import quantize_dynamic, quantize_static, QuantType, QuantFormat
+
+    ruta_float = onnx_actualizado(ruta_pt)
+    salida = ruta_int8(ruta_pt)
+    inicio = time.perf_counter()
+    if tipo == 'estatica':
+        if not carpeta_calibracion:
+            raise ValueError("La cuantización estática necesita una carpeta de imágenes de calibración")
+        lector = LectorCalibracion(ModeloONNX(ruta_float), carpeta_calibracion, maximo_calibracion)
+        quantize_static(
+            ruta_float, salida, lector,
+            quant_format=QuantFormat.QDQ,
+            per_channel=True,
+            activation_type=QuantType.QUInt8,
+            weight_type=QuantType.QInt8,
+        )
+    elif tipo == 'dinamica':
+        quantize_dynamic(ruta_float, salida, weight_type=QuantType.QUInt8)
+    else:
+        raise ValueError(f"Tipo de cuantización desconocido: '{tipo}'")
+
+    # Se copian los metadatos de ultralytics (clases, tamaño de entrada) y se deja anotado el tipo
+    original = onnx.load(ruta_float, load_external_data=False)
+    cuantizado = onnx.load(salida)
+    metadatos = {p.key: p.value for p in original.metadata_props}
+    metadatos['cuantizacion'] = tipo
+    del cuantizado.metadata_props[:]
+    for clave, valor in metadatos.items():
+        cuantizado.metadata_props.add(key=clave, value=valor)
+    onnx.save(cuantizado, salida)
+
+    print(f"    - [IA] Variante INT8 ({tipo}) de '{os.path.basename(ruta_pt)}' generada en {time.perf_counter() - inicio:.1f} s: "
+          f"{os.path.getsize(ruta_float) / 1e6:.1f} MB -> {os.path.getsize(salida) / 1e6:.1f} MB.")
+    return salida
+
+def _percentil(valores: list, p: float) -> float:
+    return float(np.percentile(valores, p)) if valores else 0.0
+
+def comparar_detecciones(por_imagen: list[dict], nombres: dict, iou_minimo: float = 0.5) -> dict:
+    """
+    Compara las detecciones de ambos modelos. 'por_imagen' tiene, por imagen, {'float': [...], 'int8': [...]}
+    con tuplas (clase, confianza, caja x1 y1 x2 y2).
+
+    Toma las detecciones del modelo float como referencia: por clase cuenta las detecciones de cada
+    modelo y las que coinciden (misma clase e IoU >= 'iou_minimo', cada una de INT8 usada una vez), y
+    calcula el acuerdo como coincidencias / max(detecciones float, detecciones INT8): así bajan el acuerdo
+    tanto las detecciones que INT8 pierde como las que agrega. Retorna 'clases', y la diferencia de confianza
+    y el IoU medios de las coincidencias.
+    """
+    clases = {nombre: {'float': 0, 'int8': 0, 'coincidencias': 0} for nombre in nombres.values()}
+    diferencias_confianza = []
+    ious = []
+    for detecciones in por_imagen:
+        for nombre in ('float', 'int8'):
+            for clase, _, _ in detecciones[nombre]:
+                clases[nombres[clase]][nombre] += 1
+
+        usadas = set()
+        for clase, puntaje, caja in detecciones['float']:
+            candidatas = [
+                (iou_cajas(caja, k), j) for j, (c, _, k) in enumerate(detecciones['int8'])
+                if c == clase and j not in usadas
+            ]
+            mejor = max(candidatas, default=(0.0, None))
+            if mejor[0] >= iou_minimo:
+                usadas.add(mejor[1])
+                clases[nombres[clase]]['coincidencias'] += 1
+                diferencias_confianza.append(abs(puntaje - detecciones['int8'][mejor[1]][1]))
+                ious.append(mejor[0])
+
+    for datos in clases.values():
+        datos['acuerdo'] = round(datos['coincidencias'] / max(datos['float'], datos['int8']), 4) if max(datos['float'], datos['int8']) else None
+
+    return {
+        'clases': clases,
+        'diferencia_confianza_media': round(float(np.mean(diferencias_confianza)), 4) if diferencias_confianza else None,
+        'iou_medio': round(float(np.mean(ious)), 4) if ious else None,
+    }
+
+def fuera_de_tolerancia(resultado: dict, acuerdo_minimo: float = ACUERDO_MINIMO, iou_medio_minimo: float = IOU_MEDIO_MINIMO,
+                        diferencia_confianza_maxima: float = DIFERENCIA_CONFIANZA_MAXIMA) -> list[str]:
+    """
+    Retorna los problemas de un informe ('comparar_detecciones' o 'informe'): clases con acuerdo bajo
+    'acuerdo_minimo', IoU medio bajo 'iou_medio_minimo' o diferencia de confianza media sobre
+    'diferencia_confianza_maxima'. Una lista vacía significa que la variante INT8 está dentro de tolerancia.
+    """
+    problemas = [
+        f"clase '{nombre}': acuerdo {datos['acuerdo']:.1%} < {acuerdo_minimo:.1%}"
+        for nombre, datos in resultado['clases'].items()
+        if datos['acuerdo'] is not None and datos['acuerdo'] < acuerdo_minimo
+    ]
+    if resultado['iou_medio'] is not None and resultado['iou_medio'] < iou_medio_minimo:
+        problemas.append(f"IoU medio {resultado['iou_medio']:.3f} < {iou_medio_minimo}")
+    if resultado['diferencia_confianza_media'] is not None and resultado['diferencia_confianza_media'] > diferencia_confianza_maxima:
+        problemas.append(f"diferencia de confianza media {resultado['diferencia_confianza_media']:.3f} > {diferencia_confianza_maxima}")
+    return problemas
+
+def informe(ruta_pt: str, carpeta: str, confianza: float = 0.25, iou_minimo: float = 0.5) -> dict:
+    """
+    Compara la variante INT8 de 'ruta_pt' con el modelo ONNX float sobre las imágenes de 'carpeta'
+    (ver 'comparar_detecciones') y mide la latencia por imagen (p50 y p99) de ambos.
+    """
+    float_ = ModeloONNX(onnx_actualizado(ruta_pt))
+    int8 = ModeloONNX(ruta_int8(ruta_pt))
+    latencias = {'float': [], 'int8': []}
+    por_imagen = []
+
+    for ruta in _imagenes(carpeta):
+        frame = cv2.imread(ruta)
+        if frame is None:
+            continue
+        detecciones = {}
+        for nombre, modelo in (('float', float_), ('int8', int8)):
+            inicio = time.perf_counter()
+            resultado = modelo.predict([frame], conf=confianza)[0]
+            latencias[nombre].append((time.perf_counter() - inicio) * 1000)
+            detecciones[nombre] = [(int(d.cls.item()), float(d.conf.item()), d.xyxy[0]) for d in resultado.boxes]
+        por_imagen.append(detecciones)
+
+    comparacion = comparar_detecciones(por_imagen, float_.names, iou_minimo)
+    clases = comparacion['clases']
+    resultado = {
+        'modelo': os.path.basename(ruta_pt),
+        'imagenes': len(latencias['float']),
+        'confianza': confianza,
+        'iou_minimo': iou_minimo,
+        **comparacion,
+        'latencia_ms': {
+            nombre: {'p50': round(_percentil(valores, 50), 2), 'p99': round(_percentil(valores, 99), 2)}
+            for nombre, valores in latencias.items()
+        },
+    }
+
+    print(f"Modelo '{resultado['modelo']}', {resultado['imagenes']} imágenes")
+    print(f"{'clase':<22}{'float':>8}{'int8':>8}{'coinc.':>8}{'acuerdo':>9}")
+    for nombre, datos in clases.items():
+        acuerdo = f"{datos['acuerdo']:.1%}" if datos['acuerdo'] is not None else '-'
+        print(f"{nombre:<22}{datos['float']:>8}{datos['int8']:>8}{datos['coincidencias']:>8}{acuerdo:>9}")
+    for nombre, valores in resultado['latencia_ms'].items():
+        print(f"Latencia {nombre}: p50 {valores['p50']:.1f} ms, p99 {valores['p99']:.1f} ms")
+    resultado['problemas'] = fuera_de_tolerancia(resultado)
+    for problema in resultado['problemas']:
+        print(f"Fuera de tolerancia: {problema}")
+    return resultado
+
+if __name__ == '__main__':
+    # python cuantizacion.py cuantizar <pesos.pt> [dinamica|estatica] [carpeta de calibración]
+    # python cuantizacion.py informe <pesos.pt> <carpeta de imágenes> [salida.json]
+    if len(sys.argv) >= 3 and sys.argv[1] == 'cuantizar':
+        print(cuantizar(sys.argv[2], *sys.argv[3:5]))
+    elif len(sys.argv) >= 4 and sys.argv[1] == 'informe':
+        datos = informe(sys.argv[2], sys.argv[3])
+        if len(sys.argv) >= 5:
+            with open(sys.argv[4], 'w') as f:
+                json.dump(datos, f, indent=2, ensure_ascii=False)
+        sys.exit(1 if datos['problemas'] else 0)
+    else:
+        print("Uso: python cuantizacion.py cuantizar <pesos.pt> [dinamica|estatica] [carpeta] | informe <pesos.pt> <carpeta> [salida.json]")
+        sys.exit(2)
@@ -0,0 +1,147 @@
+import os
+import time
+import threading
+from concurrent.futures import Future
+from pymongo import InsertOne
+from pymongo.errors import BulkWriteError, PyMongoError
+from database import db
+import metricas
+
+# Se escribe a la BD cuando pasan 'IA_MONGO_FLUSH_MS' milisegundos o se juntan 'IA_MONGO_FLUSH_OPERACIONES' operaciones
+flush_ms = float(os.getenv('IA_MONGO_FLUSH_MS', 100))
+flush_operaciones = int(os.getenv('IA_MONGO_FLUSH_OPERACIONES', 500))
+
+CLAVE_DUPLICADA = 11000
+
+class ErrorEscritura(PyMongoError):
+    """
+    Error con que se completa el Future de una imagen cuando alguna de sus operaciones falló.
+
+    'colecciones' son las colecciones donde fallaron sus operaciones (en las demás quedaron escritas).
+    """
+
+    def __init__(self, error: Exception, colecciones: set[str]):
+        super().__init__(str(error))
+        self.error = error
+        self.colecciones = colecciones
+
+class EscrituraPorLotes:
+    """
+    Acumula las escrituras a MongoDB de varias imágenes y las manda juntas con 'bulk_write' no ordenado,
+    un lote por colección.
+
+    'encolar' recibe las operaciones de una imagen ((colección, operación) de pymongo) y retorna un
+    Future que se completa cuando todas ellas quedaron escritas, o con la excepción si alguna falló.
+    El mensaje de la imagen se confirma en RabbitMQ recién ahí, así que si el worker se cae antes
+    el mensaje se vuelve a entregar.
+
+    Dentro de un mismo lote los 'InsertOne' de una colección se escriben antes que el resto de sus
+    operaciones, para que una imagen pueda agregarse a un punto que se creó en el mismo lote.
+    Un 'InsertOne' con clave duplicada (imagen reentregada) se toma como escrito.
+
+    Un 'UpdateOne' sin upsert que no encuentra su documento no es un error para MongoDB; por eso 'encolar'
+    recibe además los documentos ((colección, _id)) que deben existir después de escribir, y si alguno
+    falta el Future de la imagen se completa con error.
+    """
+
+    def __init__(self):
+        self._pendientes = [] # (operaciones, existentes, future)
+        self._cantidad = 0
+        self._cond = threading.Condition()
+        self._vaciar = False
+        self._hilo = threading.Thread(target=self._ciclo, name='escritura-mongo', daemon=True)
+        self._hilo.start()
+
+    def encolar(self, operaciones: list[tuple], existentes: list[tuple] = ()) -> Future:
+        futuro = Future()
+        if not operaciones:
+            futuro.set_result(None)
+            return futuro
+        with self._cond:
+            self._pendientes.append((operaciones, list(existentes), futuro))
+            self._cantidad += len(operaciones)
+            if self._cantidad >= flush_operaciones:
+                self._cond.notify()
+        return futuro
+
+    def vaciar(self):
+        """
+        Pide escribir lo pendiente sin esperar al intervalo (para quien va a esperar los resultados enseguida).
+        """
+        with self._cond:
+            self._vaciar = True
+            self._cond.notify()
+
+    def _ciclo(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._vaciar or self._cantidad >= flush_operaciones, timeout=flush_ms / 1000)
+                pendientes, self._pendientes = self._pendientes, []
+                self._cantidad = 0
+                self._vaciar = False
+            if pendientes:
+                self._escribir(pendientes)
+
+    def _escribir(self, pendientes: list):
+        inicio = time.perf_counter()
+        errores = {} # índice en 'pendientes' -> excepción
+        fallidas = {} # índice en 'pendientes' -> colecciones donde falló
+        por_coleccion = {}
+        for i, (operaciones, _, _) in enumerate(pendientes):
+            for coleccion, operacion in operaciones:
+                por_coleccion.setdefault(coleccion, ([], []))[0 if isinstance(operacion, InsertOne) else 1].append((i, operacion))
+
+        total = 0
+        for coleccion, grupos in por_coleccion.items():
+            for grupo in grupos:
+                # Las operaciones de imágenes que ya fallaron no se escriben
+                grupo = [(i, op) for i, op in grupo if i not in errores]
+                if not grupo:
+                    continue
+                total += len(grupo)
+                try:
+                    db[coleccion].bulk_write([op for _, op in grupo], ordered=False)
+                except BulkWriteError as e:
+                    for error in e.details.get('writeErrors', []):
+                        if error.get('code') != CLAVE_DUPLICADA:
+                            i = grupo[error['index']][0]
+                            errores.setdefault(i, PyMongoError(error.get('errmsg')))
+                            fallidas.setdefault(i, set()).add(coleccion)
+                except Exception as e:
+                    for i, _ in grupo:
+                        errores.setdefault(i, e)
+                        fallidas.setdefault(i, set()).add(coleccion)
+
+        self._revisar_existentes(pendientes, errores, fallidas)
+        metricas.etapas.labels('escritura_mongo').observe(time.perf_counter() - inicio)
+        for i, (_, _, futuro) in enumerate(pendientes):
+            if i in errores:
+                futuro.set_exception(ErrorEscritura(errores[i], fallidas[i]))
+            else:
+                futuro.set_result(None)
+        print(f"    - [IA] Lote de {total} escrituras de {len(pendientes)} imágenes en {len(por_coleccion)} colecciones "
+              f"({len(errores)} con error) en {(time.perf_counter() - inicio) * 1000:.0f} ms.")
+
+    def _revisar_existentes(self, pendientes: list, errores: dict, fallidas: dict):
+        """
+        Marca con error las imágenes cuyos documentos 'existentes' no están en la BD (una consulta por colección).
+        """
+        por_coleccion = {}
+        for i, (_, existentes, _) in enumerate(pendientes):
+            if i in errores:
+                continue
+            for coleccion, id in existentes:
+                por_coleccion.setdefault(coleccion, {}).setdefault(id, []).append(i)
+        for coleccion, ids in por_coleccion.items():
+            try:
+                encontrados = {d['_id'] for d in db[coleccion].find({'_id': {'$in': list(ids)}}, {'_id': 1})}
+            except Exception as e:
+                faltan = {id: e for id in ids}
+            else:
+                faltan = {id: PyMongoError(f"El documento '{id}' no existe en '{coleccion}'") for id in ids if id not in encontrados}
+            for id, error in faltan.items():
+                for i in ids[id]:
+                    errores.setdefault(i, error)
+                    fallidas.setdefault(i, set()).add(coleccion)
+
+escritura = EscrituraPorLotes()
@@ -2,8 +2,18 @@ import requests
 from dotenv import load_dotenv
 from database import db
 import os
-from models import PhotoInfo, PhotoDB, PhotoSend, GeoJson, Geometry
+from models import PhotoInfo, PhotoDB, PhotoReady, GeoJson, Geometry, DeteccionesImagen
+from almacenamiento import almacenamiento
+import indice_irregularidades
+import indice_calles
+import metricas
+import idempotencia
+from escritura_mongo import escritura
+from outbox import Outbox, outbox_en, ruta_outbox
+from pymongo import InsertOne, UpdateOne
+from concurrent.futures import Future
 from datetime import datetime
+import re
 import time
 import uuid
 
@@ -14,53 +24,138 @@ port = os.getenv('PORT', 8080)
 
 url = f'http://{host}:{port}'
 
-def save_data_to_mongodb(photo_info: PhotoInfo):
+# Los puntos nuevos toman un id derivado del id de la imagen que los crea: si el mensaje se procesa
+# dos veces (reentrega), el segundo 'InsertOne' choca con el primero en vez de crear otro punto
+ESPACIO_PUNTOS = uuid.UUID('5b8f3c2e-6a1d-4f0b-9c47-2d1e8a7b6c30')
+
+def id_punto(id_imagen: str) -> str:
+    return str(uuid.uuid5(ESPACIO_PUNTOS, id_imagen))
+
+# Formato de los ids de imagen que genera la API: un UUID, o '<uuid>-<frame>' para los frames de un video
+FORMATO_ID_IMAGEN = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}(-[0-9]{6})?")
+
+def save_data_to_mongodb(photo_info: PhotoInfo, _id: str | None = None) -> Future:
     """
     Guarda los datos de la imagen 'image_filename' como 'latitude',
     'longitude', 'date' y 'type' en la BD 'processed_images'
-    
+
+    Si se entrega '_id', el punto se guarda con ese id (el que se reservó en el índice de irregularidades).
+
+    La escritura (junto con la de la calle) se encola en el próximo lote; retorna el Future del lote.
     """
-    collection = db['processed_geojson']
-    
     data = PhotoDB(**photo_info.model_dump(), repair_at=None, estado=0, observaciones="Sin Observaciones")
-    irregularidad = geoJson(data)
-    
-    try:
-        result = collection.insert_one(irregularidad)
-    except Exception as e:
-        print(f"    - [IA] Datos duplicados de la imagen '{photo_info.id}' en la BD, error:", e)
-
+    irregularidad = geoJson(data, _id)
     geojson = GeoJson(**irregularidad)
-    
-    procesar_irregularidad(geojson)
-    
-    print(f"    - [IA] Imagen '{photo_info.id}' guardada en 'processed_geojson' con el ID: {result.inserted_id}.")
 
-def actualizar_foto(foto: GeoJson, id_imagen: str):
+    operaciones = [('processed_geojson', InsertOne(irregularidad))] + procesar_irregularidad(geojson)
+    indice_irregularidades.indice.agregar(irregularidad["_id"], photo_info.longitude, photo_info.latitude, reserva=True)
+
+    def terminado(futuro: Future):
+        error = futuro.exception()
+        if error:
+            # Si solo falló la calle, el punto quedó en la BD y sigue en el índice (al reentregarse el
+            # mensaje 'procesar' lo encuentra y vuelve a intentar la calle)
+            if 'processed_geojson' in getattr(error, 'colecciones', {'processed_geojson'}):
+                indice_irregularidades.indice.quitar(irregularidad["_id"])
+            print(f"    - [IA] Error al guardar la imagen '{photo_info.id}' en 'processed_geojson':", error)
+        else:
+            print(f"    - [IA] Imagen '{photo_info.id}' guardada en 'processed_geojson' con el ID: {irregularidad['_id']}.")
+
+    futuro = escritura.encolar(operaciones)
+    futuro.add_done_callback(terminado)
+    return futuro
+
+def actualizar_foto(foto: GeoJson, id_imagen: str) -> Future:
     """
     Actualiza la foto en la BD 'processed_images' agregando el id de la imagen a la lista de imagenes.
     """
-    
-    try:
-        db.processed_geojson.update_one(
-            {"_id": foto.properties.id},
-            {
-                "$addToSet": {"properties.images": id_imagen},
-                "$set": {"properties.last_update": datetime.now()}
-            }
-        )
-        print(f"    - [IA] Foto '{foto.properties.id}' actualizada con la imagen '{id_imagen}'.")
-    except Exception as e:
-        print(f"    - [IA] Error al actualizar la foto '{foto.properties.id}': {e}")
+    return actualizar_foto_por_id(foto.properties.id, id_imagen)
+
+def actualizar_foto_por_id(id_foto: str, id_imagen: str, detecciones: DeteccionesImagen | None = None) -> Future:
+    """
+    Igual que 'actualizar_foto', pero solo con el id del punto. Si se entregan, guarda también
+    las detecciones de la imagen en 'properties.detecciones.<id_imagen>'.
+
+    La escritura se encola en el próximo lote; retorna el Future del lote.
+    """
+    # El id va dentro de una ruta de campo: un '.' o un '$' escribirían en otro campo
+    if FORMATO_ID_IMAGEN.fullmatch(id_imagen) is None:
+        raise ValueError(f"Id de imagen inválido: '{id_imagen}'")
+    cambios = {"properties.last_update": datetime.now()}
+    if detecciones is not None:
+        cambios[f"properties.detecciones.{id_imagen}"] = detecciones.model_dump()
+    operacion = UpdateOne(
+        {"_id": id_foto},
+        {
+            "$addToSet": {"properties.images": id_imagen},
+            "$set": cambios
+        }
+    )
+
+    def terminado(futuro: Future):
+        if futuro.exception():
+            print(f"    - [IA] Error al actualizar la foto '{id_foto}': {futuro.exception()}")
+        else:
+            print(f"    - [IA] Foto '{id_foto}' actualizada con la imagen '{id_imagen}'.")
+
+    # Si el punto ya no existe (borrado o reagrupado entre la búsqueda y la escritura) la imagen no
+    # quedaría en ninguna parte: el lote lo reporta como error y el mensaje se devuelve a la cola
+    futuro = escritura.encolar([('processed_geojson', operacion)], existentes=[('processed_geojson', id_foto)])
+    futuro.add_done_callback(terminado)
+    return futuro
+
+def id_irregularidad_cercana(info: PhotoInfo, id_nuevo: str, max_distance=10) -> str | None:
+    """
+    Retorna el id de la irregularidad más cercana a la imagen (a menos de 'max_distance' metros), o None.
+
+    Usa el índice en memoria si está cargado (y si no hay ninguna cerca, deja reservado 'id_nuevo' en él);
+    si no, consulta a MongoDB con '$near'.
+    """
+    with metricas.medir('irregularidad_cercana'):
+        if indice_irregularidades.indice.listo:
+            return indice_irregularidades.indice.cercano_o_agregar(id_nuevo, info.longitude, info.latitude, max_distance)
+        irregularidad = irregularidad_cercana(Geometry(coordinates=[info.longitude, info.latitude]), max_distance)
+        return irregularidad.properties.id if irregularidad else None
 
-def procesar(info: PhotoInfo):
-    irregularidad = irregularidad_cercana(Geometry(coordinates=[info.longitude, info.latitude]))
-    if irregularidad:
+def procesar(info: PhotoInfo) -> Future:
+    """
+    Agrega la imagen a la irregularidad cercana o crea una nueva.
+
+    Retorna el Future del lote de escrituras: la imagen está guardada en la BD cuando se completa.
+    """
+    id_nuevo = id_punto(info.id)
+    id_cercana = id_irregularidad_cercana(info, id_nuevo)
+    if id_cercana == id_nuevo:
+        # El punto lo creó un intento anterior de esta misma imagen: se repiten sus escrituras (el
+        # 'InsertOne' duplicado se toma como escrito y la calle no suma dos veces la misma irregularidad)
+        return save_data_to_mongodb(info, id_nuevo)
+    if id_cercana:
         print(f"    - [IA] Irregularidad cercana a la imagen '{info.id}' encontrada.")
-        actualizar_foto(irregularidad, info.id)
+        return actualizar_foto_por_id(id_cercana, info.id, info.detecciones)
     else:
         print(f"    - [IA] No se encontró una irregularidad cercana a la imagen '{info.id}'.")
-        save_data_to_mongodb(info)
+        try:
+            return save_data_to_mongodb(info, id_nuevo)
+        except Exception:
+            # 'id_nuevo' quedó reservado en el índice pero su escritura nunca se encoló: si no se quita,
+            # las imágenes cercanas se agregarían a un punto que no existe
+            indice_irregularidades.indice.quitar(id_nuevo)
+            raise
+
+def esperar_escrituras(futuros: list) -> list:
+    """
+    Pide escribir el lote pendiente y espera los Futures entregados (None se ignora).
+
+    En 'IA_MODO_CONSUMO=simple' se llama por cada imagen, así que cada lote tiene las escrituras de una
+    sola imagen; para juntar varias en un lote hay que usar los modos 'lotes' o 'pipeline'.
+
+    Retorna, en el mismo orden, None para cada escritura exitosa o la excepción con que falló.
+    """
+    escritura.vaciar()
+    errores = []
+    for futuro in futuros:
+        errores.append(futuro.exception() if futuro is not None else None)
+    return errores
 
 def irregularidad_cercana(punto: Geometry, max_distance=10) -> GeoJson | None :
     """
@@ -97,13 +192,14 @@ def delete_image(image_filename: str):
 
 def create_directories():
     """
-    Crea las carpetas 'imgs', 'imgs/pre' y 'imgs/post' en el directorio actual si no existen
-    
-    Tambien crea el archivo 'dataset.csv' en la carpeta 'imgs' si no existe
+    Crea las carpetas 'imgs', 'imgs/pre', 'imgs/post' y 'imgs/detecciones' en el directorio actual si no existen
+
+    El log de detecciones se escribe en 'imgs/detecciones' en archivos nuevos por cada inicio, asi que no se borra nada.
     """
     base_dir = os.path.join(os.getcwd(), "imgs")
     pre_pro_dir = os.path.join(base_dir, "pre")
     post_pro_dir = os.path.join(base_dir, "post")
+    detecciones_dir = os.path.join(base_dir, "detecciones")
     
     if not os.path.exists(base_dir):
         os.makedirs(base_dir)
@@ -114,37 +210,59 @@ def create_directories():
     if not os.path.exists(post_pro_dir):
         os.makedirs(post_pro_dir)
 
-    csv_filename = 'dataset.csv'
-    csv_filepath = os.path.join(base_dir, csv_filename)
-    with open(csv_filepath, 'w') as csv_file:
-        pass
+    if not os.path.exists(detecciones_dir):
+        os.makedirs(detecciones_dir)
 
-def send_to_API(data: PhotoSend):
+def outbox_api() -> Outbox:
     """
-    Envia los datos de la imagen 'image' y 'image_filename' a la api
+    Retorna el outbox de avisos a la API del proceso.
     """
-    retries = 0
-    max_retries = 3
-    while retries < max_retries:
-        try:
-            request_url = f'{url}/data/processed_image'
-            response = requests.post(request_url, json=data.model_dump())
-            response.raise_for_status()
-            print(f"    - [IA] Imagen '{data.id}' enviada a la API.")
-            break
-        except requests.exceptions.RequestException as e:
-            print(f"    - [IA] Error al enviar la imagen '{data.id}' a la API: {e}")
-            print(f"    - [IA] Reintentando en 5 segundos...")
-            time.sleep(5)
-            retries += 1
-    if retries == max_retries:
-        print(f"    - [IA] No se pudo enviar la imagen '{data.id}' a la API.")
-
-def geoJson(data: PhotoDB) -> dict:
+    return outbox_en(ruta_outbox, url)
+
+def send_to_API(data: PhotoReady):
+    """
+    Avisa a la API que la imagen 'id' ya está en el almacenamiento bajo la clave 'key'.
+
+    La imagen no viaja en la petición: la IA la escribe directo en el almacenamiento compartido.
+    El aviso queda guardado en el outbox y lo manda su hilo de envío (ver 'outbox.Outbox').
+    """
+    with metricas.medir('send_to_api'):
+        outbox_api().encolar('/data/processed_image/ready', data.model_dump())
+    print(f"    - [IA] Aviso de la imagen '{data.id}' guardado para la API.")
+
+def finalizar_imagen(data: dict, image: bytes, result, path: str | None = None):
+    """
+    Cierra el procesamiento de una imagen: si no tuvo detecciones se borra; si tuvo se guarda
+    en el almacenamiento de imágenes y se avisa a la API.
+
+    Si la imagen se guardó en 'pre' ('path'), se elimina de ahí.
+    Si ya se había finalizado en un intento anterior del mismo mensaje, no se repite.
+    """
+    image_filename = data['id'] + '.jpg'
+    if idempotencia.completada(data['id'], 'notificacion'):
+        print(f"    - [IA] Imagen '{image_filename}' ya estaba finalizada.")
+    else:
+        if result:
+            print(f"    - [IA] Imagen '{image_filename}' sin detecciones, no se guarda.")
+        else:
+            almacenamiento.guardar(image_filename, image)
+            print(f"    - [IA] Imagen '{image_filename}' guardada en el almacenamiento.")
+            send_to_API(PhotoReady(id=data['id'], key=image_filename))
+        idempotencia.marcar(data['id'], 'notificacion')
+    if path is not None:
+        os.remove(path)
+        print(f"    - [IA] Imagen '{image_filename}' procesada y eliminada de 'pre'.")
+    else:
+        print(f"    - [IA] Imagen '{image_filename}' procesada.")
+
+def geoJson(data: PhotoDB, _id: str | None = None) -> dict:
     properties = {}
     item = data.model_dump()
-    item["_id"] = str(uuid.uuid4())
+    item["_id"] = _id or str(uuid.uuid4())
     item["images"] = [item["id"]]
+    # Las detecciones quedan por imagen, así las de otras imágenes del punto se agregan al lado
+    detecciones = item.pop("detecciones", None)
+    item["detecciones"] = {item["id"]: detecciones} if detecciones else {}
     item["id"] = item["_id"]
     for key in item:
         if key!="longitude" and key!="latitude" and key!="_id":
@@ -163,25 +281,33 @@ def geoJson(data: PhotoDB) -> dict:
 
 def encontrar_calle_mas_cercana(punto : Geometry , max_distance = 30) -> dict:
     """
-    Encuentra la calle más cercana a un punto dado usando una consulta geoespacial.
+    Encuentra la calle más cercana a un punto dado.
+
+    Usa el índice de calles en memoria si está cargado; si no, una consulta geoespacial a la BD.
     """
-    return db.streets.find_one({
-        "geometry": {
-            "$near": {
-                "$geometry": punto.model_dump(),
-                "$maxDistance": max_distance
+    with metricas.medir('calle_cercana'):
+        if indice_calles.listo():
+            lon, lat = punto.coordinates[:2]
+            return indice_calles.calle_mas_cercana(lon, lat, max_distance)
+        return db.streets.find_one({
+            "geometry": {
+                "$near": {
+                    "$geometry": punto.model_dump(),
+                    "$maxDistance": max_distance
+                }
             }
-        }
-    })
+        })
 
-def actualizar_calle_con_irregularidades(calle_id: str, id_imagen: str ,tipos_irregularidades : list[str]):
+def actualizar_calle_con_irregularidades(calle_id: str, id_imagen: str ,tipos_irregularidades : list[str]) -> UpdateOne:
     """
-    Actualiza la calle incrementando cada tipo de irregularidad proporcionado.
+    Retorna la operación que actualiza la calle incrementando cada tipo de irregularidad proporcionado.
+
+    Solo aplica si la irregularidad no estaba ya en la calle, así reescribirla no vuelve a sumar los contadores.
     """
     incrementos = {f"properties.{tipo}": 1 for tipo in tipos_irregularidades}
 
-    db.streets.update_one(
-        {"id": calle_id},
+    return UpdateOne(
+        {"id": calle_id, "properties.images": {"$ne": id_imagen}},
         {
             "$inc": incrementos,
             "$addToSet": {"properties.images": id_imagen},
@@ -189,9 +315,10 @@ def actualizar_calle_con_irregularidades(calle_id: str, id_imagen: str ,tipos_ir
         }
     )
 
-def procesar_irregularidad(irregularidad: GeoJson):
+def procesar_irregularidad(irregularidad: GeoJson) -> list[tuple]:
     """
-    Procesa una nueva irregularidad: encuentra la calle más cercana y actualiza sus propiedades.
+    Procesa una nueva irregularidad: encuentra la calle más cercana y retorna las operaciones
+    ((colección, operación)) que actualizan sus propiedades.
     """
     punto = irregularidad.geometry
     tipos_irregularidades = [tipo.capitalize() for tipo in irregularidad.properties.type]
@@ -200,10 +327,11 @@ def procesar_irregularidad(irregularidad: GeoJson):
 
     if calle:
         calle_id = calle["id"]
-        actualizar_calle_con_irregularidades(calle_id,irregularidad.properties.id ,tipos_irregularidades)
         print(f"    - [IA] Irregularidad procesada en la calle '{calle_id}'.")
+        return [('streets', actualizar_calle_con_irregularidades(calle_id,irregularidad.properties.id ,tipos_irregularidades))]
     else:
         print(f"    - [IA] No se encontró una calle cercana a la irregularidad.")
+        return []
 
 """ Cementerio:
 
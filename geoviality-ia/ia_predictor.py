@@ -1,103 +1,268 @@
-from ultralytics import YOLO
-import torch
 import cv2
 import os
-import csv
-from funcs import save_data_to_mongodb, procesar
+import time
+from datetime import datetime
+from funcs import save_data_to_mongodb, procesar, esperar_escrituras
 from models import PhotoDB
 from bson.objectid import ObjectId
 from models import PhotoInfo
+import registro_modelos
+import metricas
+import idempotencia
+from concurrent.futures import Future
+from imagenes import decodificar_imagen
+from log_detecciones import log_en
 
-def ia_imagenes(car_model, walk_model, input_source, output_directory, dataset_directory, confianza, diccionario):
+def clases_modelo(model) -> list[str]:
     """
-    car_model: Modelo de IA para vehiculos.
-    walk_model: Modelo de IA para peatones.
-    input_source: Ruta de la imagen a procesar
-    output_directory: Ruta de la imagen procesada
+    Retorna los nombres de las clases del modelo, o la lista por defecto si el modelo no los trae.
+    """
+    try:
+        return model.names
+    except AttributeError:
+        return ['hoyo', 'hoyo con agua', 'cocodrilo', 'cocodrilo con agua', 'lomo de toro', 'grieta', 'longitudinal']
+
+def detectar_lote(frames: list, modo: str, confianza):
+    """
+    Corre una sola llamada a 'predict' del modelo de 'modo' sobre todos los 'frames'.
+
+    Retorna un resultado por frame, en el mismo orden.
+    """
+    model = registro_modelos.obtener_modelo(modo)
+    with registro_modelos.bloqueo(modo):
+        inicio = time.perf_counter()
+        if registro_modelos.backend(modo) != 'torch':
+            results = model.predict(frames, conf=confianza)
+        else:
+            results = model.predict(frames, conf=confianza, device=registro_modelos.dispositivo()) # Esto imprime la detección en consola
+    por_imagen = (time.perf_counter() - inicio) / max(1, len(frames))
+    for _ in frames:
+        metricas.inferencia.labels(modo).observe(por_imagen)
+    return results
+
+def extraer_detecciones(result, class_names) -> list[dict]:
+    """
+    Retorna las detecciones del resultado como una lista de {'class', 'confidence', 'x_min', 'y_min', 'x_max', 'y_max'}.
+
+    La imagen no se dibuja: las cajas quedan en la BD y la API arma la imagen anotada cuando se la piden.
+    """
+    log_data = []
+    for detection in result.boxes:
+        class_index = int(detection.cls.item())
+        class_name = class_names[class_index] if class_index < len(class_names) else 'Unknown'
+
+        x_min, y_min, x_max, y_max = detection.xyxy[0].tolist()
+        log_entry = {
+            'class': class_name,
+            'confidence': round(detection.conf.item() * 100, 2),
+            'x_min': x_min,
+            'y_min': y_min,
+            'x_max': x_max,
+            'y_max': y_max
+        }
+        log_data.append(log_entry)
+    return log_data
+
+def resumir_detecciones(log_data, confianza, version: str, tamano: tuple | None = None) -> dict | None:
+    """
+    Retorna las detecciones sobre 'confianza' como se guardan en la BD ({'modelo', 'ancho', 'alto', 'cajas'}),
+    o None si no hay ninguna.
+
+    tamano: (alto, ancho) de la imagen en que están las cajas.
+    """
+    cajas = [
+        {
+            'clase': log_entry['class'],
+            'confianza': log_entry['confidence'],
+            'caja': [round(log_entry[c], 1) for c in ('x_min', 'y_min', 'x_max', 'y_max')]
+        }
+        for log_entry in log_data if log_entry['confidence'] >= confianza
+    ]
+    if not cajas:
+        return None
+    alto, ancho = tamano or (0, 0)
+    return {'modelo': version, 'ancho': int(ancho), 'alto': int(alto), 'cajas': cajas}
+
+def registrar_detecciones(log_data, dataset_directory, confianza, diccionario, tiempos: dict | None = None, tamano: tuple | None = None) -> bool:
+    """
+    Deja las detecciones en el log de detecciones ('<dataset_directory>/detecciones') y deja en
+    diccionario['type'] las clases detectadas y en diccionario['detecciones'] sus cajas y confianzas,
+    con la versión del modelo (ver 'resumir_detecciones').
+
+    tiempos: {'t_decodificacion_ms', 't_inferencia_ms'} de la imagen, si se midieron.
+    tamano: (alto, ancho) de la imagen en que están las cajas.
+
+    Retorna True si la imagen NO tiene detecciones, False en caso contrario.
+    """
+    tiempos = tiempos or {}
+    fecha = datetime.now()
+    version = registro_modelos.version_modelo(diccionario['modo'])
+    filas = []
+
+    diccionario['type'] = [] # 'class' es una lista de las clases detectadas en la imagen.
+    for log_entry in log_data:
+        if log_entry['confidence'] >= confianza:
+            filas.append({
+                **log_entry,
+                'fecha': fecha,
+                'id': diccionario['id'],
+                'modo': diccionario['modo'],
+                'modelo': version,
+                't_decodificacion_ms': tiempos.get('t_decodificacion_ms'),
+                't_inferencia_ms': tiempos.get('t_inferencia_ms')
+            })
+            metricas.detecciones.labels(registro_modelos.modo_modelo(diccionario['modo']), log_entry['class']).inc()
+            if log_entry['class'] not in diccionario['type']:
+                diccionario['type'].append(log_entry['class'])
+    diccionario['detecciones'] = resumir_detecciones(log_data, confianza, version, tamano)
+    log_en(os.path.join(dataset_directory, 'detecciones')).agregar(filas)
+    return diccionario['type'] == []
+
+def guardar_irregularidad(diccionario):
+    """
+    Guarda en la BD la irregularidad detectada en la imagen (o la agrega a una cercana).
+
+    La escritura va en el próximo lote; retorna su Future. Si la imagen ya quedó guardada en un intento
+    anterior del mismo mensaje, retorna un Future ya completado.
+    """
+    if idempotencia.completada(diccionario['id'], 'bd'):
+        print(f"    - [IA] Imagen '{diccionario['id']}' ya estaba guardada en la BD.")
+        futuro = Future()
+        futuro.set_result(None)
+        return futuro
+
+    def terminado(f):
+        if f.exception() is None:
+            idempotencia.marcar(diccionario['id'], 'bd')
+            print(f" [IA]: imagen {diccionario['id']} guardada en BDD")
+
+    futuro = procesar(PhotoInfo(**diccionario))
+    futuro.add_done_callback(terminado)
+    return futuro
+
+def ia_imagenes(image: bytes, output_directory, dataset_directory, confianza, diccionario):
+    """
+    image: Bytes de la imagen a procesar (se decodifica en memoria)
+    output_directory: Ruta de la imagen procesada (ya no se escribe: la API dibuja las detecciones al pedirla)
     dataset_directory: Ruta del archivo CSV
     confianza: Umbral de confianza para las detecciones
 
     Retorna True si la imagen NO tiene detecciones, False en caso contrario.
     
-    Si hay detecciones, esta funcion manda a guardar los datos en la BD 'processed_images' junto con las detecciones.
+    Si hay detecciones, esta funcion manda a guardar los datos en la BD 'processed_images' junto con las detecciones
+    y espera a que queden escritos (si la escritura falla, lanza la excepción).
     
     Tanto si hay detecciones como si no, se manda a la API a mover la imagen a la carpeta 'post_pro'.
-    """
-    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
+    Los modelos se toman del registro del proceso (ver 'registro_modelos.cargar_modelos').
+    """
     # print("\nia_predictor/ia_imagenes - Diccionario", diccionario, "\n")
 
     if diccionario['modo'] == 'auto':
         print("    - Modelo de IA: Vehiculo")
-        model = YOLO(car_model)
     else:
         print("    - Modelo de IA: Peaton")
-        model = YOLO(walk_model)
+    previa = idempotencia.inferencias_previas([diccionario['id']]).get(diccionario['id'])
+    if previa is not None:
+        # Mensaje reentregado: se usa el resultado guardado en vez de volver a correr el modelo
+        print(f"    - [IA] Imagen '{diccionario['id']}' ya inferida, se retoma desde la BD.")
+        diccionario['type'] = previa['type']
+        diccionario['detecciones'] = previa['detecciones']
+        sin_detecciones = previa['resultado']
+        if sin_detecciones is None:
+            return
+    else:
+        model = registro_modelos.obtener_modelo(diccionario['modo'])
+        class_names = clases_modelo(model)
 
-    try:
-        class_names = model.names
-    except AttributeError:
-        class_names = ['hoyo', 'hoyo con agua', 'cocodrilo', 'cocodrilo con agua', 'lomo de toro', 'grieta', 'longitudinal']
+        inicio = time.perf_counter()
+        frame = decodificar_imagen(image)
+        if frame is None:
+            print(f"Error al decodificar la imagen '{diccionario['id']}'.")
+            idempotencia.guardar_inferencias([(diccionario['id'], None, [], None)])
+            return # !!!PELIGROSO!!! (No se retorna nada)
+        tiempos = {'t_decodificacion_ms': (time.perf_counter() - inicio) * 1000}
 
-    input_extension = os.path.splitext(input_source)[1].lower()
-    #is_video = input_extension in ['.mp4', '.avi', '.mov', '.mkv', '.TS', '.ts']
-    is_image = input_extension in ['.jpg', '.jpeg', '.png', '.bmp', '.tiff', '.TS', '.ts']
+        log_data = []
+        inicio = time.perf_counter()
+        results = detectar_lote([frame], diccionario['modo'], confianza)
+        tiempos['t_inferencia_ms'] = (time.perf_counter() - inicio) * 1000
 
-    log_data = []
+        for result in results:
+            log_data.extend(extraer_detecciones(result, class_names))
 
-    if is_image:
-        frame = cv2.imread(input_source)
-        try:
-            frame = cv2.imread(input_source)
-            if frame is None:
-                raise FileNotFoundError(f"Error al abrir la imagen: {input_source}")
-        except Exception as e:
-            print(f"Excepción encontrada: {e}")
-            return # !!!PELIGROSO!!! (No se retorna nada)
+        sin_detecciones = registrar_detecciones(log_data, dataset_directory, confianza, diccionario, tiempos, frame.shape[:2])
+        idempotencia.guardar_inferencias([(diccionario['id'], sin_detecciones, diccionario['type'], diccionario['detecciones'])])
+    if not sin_detecciones:
+        error, = esperar_escrituras([guardar_irregularidad(diccionario)])
+        if error:
+            raise error
+    return sin_detecciones
 
-        results = model.predict(frame, conf=confianza, device=device) # Esto imprime la detección en consola
+def inferir_lote(items: list[tuple], dataset_directory, confianza, tiempos_decodificacion: list | None = None) -> list:
+    """
+    Corre la inferencia de varias imágenes agrupandolas por 'modo', con una sola llamada a 'predict'
+    por modelo, y deja sus detecciones en el log de detecciones. No toca la BD.
 
-        for result in results:
-            annotated_frame = result.plot()
-            cv2.imwrite(output_directory, annotated_frame) # Guardar la imagen procesada en el directorio de salida
+    items: Lista de (frame, output_directory, diccionario), con 'output_directory' como en 'ia_imagenes'. Un frame None indica que la imagen no se pudo decodificar
+           (o que no se decodificó porque ya estaba inferida, ver 'idempotencia').
+    tiempos_decodificacion: Tiempo de decodificación de cada imagen en ms (mismo orden que 'items'), si se midió.
 
-            for detection in result.boxes:
-                class_index = int(detection.cls.item())
-                class_name = class_names[class_index] if class_index < len(class_names) else 'Unknown'
+    Retorna, en el mismo orden que 'items', True si la imagen NO tiene detecciones, False si tiene,
+    o None si la imagen no se pudo decodificar (igual que 'ia_imagenes').
+    """
+    resultados = [None] * len(items)
+    grupos = {}
+    # Las imágenes de mensajes reentregados que ya se infirieron no vuelven a pasar por el modelo
+    previas = idempotencia.inferencias_previas([diccionario['id'] for _, _, diccionario in items])
+    nuevas = []
+    for i, (frame, _, diccionario) in enumerate(items):
+        previa = previas.get(diccionario['id'])
+        if previa is not None:
+            print(f"    - [IA] Imagen '{diccionario['id']}' ya inferida, se retoma desde la BD.")
+            diccionario['type'] = previa['type']
+            diccionario['detecciones'] = previa['detecciones']
+            resultados[i] = previa['resultado']
+            continue
+        nuevas.append(i)
+        if frame is not None:
+            grupos.setdefault(registro_modelos.modo_modelo(diccionario['modo']), []).append(i)
 
-                log_entry = {
-                    'class': class_name,
-                    'confidence': round(detection.conf.item() * 100, 2)
-                }
-                log_data.append(log_entry)
+    for modo, indices in grupos.items():
+        print(f"    - [IA] Lote de {len(indices)} imagen(es) para el modelo '{modo}'")
+        model = registro_modelos.obtener_modelo(modo)
+        class_names = clases_modelo(model)
+        inicio = time.perf_counter()
+        results = detectar_lote([items[i][0] for i in indices], modo, confianza)
+        t_inferencia_ms = (time.perf_counter() - inicio) * 1000 / len(indices)
+        for i, result in zip(indices, results):
+            frame, _, diccionario = items[i]
+            tiempos = {
+                't_decodificacion_ms': tiempos_decodificacion[i] if tiempos_decodificacion else None,
+                't_inferencia_ms': t_inferencia_ms
+            }
+            log_data = extraer_detecciones(result, class_names)
+            resultados[i] = registrar_detecciones(log_data, dataset_directory, confianza, diccionario, tiempos, frame.shape[:2])
+    idempotencia.guardar_inferencias([
+        (items[i][2]['id'], resultados[i], items[i][2].get('type', []), items[i][2].get('detecciones'))
+        for i in nuevas
+    ])
+    return resultados
 
-    else:
-        print("Tipo de archivo no compatible.")
-        exit() # !!!PELIGROSO!!! (Crash)
-
-    csv_filename = 'dataset.csv'
-    csv_filepath = os.path.join(dataset_directory, csv_filename)
-
-    with open(csv_filepath, mode='a', newline='') as csv_file:
-        fieldnames = ['id', 'class', 'confidence']
-        writer = csv.DictWriter(csv_file, fieldnames=fieldnames)
-
-        if csv_file.tell() == 0:
-            writer.writeheader()
-
-        diccionario['type'] = [] # 'class' es una lista de las clases detectadas en la imagen.
-        for log_entry in log_data:
-            if log_entry['confidence'] >= confianza:
-                log_entry['id'] = diccionario['id']
-                writer.writerow(log_entry)
-                if log_entry['class'] not in diccionario['type']:
-                    diccionario['type'].append(log_entry['class'])
-        if diccionario['type'] == []:
-            return True
-        else:
-            procesar(PhotoInfo(**diccionario))
-            print(f" [IA]: imagen {diccionario['id']} guardada en BDD")
-            return False
+def ia_lote(items: list[tuple], dataset_directory, confianza, tiempos_decodificacion: list | None = None) -> tuple[list, list]:
+    """
+    Igual que 'inferir_lote', pero además guarda en la BD las irregularidades de las imágenes con detecciones,
+    todas en un mismo lote de escrituras, y espera a que queden escritas.
+
+    Retorna (resultados, errores): 'errores' tiene, en el mismo orden que 'items', None si la imagen
+    quedó guardada (o no había nada que guardar) o la excepción con que falló su escritura.
+    """
+    resultados = inferir_lote(items, dataset_directory, confianza, tiempos_decodificacion)
+    futuros = [
+        guardar_irregularidad(diccionario) if result is False else None
+        for (_, _, diccionario), result in zip(items, resultados)
+    ]
+    return resultados, esperar_escrituras(futuros)
 
 
 """Cementerio
@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+# Si es "False" no se guardan las etapas y un mensaje reentregado se procesa desde cero
+activo = os.getenv('IA_IDEMPOTENCIA', 'True').lower() == 'true'
+# Archivo SQLite con las etapas terminadas de cada imagen (queda en 'imgs', que está montado desde el host)
+ruta_registro = os.getenv('IA_IDEMPOTENCIA_RUTA', os.path.join(os.getcwd(), 'imgs', 'etapas.db'))
+# Las imágenes terminadas hace más de 'IA_IDEMPOTENCIA_DIAS' días se borran del registro
+dias_retencion = float(os.getenv('IA_IDEMPOTENCIA_DIAS', 7))
+
+ETAPAS = ('inferencia', 'bd', 'notificacion')
+
+class RegistroEtapas:
+    """
+    Etapas terminadas de cada imagen, por id de mensaje, guardadas en SQLite:
+
+        inferencia:   resultado de la inferencia (sin detecciones / con detecciones y sus clases / no decodificable)
+        bd:           irregularidad y calle escritas en MongoDB
+        notificacion: imagen guardada en el almacenamiento y aviso a la API en el outbox
+
+    Si el worker se cae (o se corta el heartbeat) a mitad de un mensaje, RabbitMQ lo vuelve a entregar;
+    con el registro se retoma desde la primera etapa que falta en vez de volver a correr el modelo.
+    """
+
+    def __init__(self, ruta: str):
+        os.makedirs(os.path.dirname(ruta) or '.', exist_ok=True)
+        self._conexion = sqlite3.connect(ruta, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conexion.execute("PRAGMA journal_mode=WAL")
+        self._conexion.execute("PRAGMA synchronous=NORMAL")
+        self._conexion.execute(
+            "CREATE TABLE IF NOT EXISTS etapas ("
+            " id TEXT PRIMARY KEY,"
+            " inferencia INTEGER NOT NULL DEFAULT 0,"
+            " resultado INTEGER," # 1: sin detecciones, 0: con detecciones, NULL: no decodificable
+            " tipos TEXT,"
+            " detecciones TEXT," # JSON de las cajas (ver 'registrar_detecciones')
+            " bd INTEGER NOT NULL DEFAULT 0,"
+            " notificacion INTEGER NOT NULL DEFAULT 0,"
+            " actualizado REAL NOT NULL)"
+        )
+        self._conexion.execute("CREATE INDEX IF NOT EXISTS etapas_actualizado ON etapas (actualizado)")
+        columnas = {fila[1] for fila in self._conexion.execute("PRAGMA table_info(etapas)")}
+        if 'detecciones' not in columnas: # Registro creado antes de guardar las cajas
+            self._conexion.execute("ALTER TABLE etapas ADD COLUMN detecciones TEXT")
+        self._lock = threading.Lock()
+        self.purgar()
+
+    def inferencias(self, ids: list[str]) -> dict:
+        """
+        Retorna {id: {'resultado', 'type', 'detecciones'}} de las imágenes de 'ids' que ya tienen la inferencia hecha.
+        """
+        if not ids:
+            return {}
+        with self._lock:
+            filas = self._conexion.execute(
+                f"SELECT id, resultado, tipos, detecciones FROM etapas WHERE inferencia = 1 AND id IN ({','.join('?' * len(ids))})",
+                list(ids)
+            ).fetchall()
+        return {
+            id: {
+                'resultado': None if resultado is None else bool(resultado),
+                'type': json.loads(tipos or '[]'),
+                'detecciones': json.loads(detecciones) if detecciones else None
+            }
+            for id, resultado, tipos, detecciones in filas
+        }
+
+    def guardar_inferencias(self, inferencias: list[tuple]):
+        """
+        inferencias: Lista de (id, resultado, tipos, detecciones), con 'resultado' como lo retorna 'inferir_lote'.
+        """
+        ahora = time.time()
+        with self._lock:
+            self._conexion.executemany(
+                "INSERT INTO etapas (id, inferencia, resultado, tipos, detecciones, actualizado) VALUES (?, 1, ?, ?, ?, ?) "
+                "ON CONFLICT(id) DO UPDATE SET inferencia = 1, resultado = excluded.resultado, "
+                "tipos = excluded.tipos, detecciones = excluded.detecciones, actualizado = excluded.actualizado",
+                [
+                    (id, None if resultado is None else int(resultado), json.dumps(tipos),
+                     json.dumps(detecciones) if detecciones else None, ahora)
+                    for id, resultado, tipos, detecciones in inferencias
+                ]
+            )
+
+    def completada(self, id: str, etapa: str) -> bool:
+        with self._lock:
+            fila = self._conexion.execute(f"SELECT {etapa} FROM etapas WHERE id = ?", (id,)).fetchone()
+        return bool(fila and fila[0])
+
+    def marcar(self, id: str, etapa: str):
+        if etapa not in ETAPAS:
+            raise ValueError(f"Etapa desconocida: '{etapa}'")
+        with self._lock:
+            self._conexion.execute(
+                f"INSERT INTO etapas (id, {etapa}, actualizado) VALUES (?, 1, ?) "
+                f"ON CONFLICT(id) DO UPDATE SET {etapa} = 1, actualizado = excluded.actualizado",
+                (id, time.time())
+            )
+
+    def purgar(self):
+        limite = time.time() - dias_retencion * 86400
+        with self._lock:
+            borradas = self._conexion.execute("DELETE FROM etapas WHERE actualizado < ?", (limite,)).rowcount
+        if borradas:
+            print(f"    - [IA] {borradas} imágenes antiguas borradas del registro de etapas.")
+
+_registro = None
+_lock = threading.Lock()
+
+def registro() -> RegistroEtapas | None:
+    """
+    Retorna el registro de etapas del proceso (lo crea la primera vez), o None si está desactivado.
+    """
+    global _registro
+    if not activo:
+        return None
+    with _lock:
+        if _registro is None:
+            _registro = RegistroEtapas(ruta_registro)
+        return _registro
+
+def inferencias_previas(ids: list[str]) -> dict:
+    return registro().inferencias(ids) if activo else {}
+
+def guardar_inferencias(inferencias: list[tuple]):
+    if activo and inferencias:
+        registro().guardar_inferencias(inferencias)
+
+def completada(id: str, etapa: str) -> bool:
+    return activo and registro().completada(id, etapa)
+
+def marcar(id: str, etapa: str):
+    if activo:
+        registro().marcar(id, etapa)
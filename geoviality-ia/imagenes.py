@@ -0,0 +1,17 @@
+import cv2
+import numpy as np
+import metricas
+
+def decodificar_imagen(image: bytes):
+    """
+    Decodifica en memoria los bytes de una imagen (jpg, png, etc.) a un frame BGR.
+
+    Retorna None si los bytes no corresponden a una imagen válida.
+    """
+    try:
+        with metricas.medir('decodificacion'):
+            frame = cv2.imdecode(np.frombuffer(image, dtype=np.uint8), cv2.IMREAD_COLOR)
+    except Exception as e:
+        print(f"    - [IA] Error al decodificar la imagen: {e}")
+        return None
+    return frame
@@ -0,0 +1,284 @@
+import os
+import math
+import time
+import uuid
+import threading
+import numpy as np
+import pika
+
+# Si es 'False', 'encontrar_calle_mas_cercana' vuelve a consultar la colección 'streets' con '$near'
+usar_indice = os.getenv('CALLES_INDICE', 'True').lower() == 'true'
+# Cantidad de hijos por nodo del R-tree
+capacidad_nodo = int(os.getenv('CALLES_INDICE_CAPACIDAD', 16))
+# Cada cuantos segundos se recarga el índice desde la BD (0 = solo al iniciar o al llamar a 'refrescar')
+intervalo_refresco = float(os.getenv('CALLES_INDICE_REFRESCO_SEG', 3600))
+
+# Exchange 'fanout' por el que 'avisar_refresco' pide a todos los procesos (API e IA) que recarguen su índice
+EXCHANGE_AVISOS = 'calles'
+# Identifica a este proceso en los avisos, para no recargar dos veces el índice que ya recargó al avisar
+_origen = uuid.uuid4().hex
+
+RADIO_TIERRA_M = 6371008.8
+METROS_POR_GRADO = math.pi / 180 * RADIO_TIERRA_M
+
+def _partes(geometria: dict) -> list:
+    """
+    Retorna las líneas (listas de [lon, lat]) de una geometría LineString o MultiLineString.
+    """
+    tipo = geometria.get("type")
+    if tipo == "LineString":
+        return [geometria["coordinates"]]
+    if tipo == "MultiLineString":
+        return geometria["coordinates"]
+    return []
+
+def _str(cajas: np.ndarray, capacidad: int) -> np.ndarray:
+    """
+    Orden Sort-Tile-Recursive de 'cajas' ((n, 4): min_x, min_y, max_x, max_y): primero se ordenan por
+    el centro en x, se cortan en franjas verticales y cada franja se ordena por el centro en y. Agrupar
+    de a 'capacidad' elementos consecutivos en ese orden da nodos con cajas chicas y poco solapadas.
+    """
+    n = len(cajas)
+    franjas = max(1, math.ceil(math.sqrt(math.ceil(n / capacidad))))
+    por_franja = franjas * capacidad
+    cx = (cajas[:, 0] + cajas[:, 2]) / 2
+    cy = (cajas[:, 1] + cajas[:, 3]) / 2
+    orden_x = np.argsort(cx, kind='stable')
+    partes = []
+    for inicio in range(0, n, por_franja):
+        franja = orden_x[inicio:inicio + por_franja]
+        partes.append(franja[np.argsort(cy[franja], kind='stable')])
+    return np.concatenate(partes) if partes else orden_x
+
+class IndiceCalles:
+    """
+    Índice en memoria de los tramos de la colección 'streets' para encontrar la calle más cercana a un punto.
+
+    Las coordenadas se guardan en arreglos de NumPy como desplazamientos float32 desde un origen (el
+    centro de la red), con la mitad de memoria que float64. El error de redondeo crece con la distancia
+    al origen (unas 6e-8 veces el desplazamiento): ~7 mm a 1° (~110 km) y ~7 cm a 10°, muy por debajo
+    de los 30 m de 'max_distance' para una red de escala urbana o regional. Cada tramo es un
+    segmento entre dos vértices consecutivos de una calle y se indexa con un R-tree empaquetado (STR)
+    construido una sola vez: cada nivel es un arreglo de cajas y el rango de hijos de cada nodo.
+    El índice no se modifica después de construido; 'refrescar' arma uno nuevo y lo reemplaza.
+    """
+
+    def __init__(self, calles):
+        ids = []
+        nombres = []
+        vertices = []
+        inicios = [] # índice del primer vértice de cada tramo (el segundo es el siguiente)
+        tramo_calle = []
+        total = 0
+        for calle in calles:
+            partes = _partes(calle.get("geometry") or {})
+            if not partes:
+                continue
+            indice = len(ids)
+            ids.append(calle.get("id"))
+            nombres.append((calle.get("properties") or {}).get("name"))
+            for parte in partes:
+                puntos = [p[:2] for p in parte]
+                if len(puntos) < 2:
+                    continue
+                vertices.extend(puntos)
+                inicios.extend(range(total, total + len(puntos) - 1))
+                tramo_calle.extend([indice] * (len(puntos) - 1))
+                total += len(puntos)
+
+        self.ids = ids
+        self.nombres = nombres
+        vertices = np.asarray(vertices, dtype=np.float64).reshape(-1, 2)
+        self.origen = vertices.mean(axis=0) if len(vertices) else np.zeros(2)
+        self.vertices = (vertices - self.origen).astype(np.float32)
+        inicios = np.asarray(inicios, dtype=np.int32)
+        tramo_calle = np.asarray(tramo_calle, dtype=np.int32)
+
+        a = self.vertices[inicios]
+        b = self.vertices[inicios + 1]
+        cajas = np.concatenate([np.minimum(a, b), np.maximum(a, b)], axis=1)
+        orden = _str(cajas, capacidad_nodo)
+        self.inicios = inicios[orden]
+        self.tramo_calle = tramo_calle[orden]
+        cajas = cajas[orden]
+
+        # Niveles del árbol, de las hojas a la raíz: (cajas, primer hijo, último hijo + 1)
+        self.niveles = []
+        while len(cajas) > 0:
+            n = len(cajas)
+            primero = np.arange(0, n, capacidad_nodo, dtype=np.int32)
+            ultimo = np.minimum(primero + capacidad_nodo, n).astype(np.int32)
+            cajas_nodo = np.concatenate([
+                np.minimum.reduceat(cajas[:, :2], primero, axis=0),
+                np.maximum.reduceat(cajas[:, 2:], primero, axis=0),
+            ], axis=1)
+            # Se ordenan los nodos con STR para el nivel de arriba; cada uno conserva su rango de hijos
+            orden = _str(cajas_nodo, capacidad_nodo)
+            cajas_nodo, primero, ultimo = cajas_nodo[orden], primero[orden], ultimo[orden]
+            self.niveles.append((cajas_nodo, primero, ultimo))
+            if len(cajas_nodo) == 1:
+                break
+            cajas = cajas_nodo
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def tramos(self) -> int:
+        return len(self.inicios)
+
+    def _candidatos(self, caja: np.ndarray) -> np.ndarray:
+        """
+        Retorna los tramos cuya caja intersecta 'caja' (min_x, min_y, max_x, max_y).
+        """
+        nodos = np.zeros(1, dtype=np.int64)
+        for cajas_nivel, primero, ultimo in reversed(self.niveles):
+            c = cajas_nivel[nodos]
+            nodos = nodos[(c[:, 0] <= caja[2]) & (c[:, 2] >= caja[0]) & (c[:, 1] <= caja[3]) & (c[:, 3] >= caja[1])]
+            if len(nodos) == 0:
+                return nodos
+            desde = primero[nodos]
+            cantidad = ultimo[nodos] - desde
+            # Rangos [desde, desde + cantidad) concatenados sin un ciclo en Python
+            nodos = np.repeat(desde - np.cumsum(cantidad) + cantidad, cantidad) + np.arange(cantidad.sum())
+        return nodos
+
+    def cercana(self, lon: float, lat: float, max_distance: float = 30) -> tuple[str, str, float] | None:
+        """
+        Retorna (id, nombre, distancia en metros) de la calle más cercana a (lon, lat) a menos de
+        'max_distance' metros, o None.
+
+        La distancia es la exacta del punto a cada tramo candidato, en una proyección equirectangular
+        centrada en el punto (a estas distancias el error es despreciable).
+        """
+        if self.tramos == 0:
+            return None
+        x0 = lon - self.origen[0]
+        y0 = lat - self.origen[1]
+        escala_x = math.cos(math.radians(lat))
+        radio_y = max_distance / METROS_POR_GRADO
+        radio_x = radio_y / max(escala_x, 0.01)
+        tramos = self._candidatos(np.array([x0 - radio_x, y0 - radio_y, x0 + radio_x, y0 + radio_y]))
+        if len(tramos) == 0:
+            return None
+
+        inicios = self.inicios[tramos]
+        escala = np.array([escala_x * METROS_POR_GRADO, METROS_POR_GRADO])
+        a = (self.vertices[inicios] - (x0, y0)) * escala
+        b = (self.vertices[inicios + 1] - (x0, y0)) * escala
+        ab = b - a
+        largo2 = np.einsum('ij,ij->i', ab, ab)
+        # Proyección del punto (el origen) sobre cada tramo, acotada a sus extremos
+        t = np.clip(-np.einsum('ij,ij->i', a, ab) / np.where(largo2 > 0, largo2, 1), 0, 1)
+        cercanos = a + ab * t[:, None]
+        distancias = np.hypot(cercanos[:, 0], cercanos[:, 1])
+        mejor = int(np.argmin(distancias))
+        if distancias[mejor] > max_distance:
+            return None
+        calle = int(self.tramo_calle[tramos[mejor]])
+        return self.ids[calle], self.nombres[calle], float(distancias[mejor])
+
+_indice = None
+_coleccion = None
+_lock = threading.Lock()
+
+def listo() -> bool:
+    return usar_indice and _indice is not None
+
+def refrescar(collection=None) -> int:
+    """
+    Vuelve a construir el índice con las calles de 'collection' (o la de la última carga) y lo reemplaza.
+
+    Las búsquedas en curso terminan con el índice anterior. Retorna la cantidad de calles cargadas.
+    """
+    global _indice, _coleccion
+    with _lock:
+        if collection is not None:
+            _coleccion = collection
+        inicio = time.perf_counter()
+        nuevo = IndiceCalles(_coleccion.find({}, {"_id": 0, "id": 1, "properties.name": 1, "geometry": 1}))
+        _indice = nuevo
+    memoria = (nuevo.vertices.nbytes + nuevo.inicios.nbytes + nuevo.tramo_calle.nbytes
+               + sum(c.nbytes + p.nbytes + u.nbytes for c, p, u in nuevo.niveles))
+    print(f"Índice de calles cargado: {len(nuevo)} calles, {nuevo.tramos} tramos, "
+          f"{memoria / 1e6:.1f} MB en {(time.perf_counter() - inicio) * 1000:.0f} ms.")
+    return len(nuevo)
+
+def _refrescar_periodicamente():
+    while True:
+        time.sleep(intervalo_refresco)
+        try:
+            refrescar()
+        except Exception as e:
+            print(f"Error al refrescar el índice de calles, se mantiene el anterior: {e}")
+
+def avisar_refresco() -> bool:
+    """
+    Pide a los demás procesos que usan el índice (workers de la IA y otros procesos de la API) que lo
+    recarguen, publicando un aviso en el exchange 'calles'. Retorna False si no se pudo publicar.
+    """
+    try:
+        conn = pika.BlockingConnection(pika.ConnectionParameters('rabbitmq'))
+        channel = conn.channel()
+        channel.exchange_declare(exchange=EXCHANGE_AVISOS, exchange_type='fanout')
+        channel.basic_publish(exchange=EXCHANGE_AVISOS, routing_key='', body=_origen)
+        conn.close()
+        return True
+    except Exception as e:
+        print(f"Error al avisar la recarga del índice de calles: {e}")
+        return False
+
+def _recibir_aviso(channel, method, properties, body):
+    if body.decode() == _origen:
+        return
+    try:
+        refrescar()
+    except Exception as e:
+        print(f"Error al refrescar el índice de calles, se mantiene el anterior: {e}")
+
+def _escuchar_avisos():
+    """
+    Recarga el índice con cada aviso de 'avisar_refresco'. Cada proceso tiene su propia cola exclusiva,
+    así que todos reciben todos los avisos.
+    """
+    while True:
+        try:
+            conn = pika.BlockingConnection(pika.ConnectionParameters('rabbitmq'))
+            channel = conn.channel()
+            channel.exchange_declare(exchange=EXCHANGE_AVISOS, exchange_type='fanout')
+            cola = channel.queue_declare(queue='', exclusive=True).method.queue
+            channel.queue_bind(queue=cola, exchange=EXCHANGE_AVISOS)
+            channel.basic_consume(queue=cola, on_message_callback=_recibir_aviso, auto_ack=True)
+            channel.start_consuming()
+        except Exception as e:
+            print(f"Sin conexión para los avisos del índice de calles, reintentando en 5 segundos: {e}")
+            time.sleep(5)
+
+def iniciar(collection, avisos: bool = True):
+    """
+    Carga el índice con las calles de 'collection' y, si 'CALLES_INDICE_REFRESCO_SEG' es mayor a 0,
+    deja un hilo recargándolo periódicamente. Con 'avisos' deja además un hilo que lo recarga
+    cuando otro proceso llama a 'avisar_refresco' (por ejemplo, la ruta '/data/streets/refresh').
+    """
+    if not usar_indice:
+        return
+    try:
+        refrescar(collection)
+    except Exception as e:
+        print(f"Error al cargar el índice de calles, se usará la BD: {e}")
+        return
+    if intervalo_refresco > 0:
+        threading.Thread(target=_refrescar_periodicamente, name='indice-calles', daemon=True).start()
+    if avisos:
+        threading.Thread(target=_escuchar_avisos, name='indice-calles-avisos', daemon=True).start()
+
+def calle_mas_cercana(lon: float, lat: float, max_distance: float = 30) -> dict | None:
+    """
+    Retorna la calle más cercana a (lon, lat) a menos de 'max_distance' metros como
+    {'id', 'properties': {'name'}, 'distancia'}, o None si no hay ninguna.
+    """
+    resultado = _indice.cercana(lon, lat, max_distance)
+    if resultado is None:
+        return None
+    id, nombre, distancia = resultado
+    return {"id": id, "properties": {"name": nombre}, "distancia": distancia}
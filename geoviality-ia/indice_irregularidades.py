@@ -0,0 +1,229 @@
+import os
+import math
+import time
+import threading
+from pymongo.errors import PyMongoError
+
+# Si es 'False', 'procesar' vuelve a buscar irregularidades cercanas con '$near' en MongoDB
+usar_indice = os.getenv('IA_INDICE_IRREGULARIDADES', 'True').lower() == 'true'
+# Tamaño de las celdas de la grilla en metros (conviene que sea igual a la distancia de búsqueda)
+tamano_celda_m = float(os.getenv('IA_INDICE_CELDA_M', 10))
+# Espera máxima entre reintentos del change stream; si la BD no los soporta, el índice completo se recarga con este intervalo
+intervalo_reconciliacion = float(os.getenv('IA_INDICE_RECONCILIAR_SEG', 300))
+
+RADIO_TIERRA_M = 6371008.8
+METROS_POR_GRADO = 111320.0
+
+def distancia_m(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+    """
+    Distancia en metros entre dos puntos (haversine).
+    """
+    p1 = math.radians(lat1)
+    p2 = math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * RADIO_TIERRA_M * math.asin(math.sqrt(a))
+
+class IndiceIrregularidades:
+    """
+    Índice espacial en memoria de los puntos de 'processed_geojson'.
+
+    Es una grilla de celdas de 'tamano_celda_m' metros: cada fila de la grilla es una franja de latitud y
+    el ancho en longitud de sus celdas se ajusta con el coseno de la latitud de la franja. Buscar un punto
+    a menos de X metros solo revisa las celdas vecinas, sin ir a la BD.
+
+    Los puntos que reserva este worker ('cercano_o_agregar' o 'agregar(..., reserva=True)') quedan como
+    reservas hasta que se ven en la BD (en una recarga o en el change stream) o se quitan, así una
+    recarga no los pierde mientras su escritura espera en el lote.
+    """
+
+    def __init__(self, tamano_celda: float = tamano_celda_m):
+        self.dlat = tamano_celda / METROS_POR_GRADO
+        self._celdas = {} # (fila, columna) -> {id: (lon, lat)}
+        self._puntos = {} # id -> (fila, columna)
+        self._reservas = {} # id -> (lon, lat), puntos de este worker que aún no se ven en la BD
+        self._cambios = None # Mientras se lee una recarga: cambios hechos al índice, para repetirlos sobre ella
+        self._lock = threading.Lock()
+        self.listo = False
+
+    def _dlon(self, fila: int) -> float:
+        lat = (fila + 0.5) * self.dlat
+        return self.dlat / max(math.cos(math.radians(lat)), 0.01)
+
+    def _celda(self, lon: float, lat: float) -> tuple[int, int]:
+        fila = math.floor(lat / self.dlat)
+        return fila, math.floor(lon / self._dlon(fila))
+
+    def _agregar(self, id: str, lon: float, lat: float):
+        self._quitar(id)
+        celda = self._celda(lon, lat)
+        self._celdas.setdefault(celda, {})[id] = (lon, lat)
+        self._puntos[id] = celda
+
+    def _quitar(self, id: str):
+        celda = self._puntos.pop(id, None)
+        if celda is not None:
+            puntos = self._celdas.get(celda)
+            puntos.pop(id, None)
+            if not puntos:
+                del self._celdas[celda]
+
+    def _registrar(self, *cambio):
+        if self._cambios is not None:
+            self._cambios.append(cambio)
+
+    def agregar(self, id: str, lon: float, lat: float, reserva: bool = False):
+        """
+        Agrega o mueve el punto 'id'. Con 'reserva', el punto es de este worker y su escritura aún no
+        se confirma; si no, viene de la BD y deja de ser reserva.
+        """
+        with self._lock:
+            self._agregar(id, lon, lat)
+            if reserva:
+                self._reservas[id] = (lon, lat)
+            else:
+                self._reservas.pop(id, None)
+            self._registrar('agregar', id, lon, lat)
+
+    def quitar(self, id: str):
+        with self._lock:
+            self._quitar(id)
+            self._reservas.pop(id, None)
+            self._registrar('quitar', id)
+
+    def cargar(self, documentos):
+        """
+        Reemplaza el contenido del índice con los documentos ({'_id', 'geometry'}) entregados.
+
+        Se conservan las reservas que aún no están en los documentos, y los cambios hechos al índice
+        mientras se leían se vuelven a aplicar sobre ellos.
+        """
+        nuevo = IndiceIrregularidades.__new__(IndiceIrregularidades)
+        nuevo.dlat = self.dlat
+        nuevo._celdas = {}
+        nuevo._puntos = {}
+        with self._lock:
+            self._cambios = []
+        try:
+            for doc in documentos:
+                try:
+                    lon, lat = doc["geometry"]["coordinates"][:2]
+                except (KeyError, TypeError, ValueError):
+                    continue
+                nuevo._agregar(doc["_id"], lon, lat)
+            with self._lock:
+                for id, (lon, lat) in list(self._reservas.items()):
+                    if id in nuevo._puntos:
+                        del self._reservas[id]
+                    else:
+                        nuevo._agregar(id, lon, lat)
+                for operacion, id, *coordenadas in self._cambios:
+                    if operacion == 'agregar':
+                        nuevo._agregar(id, *coordenadas)
+                    else:
+                        nuevo._quitar(id)
+                self._celdas = nuevo._celdas
+                self._puntos = nuevo._puntos
+                self.listo = True
+        finally:
+            with self._lock:
+                self._cambios = None
+
+    def cercano(self, lon: float, lat: float, max_distance: float = 10) -> str | None:
+        """
+        Retorna el id del punto más cercano a (lon, lat) a menos de 'max_distance' metros, o None.
+        """
+        with self._lock:
+            return self._cercano(lon, lat, max_distance)
+
+    def cercano_o_agregar(self, id: str, lon: float, lat: float, max_distance: float = 10) -> str | None:
+        """
+        Igual que 'cercano', pero si no hay ningún punto cerca agrega 'id' en la misma operación, así
+        dos imágenes del mismo lugar procesadas a la vez no crean dos puntos.
+        """
+        with self._lock:
+            existente = self._cercano(lon, lat, max_distance)
+            if existente is None:
+                self._agregar(id, lon, lat)
+                self._reservas[id] = (lon, lat)
+                self._registrar('agregar', id, lon, lat)
+            return existente
+
+    def _cercano(self, lon: float, lat: float, max_distance: float) -> str | None:
+        radio_lat = max_distance / METROS_POR_GRADO
+        fila_min = math.floor((lat - radio_lat) / self.dlat)
+        fila_max = math.floor((lat + radio_lat) / self.dlat)
+        radio_lon = radio_lat / max(math.cos(math.radians(lat)), 0.01)
+        mejor = None
+        mejor_distancia = max_distance
+        for fila in range(fila_min, fila_max + 1):
+            dlon = self._dlon(fila)
+            for columna in range(math.floor((lon - radio_lon) / dlon), math.floor((lon + radio_lon) / dlon) + 1):
+                for id, (plon, plat) in self._celdas.get((fila, columna), {}).items():
+                    d = distancia_m(lon, lat, plon, plat)
+                    if d <= mejor_distancia:
+                        mejor = id
+                        mejor_distancia = d
+        return mejor
+
+    def __len__(self):
+        return len(self._puntos)
+
+indice = IndiceIrregularidades()
+
+def _recargar(collection):
+    inicio = time.perf_counter()
+    indice.cargar(collection.find({}, {"geometry": 1}))
+    print(f"    - [IA] Índice de irregularidades cargado con {len(indice)} puntos en {(time.perf_counter() - inicio) * 1000:.0f} ms.")
+
+def _seguir_cambios(collection):
+    """
+    Mantiene el índice al día con los cambios de la colección (puntos nuevos, borrados o movidos por
+    otros workers o por la API).
+
+    Si el change stream falla, recarga el índice y lo vuelve a abrir con esperas crecientes hasta
+    'IA_INDICE_RECONCILIAR_SEG' segundos; si la BD no los soporta, eso deja el índice recargándose
+    con ese intervalo.
+    """
+    espera = 1
+    while True:
+        try:
+            with collection.watch(full_document='updateLookup') as stream:
+                # Lo que haya cambiado antes de abrir el stream se recupera recargando una vez
+                _recargar(collection)
+                espera = 1
+                for cambio in stream:
+                    operacion = cambio["operationType"]
+                    id = cambio.get("documentKey", {}).get("_id")
+                    if operacion == "delete":
+                        indice.quitar(id)
+                    elif operacion in ("insert", "update", "replace"):
+                        doc = cambio.get("fullDocument")
+                        if doc is None:
+                            indice.quitar(id)
+                        else:
+                            lon, lat = doc["geometry"]["coordinates"][:2]
+                            indice.agregar(id, lon, lat)
+                    elif operacion in ("drop", "rename", "invalidate"):
+                        break
+        except PyMongoError as e:
+            print(f"    - [IA] Change stream del índice de irregularidades interrumpido ({e}), se reintenta en {espera:.0f} s.")
+            time.sleep(espera)
+            espera = min(espera * 2, intervalo_reconciliacion)
+            try:
+                _recargar(collection)
+            except PyMongoError as e:
+                print(f"    - [IA] Error al reconciliar el índice de irregularidades: {e}")
+        except Exception as e:
+            print(f"    - [IA] Error en el seguimiento del índice de irregularidades: {e}")
+            time.sleep(5)
+
+def iniciar(collection):
+    """
+    Carga el índice con todos los puntos de 'collection' y deja un hilo manteniéndolo al día.
+    """
+    if not usar_indice:
+        return
+    _recargar(collection)
+    threading.Thread(target=_seguir_cambios, args=(collection,), name='indice-irregularidades', daemon=True).start()
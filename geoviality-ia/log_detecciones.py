@@ -0,0 +1,154 @@
+import os
+import csv
+import time
+import atexit
+import threading
+from datetime import datetime
+import metricas
+
+# Formato de los archivos: 'arrow' (Arrow IPC stream), 'parquet' o 'csv'
+formato = os.getenv('IA_LOG_FORMATO', 'arrow').lower()
+# Se escribe a disco cuando se juntan 'IA_LOG_FLUSH_FILAS' filas o pasan 'IA_LOG_FLUSH_SEG' segundos
+flush_filas = int(os.getenv('IA_LOG_FLUSH_FILAS', 500))
+flush_seg = float(os.getenv('IA_LOG_FLUSH_SEG', 5))
+# Se abre un archivo nuevo cada 'IA_LOG_ROTACION_FILAS' filas o cada 'IA_LOG_ROTACION_SEG' segundos
+rotacion_filas = int(os.getenv('IA_LOG_ROTACION_FILAS', 100000))
+rotacion_seg = float(os.getenv('IA_LOG_ROTACION_SEG', 3600))
+
+columnas = [
+    'fecha', 'id', 'modo', 'modelo', 'class', 'confidence',
+    'x_min', 'y_min', 'x_max', 'y_max', 't_decodificacion_ms', 't_inferencia_ms'
+]
+
+def _esquema():
+    import pyarrow as pa
+    return pa.schema([
+        ('fecha', pa.timestamp('ms')),
+        ('id', pa.string()),
+        ('modo', pa.string()),
+        ('modelo', pa.string()),
+        ('class', pa.string()),
+        ('confidence', pa.float32()),
+        ('x_min', pa.float32()),
+        ('y_min', pa.float32()),
+        ('x_max', pa.float32()),
+        ('y_max', pa.float32()),
+        ('t_decodificacion_ms', pa.float32()),
+        ('t_inferencia_ms', pa.float32()),
+    ])
+
+class LogDetecciones:
+    """
+    Log de detecciones con buffer en memoria.
+
+    'agregar' solo deja las filas en el buffer; un hilo aparte las escribe por lotes en archivos
+    rotados dentro de 'directorio', así el hilo de inferencia no espera al disco. Cada archivo lleva
+    en el nombre la fecha en que se abrió y el pid, por lo que un reinicio nunca pisa datos anteriores.
+    """
+
+    def __init__(self, directorio: str):
+        self.directorio = directorio
+        os.makedirs(directorio, exist_ok=True)
+        self._buffer = []
+        self._cond = threading.Condition()
+        self._escritura = threading.Lock()
+        self._archivo = None # Archivo abierto actual (arrow/csv; parquet lo maneja su escritor)
+        self._escritor = None
+        self._filas_archivo = 0
+        self._apertura = 0.0
+        self._secuencia = 0
+        self._hilo = threading.Thread(target=self._ciclo, name='log-detecciones', daemon=True)
+        self._hilo.start()
+        atexit.register(self.cerrar)
+
+    def agregar(self, filas: list[dict]):
+        if not filas:
+            return
+        with self._cond:
+            self._buffer.extend(filas)
+            if len(self._buffer) >= flush_filas:
+                self._cond.notify()
+
+    def _ciclo(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._buffer) >= flush_filas, timeout=flush_seg)
+                filas, self._buffer = self._buffer, []
+            if filas:
+                try:
+                    with self._escritura, metricas.medir('log'):
+                        self._escribir(filas)
+                except Exception as e:
+                    print(f"    - [IA] Error al escribir el log de detecciones ({len(filas)} filas perdidas): {e}")
+
+    def _nombre(self, extension: str) -> str:
+        self._secuencia += 1
+        return os.path.join(self.directorio, f"detecciones-{datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{self._secuencia}.{extension}")
+
+    def _rotar_si_corresponde(self):
+        if self._escritor is not None and (self._filas_archivo >= rotacion_filas or time.monotonic() - self._apertura >= rotacion_seg):
+            self._cerrar_archivo()
+
+    def _cerrar_archivo(self):
+        if self._escritor is not None and formato in ('arrow', 'parquet'):
+            self._escritor.close()
+        if self._archivo is not None:
+            self._archivo.close()
+        self._archivo = None
+        self._escritor = None
+        self._filas_archivo = 0
+
+    def _escribir(self, filas: list[dict]):
+        self._rotar_si_corresponde()
+        if formato == 'parquet':
+            # Cada flush es un row group del archivo abierto. El footer se escribe al rotar o al cerrar,
+            # así que si el proceso muere sin cerrar se pierde el archivo en curso.
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            if self._escritor is None:
+                self._escritor = pq.ParquetWriter(self._nombre('parquet'), _esquema())
+                self._apertura = time.monotonic()
+            self._escritor.write_table(pa.Table.from_pylist(filas, schema=_esquema()))
+            self._filas_archivo += len(filas)
+            return
+        if formato == 'csv':
+            if self._escritor is None:
+                self._archivo = open(self._nombre('csv'), 'w', newline='')
+                self._escritor = csv.DictWriter(self._archivo, fieldnames=columnas, extrasaction='ignore')
+                self._escritor.writeheader()
+                self._apertura = time.monotonic()
+            self._escritor.writerows(filas)
+        else:
+            # Arrow IPC stream: cada flush es un record batch; un archivo cortado se puede leer hasta el último batch
+            import pyarrow as pa
+            if self._escritor is None:
+                self._archivo = open(self._nombre('arrows'), 'wb')
+                self._escritor = pa.ipc.new_stream(self._archivo, _esquema())
+                self._apertura = time.monotonic()
+            self._escritor.write_batch(pa.RecordBatch.from_pylist(filas, schema=_esquema()))
+        self._archivo.flush()
+        self._filas_archivo += len(filas)
+
+    def cerrar(self):
+        """
+        Escribe lo que quede en el buffer y cierra el archivo actual.
+        """
+        with self._cond:
+            filas, self._buffer = self._buffer, []
+        with self._escritura:
+            if filas:
+                with metricas.medir('log'):
+                    self._escribir(filas)
+            self._cerrar_archivo()
+
+_logs = {}
+_lock = threading.Lock()
+
+def log_en(directorio: str) -> LogDetecciones:
+    """
+    Retorna el log de detecciones del proceso para 'directorio' (lo crea la primera vez).
+    """
+    with _lock:
+        if directorio not in _logs:
+            _logs[directorio] = LogDetecciones(directorio)
+        return _logs[directorio]
@@ -1,64 +1,222 @@
+import arranque # Primero, para medir desde el inicio del proceso
 import ia_predictor as ia
 import dotenv
 import pika
 import os
 import json
 import time
-from models import PhotoSend
+import registro_modelos
+import metricas
+import colas
+import idempotencia
+import video
+from pool_inferencia import PoolInferencia, consumir_con_procesos
+from pipeline import Pipeline, consumir_en_pipeline
+from imagenes import decodificar_imagen
 
 dotenv.load_dotenv()
 
-from funcs import create_directories, delete_image, send_to_API
+from funcs import create_directories, finalizar_imagen, outbox_api
+from database import db
+import indice_irregularidades
+import indice_calles
+from configuracion import modelo_IA_auto, modelos_IA, confianza, path_post, path_csv
 
-modelo_IA_auto = os.getcwd() + '/Modelo 2 (Fuerte en Seco)/Vista_Vehiculo_V3.pt'
-modelo_IA_peaton = os.getcwd() + '/Modelo 2 (Fuerte en Seco)/Vista_Peaton_General_V3_Refactorizado_Cris.pt'
-confianza = 0.65
-path_post = os.getcwd() + '/imgs/post/'
-path_csv = os.getcwd() + '/imgs/'
+# Solo se cargan los modelos de las rutas que atiende este worker ('IA_RUTAS'); los videos usan el de vehiculo
+modelos_activos = {
+    modo: ruta for modo, ruta in modelos_IA.items()
+    if modo in colas.rutas or (modo == 'auto' and colas.RUTA_VIDEOS in colas.rutas)
+}
 
+# 'simple': un mensaje a la vez. 'lotes': junta varios mensajes y hace un 'predict' por modelo.
+# 'procesos': el proceso principal solo consume y reparte entre 'IA_PROCESOS' procesos de inferencia.
+# 'pipeline': etapas con hilos propios (decodificación, inferencia, BD, notificación) unidas por colas acotadas.
+modo_consumo = os.getenv('IA_MODO_CONSUMO', 'simple').lower()
+tamano_lote = int(os.getenv('IA_LOTE_TAMANO', 8))
+espera_lote_ms = int(os.getenv('IA_LOTE_ESPERA_MS', 200))
+procesos_IA = int(os.getenv('IA_PROCESOS', os.cpu_count() or 1))
+prefetch = int(os.getenv('IA_PREFETCH', tamano_lote * 2 * (procesos_IA if modo_consumo == 'procesos' else 1)))
+# Solo para depurar: deja una copia de cada imagen recibida en 'imgs/pre' mientras se procesa
+guardar_en_pre = os.getenv('IA_GUARDAR_PRE', 'False').lower() == 'true'
+
+
+def guardar_pre(data: dict, image: bytes) -> str | None:
+    """
+    Si 'IA_GUARDAR_PRE' está activo, guarda la imagen del mensaje en 'imgs/pre' y retorna su ruta.
+
+    Si no, retorna None: la imagen se procesa solo en memoria.
+    """
+    if not guardar_en_pre:
+        return None
+    path = os.getcwd() + '/imgs/pre/' + data['id'] + '.jpg'
+    with open(path, 'wb') as f:
+        f.write(image)
+    print(f"    - [IA] Imagen '{data['id']}.jpg' guardada en 'pre'.")
+    return path
 
 def callback(ch, method, properties, body):
+    # Un mensaje a la vez: 'ia_en_cola{cola="en_vuelo"}' queda en 1 mientras se procesa
+    en_vuelo = metricas.en_cola.labels('en_vuelo')
+    en_vuelo.inc()
+    try:
+        procesar_mensaje(ch, method, body)
+    finally:
+        en_vuelo.dec()
+
+def procesar_mensaje(ch, method, body):
     print("    - [IA] Imagen recibida")
     data = json.loads(body)
     print(data.keys())
-    image = data['image']
     image_filename = data['id'] + '.jpg'
-    id = data['id']
-    path = os.getcwd() + '/imgs/pre/' + image_filename
-    with open(path, 'wb') as f:
-        f.write(image.encode('latin1'))
-    print(f"    - [IA] Imagen '{image_filename}' guardada en 'pre' y empezando a procesar.")
-    result = ia.ia_imagenes(modelo_IA_auto, modelo_IA_peaton, path, path_post + image_filename, path_csv, confianza, data)
-    if result:
-        delete_image(image_filename)
-    else:
-        send_to_API(PhotoSend(image=image, id=id))
-    os.remove(path)
-    print(f"    - [IA] Imagen '{image_filename}' procesada y eliminada de 'pre'.")
+    image = data['image'].encode('latin1')
+    path = guardar_pre(data, image)
+    print(f"    - [IA] Imagen '{image_filename}' recibida, empezando a procesar.")
+    try:
+        result = ia.ia_imagenes(image, path_post + image_filename, path_csv, confianza, data)
+    except Exception as e:
+        # No quedó guardada en la BD: se devuelve a la cola una vez; si ya venía reentregada se descarta
+        print(f"    - [IA] Error al guardar la imagen '{image_filename}' en la BD: {e}")
+        ch.basic_nack(delivery_tag=method.delivery_tag, requeue=not method.redelivered)
+        metricas.mensajes.labels('error').inc()
+        return
+    finalizar_imagen(data, image, result, path)
     ch.basic_ack(delivery_tag=method.delivery_tag)
+    metricas.mensajes.labels('ok').inc()
 
-def procesar_imagenes():
-    print("    - [IA] Iniciando IA...")
-    create_directories()
-    print("    - [IA] Directorios creados.")
+def recolectar_lote(connection, pendientes: list):
+    """
+    Espera a que llegue al menos un mensaje y luego sigue recibiendo hasta juntar 'IA_LOTE_TAMANO'
+    mensajes o hasta que pasen 'IA_LOTE_ESPERA_MS' milisegundos desde el primero.
+
+    Retorna la lista de (method, body) recolectados y los quita de 'pendientes'.
+    """
+    while not pendientes:
+        connection.process_data_events(time_limit=None)
+    limite = time.monotonic() + espera_lote_ms / 1000
+    while len(pendientes) < tamano_lote:
+        restante = limite - time.monotonic()
+        if restante <= 0:
+            break
+        connection.process_data_events(time_limit=restante)
+    lote = pendientes[:tamano_lote]
+    del pendientes[:tamano_lote]
+    return lote
+
+def procesar_lote(channel, lote: list):
+    """
+    Procesa un lote de mensajes con un 'predict' por modelo y confirma cada mensaje
+    una vez que sus resultados quedaron escritos.
+    """
+    print(f"    - [IA] Lote de {len(lote)} imagen(es) recibido")
+    mensajes = []
+    items = []
+    tiempos_decodificacion = []
+    for method, body in lote:
+        data = json.loads(body)
+        image = data['image'].encode('latin1')
+        path = guardar_pre(data, image)
+        mensajes.append((method, data, image, path))
+        inicio = time.perf_counter()
+        # Un mensaje reentregado que ya se infirió no se decodifica ('inferir_lote' usa el resultado guardado)
+        ya_inferida = method.redelivered and idempotencia.inferencias_previas([data['id']])
+        items.append((None if ya_inferida else decodificar_imagen(image), path_post + data['id'] + '.jpg', data))
+        tiempos_decodificacion.append((time.perf_counter() - inicio) * 1000)
+
+    resultados, errores = ia.ia_lote(items, path_csv, confianza, tiempos_decodificacion)
+
+    for (method, data, image, path), result, error in zip(mensajes, resultados, errores):
+        if error:
+            print(f"    - [IA] Error al guardar la imagen '{data['id']}' en la BD: {error}")
+            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=not method.redelivered)
+            metricas.mensajes.labels('error').inc()
+            continue
+        finalizar_imagen(data, image, result, path)
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+        metricas.mensajes.labels('ok').inc()
+
+def consumir_por_lotes(connection, channel):
+    """
+    Consume las colas de imágenes por lotes. El prefetch limita cuantos mensajes sin confirmar
+    puede tener el worker a la vez.
+    """
+    pendientes = []
+    metricas.observar_cola('recibidos', lambda: len(pendientes))
+    colas.suscribir(
+        channel,
+        lambda ch, method, properties, body: pendientes.append((method, body)),
+        max(prefetch, tamano_lote)
+        )
+    print(f"    - [IA] Consumo por lotes: hasta {tamano_lote} imagenes o {espera_lote_ms} ms por lote.")
+    while True:
+        lote = recolectar_lote(connection, pendientes)
+        procesar_lote(channel, lote)
+
+def conectar_rabbitmq():
     print("    - [IA] Iniciando conexión a cola RabbitMQ...")
     while True:
         try:
             connection = pika.BlockingConnection(pika.ConnectionParameters('rabbitmq'))
             print("    - [IA] Conexion a cola Rabbit exitosa.")
-            break
+            return connection
         except pika.exceptions.AMQPConnectionError:
             print("    - [IA] No se pudo conectar a RabbitMQ, reintentando en 5 segundos...")
             time.sleep(5)
 
+def procesar_imagenes():
+    """
+    Arranca el worker: carga y calienta los modelos y los índices antes de conectarse a RabbitMQ,
+    así el primer mensaje no paga la inicialización. Cada fase se mide (ver 'arranque') y al
+    terminar se crea el archivo de listo que revisa el healthcheck del contenedor.
+    """
+    arranque.registrar('importaciones', arranque.desde_inicio())
+    arranque.limpiar()
+    arranque.instalar_senales()
+    print("    - [IA] Iniciando IA...")
+    with arranque.fase('preparacion'):
+        create_directories()
+        print("    - [IA] Directorios creados.")
+        metricas.iniciar()
+        outbox_api().iniciar_envio()
+        metricas.observar_cola('avisos_api', outbox_api().pendientes)
+    if modo_consumo == 'procesos':
+        with arranque.fase('modelos'):
+            print(f"    - [IA] Iniciando {procesos_IA} procesos de inferencia...")
+            pool = PoolInferencia(procesos_IA, modelos_activos, confianza, path_post, path_csv, tamano_lote)
+            if colas.RUTA_VIDEOS in colas.rutas:
+                # Los videos se procesan en este proceso, con su propio modelo
+                registro_modelos.cargar_modelos({'auto': modelo_IA_auto})
+            pool.esperar_listos()
+        if colas.RUTA_VIDEOS in colas.rutas:
+            with arranque.fase('indices'):
+                indice_irregularidades.iniciar(db.processed_geojson)
+                indice_calles.iniciar(db.streets)
+    else:
+        with arranque.fase('modelos'):
+            print(f"    - [IA] Cargando modelos de IA ({', '.join(modelos_activos)})...")
+            registro_modelos.cargar_modelos(modelos_activos)
+        with arranque.fase('indices'):
+            indice_irregularidades.iniciar(db.processed_geojson)
+            indice_calles.iniciar(db.streets)
+    with arranque.fase('rabbitmq'):
+        connection = conectar_rabbitmq()
+
     channel = connection.channel()
-    channel.queue_declare(queue='images', durable=True)
+    if colas.RUTA_VIDEOS in colas.rutas:
+        video.iniciar(confianza, path_post, path_csv)
+    arranque.marcar_listo()
     print('    - [IA] Esperando mensajes, para salir presione CTRL+C')
-    channel.basic_consume(
-        queue='images', 
-        on_message_callback=callback
-        )
+    if modo_consumo == 'lotes':
+        consumir_por_lotes(connection, channel)
+        return
+    if modo_consumo == 'procesos':
+        consumir_con_procesos(connection, channel, pool, prefetch)
+        return
+    if modo_consumo == 'pipeline':
+        pipeline = Pipeline(connection, channel, confianza, path_post, path_csv, tamano_lote, prefetch, guardar_pre)
+        consumir_en_pipeline(connection, channel, pipeline, prefetch)
+        return
+    colas.suscribir(channel, callback, prefetch)
     channel.start_consuming()
 
 if __name__ == "__main__":
-    procesar_imagenes()
\ No newline at end of file
+    procesar_imagenes()
@@ -0,0 +1,116 @@
+import os
+import glob
+import time
+import threading
+
+# Puerto HTTP donde se exponen las métricas en formato Prometheus ('/metrics'). 0 las desactiva.
+puerto = int(os.getenv('IA_METRICAS_PUERTO', 9100))
+# Cada cuanto se actualizan la memoria del proceso y el largo de las colas
+intervalo_muestreo = float(os.getenv('IA_METRICAS_MUESTREO_SEG', 5))
+
+# Con 'IA_MODO_CONSUMO=procesos' cada proceso de inferencia escribe sus métricas en archivos de esta
+# carpeta y el proceso principal las junta al responder. Tiene que quedar definida antes de importar
+# prometheus_client, y los procesos hijos la heredan por el entorno.
+multiproceso = os.getenv('IA_MODO_CONSUMO', 'simple').lower() == 'procesos'
+if multiproceso:
+    os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(os.getcwd(), 'imgs', 'metricas'))
+    os.makedirs(os.environ['PROMETHEUS_MULTIPROC_DIR'], exist_ok=True)
+
+from prometheus_client import Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, start_http_server
+
+# Desde 1 ms hasta 10 s
+intervalos = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+etapas = Histogram(
+    'ia_etapa_segundos',
+    'Duración de cada etapa del procesamiento de una imagen',
+    ['etapa'], buckets=intervalos
+)
+inferencia = Histogram(
+    'ia_inferencia_segundos',
+    'Tiempo de inferencia por imagen (el de un lote dividido por sus imágenes)',
+    ['modelo'], buckets=intervalos
+)
+mensajes = Counter('ia_mensajes_total', 'Mensajes de RabbitMQ terminados', ['resultado'])
+detecciones = Counter('ia_detecciones_total', 'Detecciones sobre el umbral de confianza', ['modelo', 'clase'])
+en_cola = Gauge(
+    'ia_en_cola', 'Elementos esperando en cada cola interna (mensajes en vuelo, avisos pendientes)',
+    ['cola'], multiprocess_mode='livesum'
+)
+memoria = Gauge('ia_memoria_residente_bytes', 'Memoria residente del proceso', multiprocess_mode='livesum')
+arranque = Gauge(
+    'ia_arranque_segundos', 'Duración de cada fase del arranque del worker', ['fase'], multiprocess_mode='livemax'
+)
+listo = Gauge('ia_listo', '1 cuando el worker terminó de arrancar y está consumiendo', multiprocess_mode='livemax')
+
+_colas = {} # nombre -> función que retorna su largo
+_muestreo = None
+_lock = threading.Lock()
+
+def medir(etapa: str):
+    """
+    Context manager que mide la duración de 'etapa':
+
+        with metricas.medir('decodificacion'):
+            ...
+    """
+    return etapas.labels(etapa).time()
+
+def observar_cola(nombre: str, largo):
+    """
+    Registra una cola interna: 'largo()' se consulta en cada muestreo y queda en 'ia_en_cola{cola=nombre}'.
+    """
+    with _lock:
+        _colas[nombre] = largo
+    iniciar_muestreo()
+
+def _memoria_residente() -> int:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # Máximo, si no hay /proc
+
+def _muestrear():
+    while True:
+        memoria.set(_memoria_residente())
+        with _lock:
+            colas = list(_colas.items())
+        for nombre, largo in colas:
+            try:
+                en_cola.labels(nombre).set(largo())
+            except Exception:
+                pass
+        time.sleep(intervalo_muestreo)
+
+def iniciar_muestreo():
+    """
+    Inicia (una vez por proceso) el hilo que actualiza la memoria residente y el largo de las colas.
+    """
+    global _muestreo
+    with _lock:
+        if _muestreo is None:
+            _muestreo = threading.Thread(target=_muestrear, name='metricas', daemon=True)
+            _muestreo.start()
+
+def iniciar():
+    """
+    Levanta el servidor HTTP de métricas en 'IA_METRICAS_PUERTO' (solo en el proceso principal).
+
+    En modo multiproceso borra los archivos de ejecuciones anteriores (los de este proceso ya están
+    abiertos) y responde con lo de todos los procesos juntos.
+    """
+    if not puerto:
+        return
+    registro = REGISTRY
+    if multiproceso:
+        from prometheus_client import multiprocess
+        for archivo in glob.glob(os.path.join(os.environ['PROMETHEUS_MULTIPROC_DIR'], '*.db')):
+            if not archivo.endswith(f'_{os.getpid()}.db'):
+                os.remove(archivo)
+        registro = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registro)
+    start_http_server(puerto, registry=registro)
+    iniciar_muestreo()
+    print(f"    - [IA] Métricas en http://0.0.0.0:{puerto}/metrics")
@@ -0,0 +1,293 @@
+import os
+import ast
+import sys
+import time
+import shutil
+import tempfile
+import contextlib
+import cv2
+import numpy as np
+
+# Hilos de ONNX Runtime por sesión (0 = los que elija ONNX Runtime). En el modo 'procesos' se usan los núcleos del proceso.
+hilos = int(os.getenv('IA_ONNX_HILOS', 0))
+# Igual que los valores por defecto de 'predict' de ultralytics
+iou_nms = float(os.getenv('IA_ONNX_IOU', 0.7))
+max_detecciones = int(os.getenv('IA_ONNX_MAX_DETECCIONES', 300))
+
+def ruta_onnx(ruta_pt: str) -> str:
+    """
+    Ruta del modelo ONNX que corresponde a un archivo de pesos '.pt' (mismo nombre, extensión '.onnx').
+    """
+    return os.path.splitext(ruta_pt)[0] + '.onnx'
+
+def exportar(ruta_pt: str, imgsz: int = 640) -> str:
+    """
+    Exporta los pesos 'ruta_pt' a ONNX (batch dinámico) con ultralytics y retorna la ruta del '.onnx'.
+
+    ultralytics escribe el '.onnx' al lado de los pesos, así que se exporta una copia en una carpeta
+    temporal y el resultado se mueve con 'os.replace': quien lea el '.onnx' ve el anterior o el nuevo
+    completo, nunca uno a medio escribir.
+    """
+    from ultralytics import YOLO
+    inicio = time.perf_counter()
+    temporal = tempfile.mkdtemp(prefix='.exportacion-', dir=os.path.dirname(os.path.abspath(ruta_pt)))
+    try:
+        copia = shutil.copy(ruta_pt, os.path.join(temporal, os.path.basename(ruta_pt)))
+        ruta = ruta_onnx(ruta_pt)
+        os.replace(YOLO(copia).export(format='onnx', imgsz=imgsz, dynamic=True), ruta)
+    finally:
+        shutil.rmtree(temporal, ignore_errors=True)
+    print(f"    - [IA] Modelo '{os.path.basename(ruta_pt)}' exportado a ONNX en {time.perf_counter() - inicio:.1f} s.")
+    return ruta
+
+@contextlib.contextmanager
+def _bloqueo_archivo(ruta: str):
+    """
+    Lock exclusivo entre procesos sobre 'ruta' (con 'flock'; donde no existe, no bloquea).
+    """
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+    with open(ruta, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _al_dia(ruta: str, ruta_pt: str) -> bool:
+    return os.path.exists(ruta) and os.path.getmtime(ruta) >= os.path.getmtime(ruta_pt)
+
+def onnx_actualizado(ruta_pt: str) -> str:
+    """
+    Retorna la ruta del '.onnx' de 'ruta_pt', exportándolo antes si no existe o es más antiguo que los pesos.
+
+    Varios procesos pueden llamarla a la vez (modo 'procesos'): solo uno exporta y el resto espera su resultado.
+    """
+    ruta = ruta_onnx(ruta_pt)
+    if _al_dia(ruta, ruta_pt):
+        return ruta
+    with _bloqueo_archivo(ruta + '.lock'):
+        if not _al_dia(ruta, ruta_pt): # Otro proceso pudo exportarlo mientras se esperaba el lock
+            exportar(ruta_pt)
+    return ruta
+
+def letterbox(frame: np.ndarray, tamano: tuple[int, int]) -> tuple[np.ndarray, float, tuple[float, float]]:
+    """
+    Escala 'frame' sin deformarlo para que quepa en 'tamano' (alto, ancho) y rellena el resto con gris
+    (114), centrado, igual que el preprocesamiento de ultralytics.
+
+    Retorna la imagen, la escala aplicada y el relleno (izquierda, arriba).
+    """
+    alto, ancho = frame.shape[:2]
+    escala = min(tamano[0] / alto, tamano[1] / ancho)
+    nuevo_ancho, nuevo_alto = round(ancho * escala), round(alto * escala)
+    dw = (tamano[1] - nuevo_ancho) / 2
+    dh = (tamano[0] - nuevo_alto) / 2
+    if (ancho, alto) != (nuevo_ancho, nuevo_alto):
+        frame = cv2.resize(frame, (nuevo_ancho, nuevo_alto), interpolation=cv2.INTER_LINEAR)
+    arriba, abajo = round(dh - 0.1), round(dh + 0.1)
+    izquierda, derecha = round(dw - 0.1), round(dw + 0.1)
+    frame = cv2.copyMakeBorder(frame, arriba, abajo, izquierda, derecha, cv2.BORDER_CONSTANT, value=(114, 114, 114))
+    return frame, escala, (izquierda, arriba)
+
+def nms(cajas: np.ndarray, puntajes: np.ndarray, iou: float) -> np.ndarray:
+    """
+    Non-maximum suppression: retorna los índices de las cajas (x1, y1, x2, y2) que se conservan,
+    de mayor a menor puntaje.
+    """
+    areas = (cajas[:, 2] - cajas[:, 0]) * (cajas[:, 3] - cajas[:, 1])
+    orden = np.argsort(-puntajes, kind='stable')
+    conservar = []
+    while len(orden) > 0:
+        i = orden[0]
+        conservar.append(i)
+        resto = orden[1:]
+        x1 = np.maximum(cajas[i, 0], cajas[resto, 0])
+        y1 = np.maximum(cajas[i, 1], cajas[resto, 1])
+        x2 = np.minimum(cajas[i, 2], cajas[resto, 2])
+        y2 = np.minimum(cajas[i, 3], cajas[resto, 3])
+        interseccion = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+        orden = resto[interseccion / (areas[i] + areas[resto] - interseccion + 1e-9) <= iou]
+    return np.asarray(conservar, dtype=np.int64)
+
+class Deteccion:
+    """
+    Una detección con los mismos atributos que usa 'extraer_detecciones' de las cajas de ultralytics
+    ('cls', 'conf' y 'xyxy').
+    """
+
+    def __init__(self, caja: np.ndarray, puntaje: float, clase: int):
+        self.xyxy = caja.reshape(1, 4)
+        self.conf = np.float32(puntaje)
+        self.cls = np.float32(clase)
+
+class ResultadoONNX:
+    """
+    Resultado de una imagen, con la misma forma que el de ultralytics: 'boxes', 'orig_shape' y 'plot()'.
+    """
+
+    def __init__(self, frame: np.ndarray, cajas: np.ndarray, puntajes: np.ndarray, clases: np.ndarray, names: dict):
+        self.orig_img = frame
+        self.orig_shape = frame.shape[:2]
+        self.names = names
+        self.boxes = [Deteccion(c, p, k) for c, p, k in zip(cajas, puntajes, clases)]
+
+    def plot(self) -> np.ndarray:
+        """
+        Retorna una copia de la imagen con las cajas y la clase y confianza de cada detección.
+        """
+        imagen = self.orig_img.copy()
+        grosor = max(round(sum(imagen.shape[:2]) / 2 * 0.003), 2)
+        for deteccion in self.boxes:
+            x1, y1, x2, y2 = (int(v) for v in deteccion.xyxy[0])
+            clase = int(deteccion.cls.item())
+            color = ((clase * 67) % 256, (clase * 151) % 256, (clase * 211 + 80) % 256)
+            cv2.rectangle(imagen, (x1, y1), (x2, y2), color, grosor, cv2.LINE_AA)
+            texto = f"{self.names.get(clase, clase)} {deteccion.conf.item():.2f}"
+            cv2.putText(imagen, texto, (x1, max(y1 - 4, 12)), cv2.FONT_HERSHEY_SIMPLEX, grosor / 3, color, max(grosor - 1, 1), cv2.LINE_AA)
+        return imagen
+
+class ModeloONNX:
+    """
+    Modelo de detección exportado por ultralytics a ONNX, corrido con ONNX Runtime en CPU.
+
+    Implementa lo que el resto del worker usa de un modelo YOLO: 'names' y 'predict(frames, conf)',
+    que retorna un 'ResultadoONNX' por frame. El preprocesamiento (letterbox) y el NMS siguen los de
+    ultralytics, así las clases y confianzas coinciden con las del modelo de torch.
+    """
+
+    def __init__(self, ruta: str):
+        import onnxruntime as ort
+        opciones = ort.SessionOptions()
+        if hilos > 0:
+            opciones.intra_op_num_threads = hilos
+        opciones.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.sesion = ort.InferenceSession(ruta, sess_options=opciones, providers=['CPUExecutionProvider'])
+        self.entrada = self.sesion.get_inputs()[0].name
+
+        metadatos = self.sesion.get_modelmeta().custom_metadata_map
+        self.names = ast.literal_eval(metadatos['names']) if 'names' in metadatos else {}
+        imgsz = ast.literal_eval(metadatos['imgsz']) if 'imgsz' in metadatos else [640, 640]
+        self.tamano = tuple(imgsz) if isinstance(imgsz, (list, tuple)) else (imgsz, imgsz)
+        forma = self.sesion.get_inputs()[0].shape
+        # Con batch fijo se corre de a una imagen
+        self.batch_dinamico = not isinstance(forma[0], int)
+
+    def preprocesar(self, frames: list) -> tuple[np.ndarray, list]:
+        lote = []
+        transformaciones = []
+        for frame in frames:
+            imagen, escala, relleno = letterbox(frame, self.tamano)
+            lote.append(imagen[:, :, ::-1].transpose(2, 0, 1)) # BGR -> RGB, HWC -> CHW
+            transformaciones.append((escala, relleno))
+        lote = np.ascontiguousarray(np.stack(lote), dtype=np.float32) / 255.0
+        return lote, transformaciones
+
+    def _postprocesar(self, salida: np.ndarray, frame: np.ndarray, escala: float, relleno: tuple, conf: float) -> ResultadoONNX:
+        # salida: (4 + clases, candidatos) con cajas (cx, cy, w, h) en coordenadas del letterbox
+        salida = salida.T
+        puntajes_clase = salida[:, 4:]
+        clases = puntajes_clase.argmax(axis=1)
+        puntajes = puntajes_clase[np.arange(len(clases)), clases]
+        filtro = puntajes > conf
+        salida, clases, puntajes = salida[filtro], clases[filtro], puntajes[filtro]
+
+        cajas = np.empty((len(salida), 4), dtype=np.float32)
+        cajas[:, 0] = salida[:, 0] - salida[:, 2] / 2
+        cajas[:, 1] = salida[:, 1] - salida[:, 3] / 2
+        cajas[:, 2] = salida[:, 0] + salida[:, 2] / 2
+        cajas[:, 3] = salida[:, 1] + salida[:, 3] / 2
+
+        # NMS por clase: se desplazan las cajas de cada clase para que no se crucen con las de otra
+        desplazadas = cajas + clases[:, None].astype(np.float32) * 7680
+        conservar = nms(desplazadas, puntajes, iou_nms)[:max_detecciones]
+        cajas, puntajes, clases = cajas[conservar], puntajes[conservar], clases[conservar]
+
+        cajas[:, [0, 2]] -= relleno[0]
+        cajas[:, [1, 3]] -= relleno[1]
+        cajas /= escala
+        alto, ancho = frame.shape[:2]
+        cajas[:, [0, 2]] = cajas[:, [0, 2]].clip(0, ancho)
+        cajas[:, [1, 3]] = cajas[:, [1, 3]].clip(0, alto)
+        return ResultadoONNX(frame, cajas, puntajes, clases, self.names)
+
+    def predict(self, frames: list, conf: float = 0.25, **_) -> list[ResultadoONNX]:
+        """
+        Corre el modelo sobre 'frames' (imágenes BGR) y retorna un resultado por frame, en el mismo orden.
+        """
+        if not frames:
+            return []
+        entrada, transformaciones = self.preprocesar(frames)
+        if self.batch_dinamico:
+            salidas = self.sesion.run(None, {self.entrada: entrada})[0]
+        else:
+            salidas = np.concatenate([self.sesion.run(None, {self.entrada: entrada[i:i + 1]})[0] for i in range(len(frames))])
+        return [
+            self._postprocesar(salida, frame, escala, relleno, conf)
+            for salida, frame, (escala, relleno) in zip(salidas, frames, transformaciones)
+        ]
+
+def iou_cajas(a: np.ndarray, b: np.ndarray) -> float:
+    x1, y1 = max(a[0], b[0]), max(a[1], b[1])
+    x2, y2 = min(a[2], b[2]), min(a[3], b[3])
+    interseccion = max(x2 - x1, 0) * max(y2 - y1, 0)
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - interseccion
+    return interseccion / union if union > 0 else 0.0
+
+def comparar(ruta_pt: str, carpeta: str, confianza: float = 0.25, iou_minimo: float = 0.9, tolerancia: float = 0.02) -> bool:
+    """
+    Compara las detecciones del modelo de torch ('ruta_pt') y de su exportación ONNX sobre las imágenes
+    de 'carpeta': cada detección de torch debe tener una de ONNX de la misma clase, con IoU >= 'iou_minimo'
+    y confianza a menos de 'tolerancia', y viceversa. Imprime las diferencias y retorna True si no hay.
+    """
+    from ultralytics import YOLO
+    modelo_torch = YOLO(ruta_pt)
+    modelo_onnx = ModeloONNX(onnx_actualizado(ruta_pt))
+    if [modelo_torch.names[k] for k in sorted(modelo_torch.names)] != [modelo_onnx.names[k] for k in sorted(modelo_onnx.names)]:
+        print(f"Las clases no coinciden: {modelo_torch.names} / {modelo_onnx.names}")
+        return False
+
+    imagenes = sorted(f for f in os.listdir(carpeta) if f.lower().endswith(('.jpg', '.jpeg', '.png')))
+    diferencias = 0
+    tiempos = {'torch': 0.0, 'onnx': 0.0}
+    for nombre in imagenes:
+        frame = cv2.imread(os.path.join(carpeta, nombre))
+        if frame is None:
+            continue
+        inicio = time.perf_counter()
+        r_torch = modelo_torch.predict([frame], conf=confianza, device='cpu', verbose=False)[0]
+        tiempos['torch'] += time.perf_counter() - inicio
+        inicio = time.perf_counter()
+        r_onnx = modelo_onnx.predict([frame], conf=confianza)[0]
+        tiempos['onnx'] += time.perf_counter() - inicio
+
+        a = [(int(d.cls.item()), float(d.conf.item()), np.asarray(d.xyxy[0].tolist())) for d in r_torch.boxes]
+        b = [(int(d.cls.item()), float(d.conf.item()), np.asarray(d.xyxy[0].tolist())) for d in r_onnx.boxes]
+        for origen, propias, otras in (('torch', a, b), ('onnx', b, a)):
+            for clase, puntaje, caja in propias:
+                pareja = any(
+                    c == clase and abs(p - puntaje) <= tolerancia and iou_cajas(caja, k) >= iou_minimo
+                    for c, p, k in otras
+                )
+                if not pareja:
+                    diferencias += 1
+                    print(f"{nombre}: detección de {origen} sin pareja: {modelo_torch.names[clase]} {puntaje:.3f} {caja.round(1).tolist()}")
+
+    n = max(len(imagenes), 1)
+    print(f"{len(imagenes)} imágenes, {diferencias} diferencias. "
+          f"Tiempo medio: torch {tiempos['torch'] / n * 1000:.1f} ms, onnx {tiempos['onnx'] / n * 1000:.1f} ms.")
+    return diferencias == 0
+
+if __name__ == '__main__':
+    # python modelo_onnx.py exportar <pesos.pt>
+    # python modelo_onnx.py comparar <pesos.pt> <carpeta de imágenes>
+    if len(sys.argv) >= 3 and sys.argv[1] == 'exportar':
+        print(exportar(sys.argv[2]))
+    elif len(sys.argv) >= 4 and sys.argv[1] == 'comparar':
+        sys.exit(0 if comparar(sys.argv[2], sys.argv[3]) else 1)
+    else:
+        print("Uso: python modelo_onnx.py exportar <pesos.pt> | comparar <pesos.pt> <carpeta>")
+        sys.exit(2)
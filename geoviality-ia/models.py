@@ -2,6 +2,20 @@ from pydantic import BaseModel
 from datetime import datetime
 from typing import Optional
 
+# Una detección de una imagen: clase, confianza (%) y caja [x_min, y_min, x_max, y_max] en píxeles
+class Deteccion(BaseModel):
+    clase: str
+    confianza: float
+    caja: list[float]
+
+# Detecciones de una imagen, con la versión del modelo que las hizo y el tamaño de la imagen
+# (el de la imagen guardada en el almacenamiento, así la API dibuja las cajas sin reescalar)
+class DeteccionesImagen(BaseModel):
+    modelo: str
+    ancho: int
+    alto: int
+    cajas: list[Deteccion]
+
 class PhotoInfo(BaseModel):
     id: str
     latitude: float
@@ -10,15 +24,27 @@ class PhotoInfo(BaseModel):
     type: list[str]
     modo: str 
     user: str
+    detecciones: Optional[DeteccionesImagen] = None
 
 class PhotoDB(PhotoInfo): 
     repair_at: Optional[datetime] = None
     estado: int
     observaciones: str
 
-class PhotoSend(BaseModel):
-    image: str
+# Mensaje de la cola de videos, igual al 'VideoQueue' que publica la API. La fecha se lee con pydantic
+# porque la API la escribe con 'Z' para UTC, que 'datetime.fromisoformat' no acepta en Python 3.10
+class VideoQueue(BaseModel):
+    id: str
+    key: str
+    track: list[list[float]]
+    date: datetime
+    modo: str
+    user: str
+
+# Aviso a la API de que la imagen 'id' ya está en el almacenamiento bajo 'key'
+class PhotoReady(BaseModel):
     id: str
+    key: str
 
 # Propiedades GeoJSON
 class Properties(BaseModel):
@@ -32,6 +58,7 @@ class Properties(BaseModel):
     estado: int
     observaciones: str
     last_update: datetime
+    detecciones: dict[str, DeteccionesImagen] = {} # id de imagen -> sus detecciones
 
 # Geometry GeoJSON
 class Geometry(BaseModel):
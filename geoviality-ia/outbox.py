@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+import metricas
+
+# Archivo SQLite con los avisos pendientes (queda en 'imgs', que está montado desde el host)
+ruta_outbox = os.getenv('IA_OUTBOX_RUTA', os.path.join(os.getcwd(), 'imgs', 'outbox.db'))
+# Cuantos avisos se mandan como máximo en una petición
+tamano_lote = int(os.getenv('IA_OUTBOX_LOTE', 50))
+# Espera entre reintentos: crece al doble desde 'IA_OUTBOX_ESPERA_MIN_SEG' hasta 'IA_OUTBOX_ESPERA_MAX_SEG'
+espera_min = float(os.getenv('IA_OUTBOX_ESPERA_MIN_SEG', 1))
+espera_max = float(os.getenv('IA_OUTBOX_ESPERA_MAX_SEG', 60))
+timeout = float(os.getenv('IA_OUTBOX_TIMEOUT_SEG', 10))
+# Cada cuanto se revisa el archivo si no hubo avisos nuevos en este proceso (los de otros procesos no despiertan al hilo)
+intervalo_revision = float(os.getenv('IA_OUTBOX_REVISION_SEG', 1))
+# Si la API no tiene la ruta de lotes, se envía de a uno y se vuelve a probar pasado este tiempo
+intervalo_lotes = float(os.getenv('IA_OUTBOX_REPROBAR_LOTES_SEG', 300))
+
+# Respuestas a la ruta de lotes que indican que la API no la tiene
+SIN_RUTA_LOTES = (404, 405)
+
+class ErrorDefinitivo(Exception):
+    """
+    La API rechazó el aviso (4xx): reintentarlo no sirve.
+    """
+
+    def __init__(self, mensaje: str, codigo: int):
+        super().__init__(mensaje)
+        self.codigo = codigo
+
+class Outbox:
+    """
+    Avisos pendientes de la IA a la API, guardados en SQLite.
+
+    'encolar' solo escribe el aviso en el archivo (que es lo que se espera antes de confirmar el mensaje
+    en RabbitMQ), así una API lenta o caída no frena la inferencia y un reinicio de la IA no pierde nada.
+    Un hilo aparte ('iniciar_envio', uno solo por worker) manda los avisos en orden, juntando varios por
+    petición sobre una sesión HTTP con conexiones persistentes, y los borra cuando la API los recibió.
+    Si la API falla reintenta con espera exponencial y jitter. Los que la API rechaza con un 4xx quedan
+    en el archivo marcados como fallidos, con el error, para revisarlos a mano.
+    """
+
+    def __init__(self, ruta: str, url: str):
+        self.url = url
+        os.makedirs(os.path.dirname(ruta) or '.', exist_ok=True)
+        self._conexion = sqlite3.connect(ruta, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conexion.execute("PRAGMA journal_mode=WAL")
+        self._conexion.execute(
+            "CREATE TABLE IF NOT EXISTS avisos ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " ruta TEXT NOT NULL,"
+            " cuerpo TEXT NOT NULL,"
+            " creado REAL NOT NULL,"
+            " intentos INTEGER NOT NULL DEFAULT 0,"
+            " fallido INTEGER NOT NULL DEFAULT 0,"
+            " error TEXT)"
+        )
+        self._lock = threading.Lock()
+        self._hay_nuevos = threading.Event()
+        self._hilo = None
+        self._sin_lotes_hasta = 0.0 # Hasta cuando se envía de a uno (API sin la ruta de lotes)
+
+    def encolar(self, ruta: str, datos: dict):
+        """
+        Guarda un aviso para 'ruta' de la API (por ejemplo '/data/processed_image/ready') con 'datos' como cuerpo JSON.
+        """
+        with self._lock:
+            self._conexion.execute(
+                "INSERT INTO avisos (ruta, cuerpo, creado) VALUES (?, ?, ?)",
+                (ruta, json.dumps(datos, default=str), time.time())
+            )
+        self._hay_nuevos.set()
+
+    def pendientes(self) -> int:
+        with self._lock:
+            return self._conexion.execute("SELECT COUNT(*) FROM avisos WHERE fallido = 0").fetchone()[0]
+
+    def iniciar_envio(self):
+        """
+        Inicia el hilo que manda los avisos a la API (si no estaba iniciado).
+        """
+        if self._hilo is None:
+            self._sesion = requests.Session()
+            self._sesion.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
+            self._sesion.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=2))
+            self._hilo = threading.Thread(target=self._ciclo, name='outbox', daemon=True)
+            self._hilo.start()
+            print(f"    - [IA] Envío de avisos a la API iniciado ({self.pendientes()} pendientes).")
+
+    def _siguientes(self) -> list[tuple]:
+        with self._lock:
+            primero = self._conexion.execute(
+                "SELECT ruta FROM avisos WHERE fallido = 0 ORDER BY id LIMIT 1"
+            ).fetchone()
+            if primero is None:
+                return []
+            return self._conexion.execute(
+                "SELECT id, ruta, cuerpo FROM avisos WHERE fallido = 0 AND ruta = ? ORDER BY id LIMIT ?",
+                (primero[0], tamano_lote if time.monotonic() >= self._sin_lotes_hasta else 1)
+            ).fetchall()
+
+    def _borrar(self, ids: list[int]):
+        with self._lock:
+            self._conexion.executemany("DELETE FROM avisos WHERE id = ?", [(i,) for i in ids])
+
+    def _marcar(self, ids: list[int], error: str | None = None):
+        with self._lock:
+            self._conexion.executemany(
+                "UPDATE avisos SET intentos = intentos + 1, fallido = ?, error = ? WHERE id = ?",
+                [(int(error is not None), error, i) for i in ids]
+            )
+
+    def _post(self, ruta: str, cuerpo) -> requests.Response:
+        respuesta = self._sesion.post(f'{self.url}{ruta}', json=cuerpo, timeout=timeout)
+        if 400 <= respuesta.status_code < 500 and respuesta.status_code not in (408, 429):
+            raise ErrorDefinitivo(f"{respuesta.status_code}: {respuesta.text[:200]}", respuesta.status_code)
+        respuesta.raise_for_status()
+        return respuesta
+
+    def _enviar(self, avisos: list[tuple]):
+        """
+        Manda 'avisos' (todos de la misma ruta). Lanza una excepción si hay que reintentarlos.
+        """
+        ruta = avisos[0][1]
+        if len(avisos) > 1:
+            try:
+                respuesta = self._post(f'{ruta}/batch', [json.loads(cuerpo) for _, _, cuerpo in avisos])
+            except ErrorDefinitivo as e:
+                if e.codigo in SIN_RUTA_LOTES:
+                    print(f"    - [IA] La API no acepta avisos por lotes ({e}), se envían de a uno por {intervalo_lotes:.0f} s.")
+                    self._sin_lotes_hasta = time.monotonic() + intervalo_lotes
+                    return
+                # El lote completo fue rechazado (por ejemplo, un aviso inválido): estos se mandan de a
+                # uno para marcar solo los que la API rechaza, y el siguiente lote vuelve a ir junto
+                print(f"    - [IA] La API rechazó el lote de {len(avisos)} avisos ({e}), se envían de a uno.")
+                for aviso in avisos:
+                    self._enviar_uno(aviso)
+                return
+            errores = respuesta.json().get('errores', {})
+            fallidos = []
+            for id, _, cuerpo in avisos:
+                error = errores.get(json.loads(cuerpo).get('id'))
+                if error is not None:
+                    print(f"    - [IA] La API rechazó el aviso {id}: {error}")
+                    self._marcar([id], str(error))
+                    fallidos.append(id)
+            self._borrar([id for id, _, _ in avisos if id not in fallidos])
+            print(f"    - [IA] {len(avisos) - len(fallidos)} avisos enviados a la API.")
+            return
+        self._enviar_uno(avisos[0])
+
+    def _enviar_uno(self, aviso: tuple):
+        id, ruta, cuerpo = aviso
+        try:
+            self._post(ruta, json.loads(cuerpo))
+        except ErrorDefinitivo as e:
+            print(f"    - [IA] La API rechazó el aviso {id}: {e}")
+            self._marcar([id], str(e))
+            return
+        self._borrar([id])
+        print(f"    - [IA] Aviso {id} enviado a la API.")
+
+    def _ciclo(self):
+        fallos = 0
+        while True:
+            avisos = self._siguientes()
+            if not avisos:
+                self._hay_nuevos.wait(intervalo_revision)
+                self._hay_nuevos.clear()
+                continue
+            try:
+                with metricas.medir('envio_api'):
+                    self._enviar(avisos)
+                fallos = 0
+            except Exception as e:
+                self._marcar([id for id, _, _ in avisos])
+                fallos += 1
+                espera = min(espera_max, espera_min * 2 ** (fallos - 1))
+                espera = random.uniform(espera / 2, espera)
+                print(f"    - [IA] Error al enviar {len(avisos)} avisos a la API: {e}. Reintentando en {espera:.1f} s...")
+                time.sleep(espera)
+
+_outboxes = {}
+_lock = threading.Lock()
+
+def outbox_en(ruta: str, url: str) -> Outbox:
+    """
+    Retorna el outbox del proceso para el archivo 'ruta' (lo crea la primera vez).
+    """
+    with _lock:
+        if ruta not in _outboxes:
+            _outboxes[ruta] = Outbox(ruta, url)
+        return _outboxes[ruta]
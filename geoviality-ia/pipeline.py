@@ -0,0 +1,176 @@
+import os
+import json
+import queue
+import threading
+import functools
+import time
+import ia_predictor as ia
+from imagenes import decodificar_imagen
+from funcs import finalizar_imagen
+import metricas
+import colas
+import idempotencia
+
+# Hilos por etapa
+hilos_decodificacion = int(os.getenv('IA_PIPELINE_DECODIFICACION', 2))
+hilos_inferencia = int(os.getenv('IA_PIPELINE_INFERENCIA', 1))
+hilos_persistencia = int(os.getenv('IA_PIPELINE_PERSISTENCIA', 4))
+hilos_notificacion = int(os.getenv('IA_PIPELINE_NOTIFICACION', 4))
+
+class Pipeline:
+    """
+    Procesa los mensajes de las colas de imágenes en etapas, cada una con sus propios hilos
+    y unidas por colas acotadas:
+
+        recepción (hilo de pika) -> decodificación -> inferencia -> BD (irregularidad y calle) -> notificación a la API
+
+    Así una BD o una API lenta no frenan la inferencia, y el hilo de pika queda libre para los heartbeats.
+    Los acks se devuelven al hilo de la conexión con 'add_callback_threadsafe'.
+
+    Las escrituras a la BD se juntan en lotes ('escritura_mongo'): la etapa de BD encola las de cada imagen
+    y otros hilos esperan a que su lote quede escrito antes de pasarla a la notificación, así el hilo que
+    escribe los lotes nunca queda esperando a una etapa llena.
+    """
+
+    def __init__(self, connection, channel, confianza, path_post: str, path_csv: str, tamano_lote: int, tamano_colas: int, guardar_pre=None):
+        self.connection = connection
+        self.channel = channel
+        self.confianza = confianza
+        self.path_post = path_post
+        self.path_csv = path_csv
+        self.tamano_lote = tamano_lote
+        self.guardar_pre = guardar_pre
+        self.cola_decodificacion = queue.Queue(maxsize=tamano_colas)
+        self.cola_inferencia = queue.Queue(maxsize=tamano_colas)
+        self.cola_persistencia = queue.Queue(maxsize=tamano_colas)
+        # Sin límite: lo que hay en vuelo ya lo acota el prefetch, y quien encola no puede quedar esperando
+        self.cola_escrituras = queue.Queue()
+        self.cola_notificacion = queue.Queue(maxsize=tamano_colas)
+        metricas.observar_cola('decodificacion', self.cola_decodificacion.qsize)
+        metricas.observar_cola('inferencia', self.cola_inferencia.qsize)
+        metricas.observar_cola('persistencia', self.cola_persistencia.qsize)
+        metricas.observar_cola('escrituras', self.cola_escrituras.qsize)
+        metricas.observar_cola('notificacion', self.cola_notificacion.qsize)
+
+        etapas = [
+            ('decodificacion', self._decodificar, hilos_decodificacion),
+            ('inferencia', self._inferir, hilos_inferencia),
+            ('persistencia', self._persistir, hilos_persistencia),
+            ('escritura', self._esperar_escritura, hilos_persistencia),
+            ('notificacion', self._notificar, hilos_notificacion),
+        ]
+        for nombre, objetivo, cantidad in etapas:
+            for i in range(max(1, cantidad)):
+                threading.Thread(target=self._etapa, args=(nombre, objetivo), name=f"{nombre}-{i}", daemon=True).start()
+
+    # Confirmaciones (siempre en el hilo de la conexión)
+
+    def _ack(self, mensaje: dict):
+        self.connection.add_callback_threadsafe(
+            functools.partial(self.channel.basic_ack, delivery_tag=mensaje['tag'])
+        )
+        metricas.mensajes.labels('ok').inc()
+
+    def _nack(self, mensaje: dict):
+        # Se devuelve a la cola una sola vez; si ya venía reentregado se descarta
+        self.connection.add_callback_threadsafe(
+            functools.partial(self.channel.basic_nack, delivery_tag=mensaje['tag'], requeue=not mensaje['redelivered'])
+        )
+        metricas.mensajes.labels('error').inc()
+
+    # Etapas
+
+    def recibir(self, ch, method, properties, body):
+        """
+        Callback de pika: solo encola el mensaje para la etapa de decodificación.
+        """
+        self.cola_decodificacion.put({'tag': method.delivery_tag, 'redelivered': method.redelivered, 'body': body})
+
+    def _etapa(self, nombre: str, objetivo):
+        while True:
+            try:
+                objetivo()
+            except Exception as e:
+                print(f"    - [IA] Error inesperado en la etapa de {nombre}: {e}")
+
+    def _fallar(self, mensajes: list[dict], etapa: str, error: Exception):
+        for mensaje in mensajes:
+            print(f"    - [IA] Error en la etapa de {etapa} de la imagen '{mensaje.get('data', {}).get('id')}': {error}")
+            self._nack(mensaje)
+
+    def _decodificar(self):
+        mensaje = self.cola_decodificacion.get()
+        try:
+            data = json.loads(mensaje.pop('body'))
+            image = data.pop('image').encode('latin1')
+            mensaje['data'] = data
+            mensaje['image'] = image
+            mensaje['path'] = self.guardar_pre(data, image) if self.guardar_pre else None
+            inicio = time.perf_counter()
+            # Un mensaje reentregado que ya se infirió no se decodifica ('inferir_lote' usa el resultado guardado)
+            ya_inferida = mensaje['redelivered'] and idempotencia.inferencias_previas([data['id']])
+            mensaje['frame'] = None if ya_inferida else decodificar_imagen(image)
+            mensaje['t_decodificacion_ms'] = (time.perf_counter() - inicio) * 1000
+        except Exception as e:
+            self._fallar([mensaje], 'decodificacion', e)
+            return
+        self.cola_inferencia.put(mensaje)
+
+    def _inferir(self):
+        lote = [self.cola_inferencia.get()]
+        while len(lote) < self.tamano_lote:
+            try:
+                lote.append(self.cola_inferencia.get_nowait())
+            except queue.Empty:
+                break
+        items = [(m['frame'], self.path_post + m['data']['id'] + '.jpg', m['data']) for m in lote]
+        try:
+            resultados = ia.inferir_lote(items, self.path_csv, self.confianza, [m['t_decodificacion_ms'] for m in lote])
+        except Exception as e:
+            self._fallar(lote, 'inferencia', e)
+            return
+        for mensaje, result in zip(lote, resultados):
+            mensaje['frame'] = None
+            mensaje['result'] = result
+            self.cola_persistencia.put(mensaje)
+
+    def _persistir(self):
+        mensaje = self.cola_persistencia.get()
+        if mensaje['result'] is not False:
+            self.cola_notificacion.put(mensaje)
+            return
+        try:
+            futuro = ia.guardar_irregularidad(mensaje['data'])
+        except Exception as e:
+            self._fallar([mensaje], 'persistencia', e)
+            return
+        self.cola_escrituras.put((mensaje, futuro))
+
+    def _esperar_escritura(self):
+        # Pasa a la notificación recién cuando su lote de escrituras quedó en la BD
+        mensaje, futuro = self.cola_escrituras.get()
+        error = futuro.exception()
+        if error:
+            self._fallar([mensaje], 'persistencia', error)
+        else:
+            self.cola_notificacion.put(mensaje)
+
+    def _notificar(self):
+        mensaje = self.cola_notificacion.get()
+        try:
+            finalizar_imagen(mensaje['data'], mensaje['image'], mensaje['result'], mensaje['path'])
+        except Exception as e:
+            self._fallar([mensaje], 'notificacion', e)
+            return
+        self._ack(mensaje)
+
+def consumir_en_pipeline(connection, channel, pipeline: Pipeline, prefetch: int):
+    """
+    Consume las colas de imágenes pasando cada mensaje al pipeline.
+
+    El prefetch acota cuantos mensajes hay en vuelo entre todas las etapas.
+    """
+    colas.suscribir(channel, pipeline.recibir, prefetch)
+    print(f"    - [IA] Consumo en pipeline: {hilos_decodificacion} decodificación, {hilos_inferencia} inferencia, "
+          f"{hilos_persistencia} BD, {hilos_notificacion} notificación.")
+    channel.start_consuming()
@@ -0,0 +1,212 @@
+import os
+import sys
+import json
+import queue
+import multiprocessing as mp
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from imagenes import decodificar_imagen
+import metricas
+import colas
+import idempotencia
+import registro_modelos
+
+def repartir_nucleos(procesos: int) -> list[list[int]]:
+    """
+    Reparte los núcleos disponibles del proceso en 'procesos' tajadas contiguas.
+
+    Si hay menos núcleos que procesos, algunos procesos comparten núcleo.
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        nucleos = sorted(os.sched_getaffinity(0))
+    else:
+        nucleos = list(range(os.cpu_count() or 1))
+    if procesos >= len(nucleos):
+        return [[nucleos[i % len(nucleos)]] for i in range(procesos)]
+    por_proceso = len(nucleos) // procesos
+    tajadas = [nucleos[i * por_proceso:(i + 1) * por_proceso] for i in range(procesos)]
+    tajadas[-1].extend(nucleos[procesos * por_proceso:])
+    return tajadas
+
+def _adjuntar(nombre: str) -> SharedMemory:
+    # El bloque lo crea, registra y libera el consumidor. Con 'spawn' los procesos comparten su
+    # resource_tracker, que guarda los nombres en un conjunto: registrarlo de nuevo al adjuntarlo
+    # no cambia nada, pero quitarlo de ahí dejaría al consumidor sin limpieza si se cae.
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name=nombre, track=False)
+    return SharedMemory(name=nombre)
+
+def _cerrar(shm: SharedMemory):
+    try:
+        shm.close()
+    except BufferError:
+        # Aún hay vistas numpy vivas sobre el bloque; se cierra cuando las recoja el GC.
+        pass
+
+def _trabajador(indice, nucleos, tareas, resultados, modelos, confianza, path_post, path_csv, tamano_lote):
+    """
+    Proceso de inferencia: fija su afinidad de CPU y sus hilos de torch/ONNX Runtime, carga los modelos
+    y procesa por lotes los frames que el consumidor deja en memoria compartida.
+    """
+    import arranque
+    arranque.instalar_senales() # Para cerrar su log de detecciones cuando el proceso principal lo termina
+    if nucleos and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, nucleos)
+    import modelo_onnx
+    if registro_modelos.usa_torch(modelos):
+        import torch
+        torch.set_num_threads(max(1, len(nucleos)))
+    modelo_onnx.hilos = modelo_onnx.hilos or max(1, len(nucleos))
+    import ia_predictor as ia
+    from funcs import finalizar_imagen
+    from database import db
+    import indice_irregularidades
+    import indice_calles
+
+    print(f"    - [IA] Proceso de inferencia {indice} en núcleos {nucleos}")
+    metricas.iniciar_muestreo()
+    registro_modelos.cargar_modelos(modelos)
+    indice_irregularidades.iniciar(db.processed_geojson)
+    indice_calles.iniciar(db.streets)
+    resultados.put((None, indice)) # Aviso de proceso listo (ver 'esperar_listos')
+
+    while True:
+        lote = [tareas.get()]
+        while len(lote) < tamano_lote:
+            try:
+                lote.append(tareas.get_nowait())
+            except queue.Empty:
+                break
+
+        items = []
+        adjuntos = []
+        for tag, nombre, shape, dtype, largo, data in lote:
+            shm = _adjuntar(nombre)
+            frame = np.ndarray(shape, dtype=dtype, buffer=shm.buf) if shape else None
+            inicio = frame.nbytes if frame is not None else 0
+            image = bytes(shm.buf[inicio:inicio + largo])
+            items.append((frame, path_post + data['id'] + '.jpg', data))
+            adjuntos.append((tag, shm, data, image))
+        frame = None
+
+        try:
+            res, errores = ia.ia_lote(items, path_csv, confianza)
+        except Exception as e:
+            print(f"    - [IA] Error en el proceso de inferencia {indice}: {e}")
+            res = [None] * len(items)
+            errores = [e] * len(items)
+        items = None
+
+        for (tag, shm, data, image), result, error in zip(adjuntos, res, errores):
+            _cerrar(shm)
+            if error is None:
+                try:
+                    finalizar_imagen(data, image, result)
+                except Exception as e:
+                    print(f"    - [IA] Error al finalizar la imagen '{data['id']}': {e}")
+            else:
+                print(f"    - [IA] Error al guardar la imagen '{data['id']}' en la BD: {error}")
+            resultados.put((tag, error is None))
+
+class PoolInferencia:
+    """
+    Grupo de procesos de inferencia alimentado por el consumidor de RabbitMQ.
+
+    El consumidor decodifica cada imagen y la copia, junto con los bytes originales, a un bloque
+    de memoria compartida; a los procesos solo les llega el nombre del bloque y los metadatos.
+    """
+
+    def __init__(self, procesos: int, modelos: dict, confianza, path_post: str, path_csv: str, tamano_lote: int):
+        registro_modelos.preparar_exportaciones(modelos)
+        ctx = mp.get_context('spawn')
+        self.tareas = ctx.Queue()
+        self.resultados = ctx.Queue()
+        self.en_curso = {} # delivery_tag -> (SharedMemory, redelivered)
+        metricas.observar_cola('en_vuelo', lambda: len(self.en_curso))
+        self.procesos = []
+        for i, nucleos in enumerate(repartir_nucleos(procesos)):
+            p = ctx.Process(
+                target=_trabajador,
+                args=(i, nucleos, self.tareas, self.resultados, modelos, confianza, path_post, path_csv, tamano_lote),
+                daemon=True
+            )
+            p.start()
+            self.procesos.append(p)
+
+    def esperar_listos(self):
+        """
+        Espera a que todos los procesos de inferencia tengan sus modelos cargados y calentados.
+
+        Se llama antes de empezar a consumir, así los avisos de listo no se mezclan con los resultados.
+        """
+        pendientes = set(range(len(self.procesos)))
+        while pendientes:
+            try:
+                _, indice = self.resultados.get(timeout=1)
+                pendientes.discard(indice)
+            except queue.Empty:
+                pass
+            for i, p in enumerate(self.procesos):
+                if not p.is_alive():
+                    raise RuntimeError(f"El proceso de inferencia {i} terminó al arrancar (código {p.exitcode})")
+
+    def enviar(self, method, body):
+        """
+        Decodifica el mensaje, deja el frame y la imagen original en memoria compartida y
+        lo encola para los procesos de inferencia.
+        """
+        data = json.loads(body)
+        image = data.pop('image').encode('latin1')
+        # Un mensaje reentregado que ya se infirió no se decodifica ('inferir_lote' usa el resultado guardado)
+        ya_inferida = method.redelivered and idempotencia.inferencias_previas([data['id']])
+        frame = None if ya_inferida else decodificar_imagen(image)
+        tamano_frame = frame.nbytes if frame is not None else 0
+        shm = SharedMemory(create=True, size=max(1, tamano_frame + len(image)))
+        if frame is not None:
+            np.ndarray(frame.shape, dtype=frame.dtype, buffer=shm.buf)[:] = frame
+        shm.buf[tamano_frame:tamano_frame + len(image)] = image
+        self.en_curso[method.delivery_tag] = (shm, method.redelivered)
+        self.tareas.put((
+            method.delivery_tag,
+            shm.name,
+            frame.shape if frame is not None else None,
+            str(frame.dtype) if frame is not None else None,
+            len(image),
+            data
+        ))
+
+    def confirmar_terminados(self, channel):
+        """
+        Confirma en RabbitMQ los mensajes que los procesos ya terminaron y libera su memoria compartida.
+
+        Si un mensaje falló se devuelve a la cola una vez; si ya venía reentregado se descarta.
+        """
+        while True:
+            try:
+                tag, ok = self.resultados.get_nowait()
+            except queue.Empty:
+                break
+            shm, redelivered = self.en_curso.pop(tag)
+            shm.close()
+            shm.unlink()
+            if ok:
+                channel.basic_ack(delivery_tag=tag)
+            else:
+                channel.basic_nack(delivery_tag=tag, requeue=not redelivered)
+            metricas.mensajes.labels('ok' if ok else 'error').inc()
+
+        for i, p in enumerate(self.procesos):
+            if not p.is_alive():
+                raise RuntimeError(f"El proceso de inferencia {i} terminó inesperadamente (código {p.exitcode})")
+
+def consumir_con_procesos(connection, channel, pool: PoolInferencia, prefetch: int):
+    """
+    Consume las colas de imágenes repartiendo los mensajes entre los procesos de inferencia.
+
+    Los acks se hacen siempre desde este hilo, que es el dueño de la conexión.
+    """
+    colas.suscribir(channel, lambda ch, method, properties, body: pool.enviar(method, body), prefetch)
+    print(f"    - [IA] Consumo con {len(pool.procesos)} procesos de inferencia.")
+    while True:
+        connection.process_data_events(time_limit=0.05)
+        pool.confirmar_terminados(channel)
@@ -0,0 +1,315 @@
+"""
+Reagrupamiento offline de los puntos de 'processed_geojson' que son la misma irregularidad.
+
+'procesar' agrega cada imagen al primer punto que encuentra a menos de 10 m, así que el resultado depende
+del orden de llegada: una misma irregularidad puede quedar repartida en varios puntos, y cada uno suma en
+los contadores de su calle. Este script carga todos los puntos en arreglos de NumPy y los agrupa como
+DBSCAN con un mínimo de 1 punto (componentes conexas de "a menos de --distancia metros"), por tipo de
+irregularidad: dos puntos se unen si comparten algún tipo, tienen el mismo 'estado' y están a menos de
+la distancia. Los pares candidatos salen de una grilla de celdas del tamaño de la distancia.
+
+De cada grupo queda el punto más antiguo (entre los que tienen calle, si hay): se le agregan las imágenes,
+tipos y detecciones de los demás, que se borran, y se corrigen los contadores de las calles.
+
+    python reagrupar.py --simular --salida plan.json
+    python reagrupar.py
+
+Los workers siguen los borrados con change streams (ver 'indice_irregularidades'), así que no hace
+falta detenerlos; las imágenes que lleguen a un punto mientras se borra se pierden, así que conviene
+correrlo con poco tráfico.
+"""
+import json
+import time
+import uuid
+import argparse
+from datetime import datetime
+
+import dotenv
+import numpy as np
+
+dotenv.load_dotenv()
+
+from pymongo import UpdateOne, UpdateMany, DeleteMany
+from indice_irregularidades import RADIO_TIERRA_M, METROS_POR_GRADO
+from reprocesar import calles_de_puntos, TAMANO_ESCRITURA
+
+# Para que la marca de cada grupo en sus calles sea la misma si el script se repite
+ESPACIO_GRUPOS = uuid.UUID('5b0c7a57-3f0e-4d8e-9a51-7a1f3c2d9e40')
+# Latitud máxima que se considera al calcular el ancho de las celdas (en los polos el ancho no tiene límite)
+LATITUD_MAXIMA = 85.0
+
+def argumentos(argv=None):
+    parser = argparse.ArgumentParser(description="Reagrupamiento offline de puntos duplicados de 'processed_geojson'")
+    parser.add_argument('--distancia', type=float, default=10.0, help="Distancia máxima en metros entre puntos del mismo grupo")
+    parser.add_argument('--simular', action='store_true', help="Solo informa los grupos que se unirían, sin escribir")
+    parser.add_argument('--salida', help="Archivo donde guardar el plan JSON")
+    return parser.parse_args(argv)
+
+def cargar_puntos(db) -> dict:
+    """
+    Carga los puntos en arreglos: 'ids' (lista), 'lon', 'lat', 'estado', 'fecha' (segundos) y 'tipos' (lista de listas).
+    """
+    ids, lon, lat, estado, fecha, tipos = [], [], [], [], [], []
+    proyeccion = {"geometry.coordinates": 1, "properties.type": 1, "properties.estado": 1, "properties.date": 1}
+    for punto in db.processed_geojson.find({}, proyeccion):
+        try:
+            x, y = punto["geometry"]["coordinates"][:2]
+        except (KeyError, TypeError, ValueError):
+            continue
+        propiedades = punto.get("properties", {})
+        tipo = propiedades.get("type") or []
+        ids.append(punto["_id"])
+        lon.append(x)
+        lat.append(y)
+        estado.append(propiedades.get("estado", 0))
+        fecha.append(propiedades["date"].timestamp() if isinstance(propiedades.get("date"), datetime) else 0.0)
+        tipos.append([tipo] if isinstance(tipo, str) else list(tipo))
+    return {
+        'ids': ids,
+        'lon': np.asarray(lon, dtype=np.float64),
+        'lat': np.asarray(lat, dtype=np.float64),
+        'estado': np.asarray(estado, dtype=np.int64),
+        'fecha': np.asarray(fecha, dtype=np.float64),
+        'tipos': tipos,
+    }
+
+def haversine(lon1, lat1, lon2, lat2) -> np.ndarray:
+    p1, p2 = np.radians(lat1), np.radians(lat2)
+    a = np.sin((p2 - p1) / 2) ** 2 + np.cos(p1) * np.cos(p2) * np.sin(np.radians(lon2 - lon1) / 2) ** 2
+    return 2 * RADIO_TIERRA_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def _pares_entre(inicio_a, cantidad_a, inicio_b, cantidad_b) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Todos los pares (i, j) entre las filas de cada celda 'a' y las de su celda 'b' (filas ordenadas por celda).
+    """
+    por_par = cantidad_a * cantidad_b
+    total = int(por_par.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    celda = np.repeat(np.arange(len(por_par)), por_par)
+    local = np.arange(total) - np.repeat(np.cumsum(por_par) - por_par, por_par)
+    return inicio_a[celda] + local // cantidad_b[celda], inicio_b[celda] + local % cantidad_b[celda]
+
+def aristas(puntos: dict, distancia: float) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Retorna los pares de índices de puntos (u, v) que comparten un tipo, tienen el mismo 'estado'
+    y están a menos de 'distancia' metros.
+
+    Cada punto aparece una vez por tipo. Las filas se ordenan por (tipo, estado, celda) y los candidatos
+    de cada celda salen de ella misma y de 4 vecinas (las otras 4 quedan cubiertas desde el otro lado).
+    Las celdas tienen 'distancia' metros de alto y, de ancho, 'distancia' metros en la latitud más
+    alejada del ecuador de los datos, así que en ninguna parte son más angostas que la distancia.
+    """
+    filas_punto = np.repeat(np.arange(len(puntos['tipos'])), [len(t) for t in puntos['tipos']])
+    if len(filas_punto) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    _, tipo = np.unique([tipo for tipos in puntos['tipos'] for tipo in tipos], return_inverse=True)
+    _, estado = np.unique(puntos['estado'][filas_punto], return_inverse=True)
+    grupo = tipo.astype(np.int64) * (estado.max() + 1) + estado
+
+    lon = puntos['lon'][filas_punto]
+    lat = puntos['lat'][filas_punto]
+    dlat = distancia / METROS_POR_GRADO
+    latitud_maxima = min(float(np.abs(lat).max()) + dlat, LATITUD_MAXIMA)
+    dlon = dlat / np.cos(np.radians(latitud_maxima))
+    fila = np.floor(lat / dlat).astype(np.int64)
+    columna = np.floor(lon / dlon).astype(np.int64)
+    fila -= fila.min() - 1
+    columna -= columna.min() - 1
+    alto = int(fila.max()) + 2
+    ancho = int(columna.max()) + 2
+    clave = (grupo * ancho + columna) * alto + fila
+
+    orden = np.argsort(clave, kind='stable')
+    clave = clave[orden]
+    filas_punto = filas_punto[orden]
+    celdas, inicio, cantidad = np.unique(clave, return_index=True, return_counts=True)
+
+    u, v = [], []
+    for dcolumna, dfila in ((0, 0), (0, 1), (1, -1), (1, 0), (1, 1)):
+        vecina = celdas + dcolumna * alto + dfila
+        posicion = np.minimum(np.searchsorted(celdas, vecina), len(celdas) - 1)
+        existe = celdas[posicion] == vecina
+        a, b = _pares_entre(inicio[existe], cantidad[existe], inicio[posicion[existe]], cantidad[posicion[existe]])
+        if dcolumna == 0 and dfila == 0:
+            distintos = a < b # Dentro de la misma celda, cada par una sola vez
+            a, b = a[distintos], b[distintos]
+        a, b = filas_punto[a], filas_punto[b]
+        cerca = (a != b) & (haversine(puntos['lon'][a], puntos['lat'][a], puntos['lon'][b], puntos['lat'][b]) <= distancia)
+        u.append(a[cerca])
+        v.append(b[cerca])
+    return np.concatenate(u), np.concatenate(v)
+
+def componentes(cantidad: int, u: np.ndarray, v: np.ndarray) -> np.ndarray:
+    """
+    Etiqueta de componente conexa de cada punto (el menor índice de su componente), propagando
+    el mínimo por las aristas y acortando caminos hasta que no cambie.
+    """
+    etiquetas = np.arange(cantidad)
+    while True:
+        anteriores = etiquetas.copy()
+        np.minimum.at(etiquetas, u, etiquetas[v])
+        np.minimum.at(etiquetas, v, etiquetas[u])
+        etiquetas = etiquetas[etiquetas]
+        if np.array_equal(etiquetas, anteriores):
+            return etiquetas
+
+def grupos(puntos: dict, etiquetas: np.ndarray, con_calle: np.ndarray) -> list[list[int]]:
+    """
+    Retorna los grupos de más de un punto como listas de índices, con el que se conserva primero:
+    el más antiguo entre los que tienen calle (o entre todos, si ninguno tiene).
+    """
+    orden = np.lexsort((np.arange(len(etiquetas)), puntos['fecha'], ~con_calle, etiquetas))
+    etiquetas_ordenadas = etiquetas[orden]
+    cortes = np.flatnonzero(np.diff(etiquetas_ordenadas)) + 1
+    return [g.tolist() for g in np.split(orden, cortes) if len(g) > 1]
+
+def planificar(db, distancia: float) -> dict:
+    tiempos = {}
+    inicio = time.perf_counter()
+    puntos = cargar_puntos(db)
+    calles = calles_de_puntos(db)
+    tiempos['carga_s'] = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    con_calle = np.array([id in calles for id in puntos['ids']], dtype=bool)
+    u, v = aristas(puntos, distancia)
+    etiquetas = componentes(len(puntos['ids']), u, v)
+    lista = grupos(puntos, etiquetas, con_calle)
+    tiempos['agrupamiento_s'] = time.perf_counter() - inicio
+
+    plan = []
+    for indices in lista:
+        conservado, *absorbidos = indices
+        tipos = []
+        for i in indices:
+            tipos += [t for t in puntos['tipos'][i] if t not in tipos]
+        plan.append({
+            'conservado': puntos['ids'][conservado],
+            'absorbidos': [puntos['ids'][i] for i in absorbidos],
+            'tipos': tipos,
+            'tipos_por_punto': {puntos['ids'][i]: puntos['tipos'][i] for i in indices},
+            'distancia_max_m': float(haversine(
+                puntos['lon'][conservado], puntos['lat'][conservado],
+                puntos['lon'][absorbidos], puntos['lat'][absorbidos]
+            ).max()),
+        })
+    return {'puntos': len(puntos['ids']), 'aristas': int(len(u)), 'grupos': plan, 'calles': calles, 'tiempos': tiempos}
+
+def operaciones_calles(plan: list, calles: dict) -> list:
+    """
+    Por cada grupo y calle: resta los tipos de los puntos absorbidos que estaban en ella, los quita de
+    sus irregularidades y, en la calle del punto conservado, suma los tipos que este gana.
+
+    Cada operación deja una marca del grupo en 'properties.reagrupados' y no se aplica si ya la tiene.
+    """
+    ahora = datetime.now()
+    operaciones = []
+    for grupo in plan:
+        marca = str(uuid.uuid5(ESPACIO_GRUPOS, ','.join(sorted(grupo['absorbidos']))))
+        por_calle = {}
+        for id in grupo['absorbidos']:
+            calle = calles.get(id)
+            if calle is None:
+                continue
+            cambio = por_calle.setdefault(calle, {'incrementos': {}, 'quitar': []})
+            cambio['quitar'].append(id)
+            for tipo in {t.capitalize() for t in grupo['tipos_por_punto'][id]}:
+                cambio['incrementos'][f"properties.{tipo}"] = cambio['incrementos'].get(f"properties.{tipo}", 0) - 1
+        calle = calles.get(grupo['conservado'])
+        if calle is not None:
+            propios = {t.capitalize() for t in grupo['tipos_por_punto'][grupo['conservado']]}
+            cambio = por_calle.setdefault(calle, {'incrementos': {}, 'quitar': []})
+            for tipo in {t.capitalize() for t in grupo['tipos']} - propios:
+                cambio['incrementos'][f"properties.{tipo}"] = cambio['incrementos'].get(f"properties.{tipo}", 0) + 1
+        for calle, cambio in por_calle.items():
+            incrementos = {campo: n for campo, n in cambio['incrementos'].items() if n}
+            if not incrementos and not cambio['quitar']:
+                continue
+            actualizacion = {
+                '$addToSet': {'properties.reagrupados': marca},
+                '$set': {'properties.last_update': ahora},
+            }
+            if incrementos:
+                actualizacion['$inc'] = incrementos
+            if cambio['quitar']:
+                actualizacion['$pull'] = {'properties.images': {'$in': cambio['quitar']}}
+            operaciones.append(UpdateOne({'id': calle, 'properties.reagrupados': {'$ne': marca}}, actualizacion))
+    return operaciones
+
+def aplicar(db, plan: list, calles: dict) -> dict:
+    """
+    Escribe el plan: primero las calles (con su marca, así repetir el script no vuelve a restar),
+    luego los puntos conservados y al final borra los absorbidos.
+    """
+    ahora = datetime.now()
+    ops_calles = operaciones_calles(plan, calles)
+    for i in range(0, len(ops_calles), TAMANO_ESCRITURA):
+        db.streets.bulk_write(ops_calles[i:i + TAMANO_ESCRITURA], ordered=False)
+
+    ops_puntos = []
+    ops_reprocesos = []
+    absorbidos = []
+    for inicio in range(0, len(plan), TAMANO_ESCRITURA):
+        tramo = plan[inicio:inicio + TAMANO_ESCRITURA]
+        ids = [id for grupo in tramo for id in [grupo['conservado']] + grupo['absorbidos']]
+        documentos = {
+            p['_id']: p.get('properties', {})
+            for p in db.processed_geojson.find({'_id': {'$in': ids}}, {'properties.images': 1, 'properties.date': 1, 'properties.detecciones': 1})
+        }
+        for grupo in tramo:
+            miembros = [documentos[id] for id in [grupo['conservado']] + grupo['absorbidos'] if id in documentos]
+            imagenes = []
+            detecciones = {}
+            for propiedades in miembros:
+                imagenes += [imagen for imagen in propiedades.get('images', []) if imagen not in imagenes]
+                detecciones.update(propiedades.get('detecciones') or {})
+            asignar = {'properties.type': grupo['tipos'], 'properties.last_update': ahora}
+            fechas = [p['date'] for p in miembros if isinstance(p.get('date'), datetime)]
+            if fechas:
+                asignar['properties.date'] = min(fechas)
+            asignar.update({f"properties.detecciones.{imagen}": d for imagen, d in detecciones.items()})
+            ops_puntos.append(UpdateOne(
+                {'_id': grupo['conservado']},
+                {'$addToSet': {'properties.images': {'$each': imagenes}}, '$set': asignar}
+            ))
+            ops_reprocesos.append(UpdateMany({'punto': {'$in': grupo['absorbidos']}}, {'$set': {'punto': grupo['conservado']}}))
+            absorbidos += grupo['absorbidos']
+    for i in range(0, len(ops_puntos), TAMANO_ESCRITURA):
+        db.processed_geojson.bulk_write(ops_puntos[i:i + TAMANO_ESCRITURA], ordered=False)
+        db.reprocesos.bulk_write(ops_reprocesos[i:i + TAMANO_ESCRITURA], ordered=False)
+    for i in range(0, len(absorbidos), TAMANO_ESCRITURA):
+        db.processed_geojson.bulk_write([DeleteMany({'_id': {'$in': absorbidos[i:i + TAMANO_ESCRITURA]}})], ordered=False)
+    return {'calles': len(ops_calles), 'puntos_actualizados': len(ops_puntos), 'puntos_borrados': len(absorbidos)}
+
+def resumen(resultado: dict) -> dict:
+    plan = resultado['grupos']
+    por_tipo = {}
+    for grupo in plan:
+        for tipo in grupo['tipos']:
+            por_tipo[tipo] = por_tipo.get(tipo, 0) + 1
+    return {
+        'puntos': resultado['puntos'],
+        'pares_cercanos': resultado['aristas'],
+        'grupos': len(plan),
+        'puntos_absorbidos': sum(len(g['absorbidos']) for g in plan),
+        'grupos_por_tipo': por_tipo,
+        'mayores': sorted(plan, key=lambda g: len(g['absorbidos']), reverse=True)[:10],
+        'tiempos': {nombre: round(segundos, 3) for nombre, segundos in resultado['tiempos'].items()},
+    }
+
+if __name__ == '__main__':
+    args = argumentos()
+    from database import db
+    resultado = planificar(db, args.distancia)
+    informe = resumen(resultado)
+    if args.salida:
+        with open(args.salida, 'w') as f:
+            json.dump({**informe, 'plan': resultado['grupos']}, f, indent=2, ensure_ascii=False, default=str)
+    print(json.dumps({k: v for k, v in informe.items() if k != 'mayores'}, indent=2, ensure_ascii=False))
+    if args.simular:
+        print(f"    - [IA] Simulación: {informe['grupos']} grupos, {informe['puntos_absorbidos']} puntos se unirían (no se escribió nada).")
+    else:
+        inicio = time.perf_counter()
+        escrito = aplicar(db, resultado['grupos'], resultado['calles'])
+        print(f"    - [IA] Reagrupamiento aplicado en {time.perf_counter() - inicio:.1f} s: {json.dumps(escrito)}")
@@ -0,0 +1,186 @@
+import os
+import threading
+import contextlib
+import time
+
+# Cada cuantos segundos se revisa si cambió algún archivo de pesos en disco
+intervalo_revision = float(os.getenv('IA_REVISION_MODELOS_SEG', 30))
+# Backend de cada modelo: 'torch' (ultralytics), 'onnx' (ONNX Runtime, exporta el .pt a .onnx si hace falta)
+# u 'onnx-int8' (la variante cuantizada generada con 'cuantizacion.py')
+backends = {
+    'auto': os.getenv('IA_BACKEND_AUTO', 'torch').lower(),
+    'peaton': os.getenv('IA_BACKEND_PEATON', 'torch').lower(),
+}
+# Inferencias de prueba sobre un frame vacío al cargar cada modelo, antes de dejarlo disponible
+# (inicializa los kernels de CPU/CUDA y el predictor de ultralytics). 0 lo desactiva.
+iteraciones_calentamiento = int(os.getenv('IA_CALENTAMIENTO', 2))
+# Lado del frame de prueba (el modelo lo lleva a su tamaño de entrada igual que una foto real)
+tamano_calentamiento = int(os.getenv('IA_CALENTAMIENTO_TAMANO', 640))
+
+_lock = threading.Lock() # Protege los diccionarios de modelos; nunca se tiene mientras se carga un modelo
+_lock_recarga = threading.Lock() # Una sola recarga a la vez (las demás revisiones se saltan)
+_lock_bloqueos = threading.Lock()
+_bloqueos = {} # modo -> lock para usar el modelo (los modelos de ultralytics no se pueden usar desde dos hilos a la vez)
+_rutas = {}   # modo -> ruta del archivo .pt
+_modelos = {} # modo -> modelo cargado (YOLO o ModeloONNX)
+_mtimes = {}  # modo -> fecha de modificación del archivo cargado
+_versiones = {} # modo -> versión del modelo cargado ('<archivo>@<mtime>')
+_ultima_revision = 0.0
+_dispositivo = None
+
+def dispositivo():
+    """
+    Retorna el dispositivo de torch a usar (cuda si está disponible, si no cpu).
+
+    Se resuelve una sola vez por proceso.
+    """
+    global _dispositivo
+    if _dispositivo is None:
+        import torch
+        _dispositivo = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        print(f"    - [IA] Dispositivo de inferencia: {_dispositivo}")
+    return _dispositivo
+
+def backend(modo: str) -> str:
+    """
+    Retorna el backend configurado para el modelo de 'modo' ('torch', 'onnx' u 'onnx-int8').
+    """
+    return backends.get(modo_modelo(modo), 'torch')
+
+def usa_torch(modos) -> bool:
+    """
+    Indica si alguno de los modelos de 'modos' corre con torch.
+    """
+    return any(backend(modo) == 'torch' for modo in modos)
+
+def _cargar(modo: str, ruta: str) -> tuple:
+    """
+    Carga y calienta el modelo de 'modo' desde 'ruta' sin tocar los modelos en uso.
+
+    Retorna (modelo, mtime, versión) para dejarlo disponible con '_instalar'.
+    """
+    mtime = os.path.getmtime(ruta)
+    inicio = time.perf_counter()
+    if backend(modo) in ('onnx', 'onnx-int8'):
+        import modelo_onnx
+        ruta_cargada = modelo_onnx.onnx_actualizado(ruta)
+        if backend(modo) == 'onnx-int8':
+            import cuantizacion
+            ruta_int8 = cuantizacion.ruta_int8(ruta)
+            if os.path.exists(ruta_int8) and os.path.getmtime(ruta_int8) >= mtime:
+                ruta_cargada = ruta_int8
+            else:
+                print(f"    - [IA] No hay una variante INT8 al día de '{os.path.basename(ruta)}' "
+                      f"(generarla con 'python cuantizacion.py cuantizar'), se usa el modelo float.")
+        modelo = modelo_onnx.ModeloONNX(ruta_cargada)
+    else:
+        from ultralytics import YOLO
+        ruta_cargada = ruta
+        modelo = YOLO(ruta)
+    print(f"    - [IA] Modelo '{modo}' cargado desde '{os.path.basename(ruta_cargada)}' en {time.perf_counter() - inicio:.2f} s.")
+    # Se calienta antes de reemplazar al anterior, así una recarga tampoco deja un modelo frío en uso
+    calentar(modelo, modo)
+    return modelo, mtime, f"{os.path.basename(ruta_cargada)}@{int(mtime)}"
+
+def _instalar(modo: str, cargado: tuple):
+    with _lock:
+        _modelos[modo], _mtimes[modo], _versiones[modo] = cargado
+
+def calentar(modelo, modo: str):
+    """
+    Corre 'IA_CALENTAMIENTO' inferencias sobre un frame gris para que la primera imagen real
+    no pague la inicialización perezosa del backend.
+    """
+    if iteraciones_calentamiento <= 0:
+        return
+    import numpy as np
+    frame = np.full((tamano_calentamiento, tamano_calentamiento, 3), 114, dtype=np.uint8)
+    inicio = time.perf_counter()
+    for _ in range(iteraciones_calentamiento):
+        if backend(modo) == 'torch':
+            modelo.predict([frame], device=dispositivo(), verbose=False)
+        else:
+            modelo.predict([frame])
+    print(f"    - [IA] Modelo '{modo}' calentado en {time.perf_counter() - inicio:.2f} s.")
+
+def preparar_exportaciones(rutas: dict[str, str]):
+    """
+    Exporta a ONNX los pesos de los modelos con backend ONNX que no estén al día. Se llama en el proceso
+    principal antes de crear los procesos de inferencia, así ellos solo cargan el archivo ya exportado.
+    """
+    for modo, ruta in rutas.items():
+        if backend(modo) in ('onnx', 'onnx-int8'):
+            import modelo_onnx
+            modelo_onnx.onnx_actualizado(ruta)
+
+def cargar_modelos(rutas: dict[str, str]):
+    """
+    Carga los modelos indicados en 'rutas' ({modo: ruta .pt}) y los deja en memoria.
+
+    Se llama una vez al iniciar el proceso.
+    """
+    global _ultima_revision
+    if usa_torch(rutas):
+        dispositivo()
+    with _lock:
+        _rutas.update(rutas)
+    for modo, ruta in rutas.items():
+        _instalar(modo, _cargar(modo, ruta))
+    _ultima_revision = time.monotonic()
+
+def revisar_cambios():
+    """
+    Recarga los modelos cuyo archivo de pesos cambió en disco desde la última carga.
+
+    Si la recarga falla (por ejemplo, el archivo se está copiando) se mantiene el modelo anterior.
+
+    El modelo nuevo se carga y calienta sin tomar '_lock': mientras tanto las inferencias siguen con el
+    anterior, y solo el reemplazo final es exclusivo. Si ya hay una recarga en curso, no hace nada.
+    """
+    global _ultima_revision
+    if not _lock_recarga.acquire(blocking=False):
+        return
+    try:
+        with _lock:
+            _ultima_revision = time.monotonic()
+            rutas = dict(_rutas)
+            mtimes = dict(_mtimes)
+        for modo, ruta in rutas.items():
+            try:
+                if os.path.getmtime(ruta) != mtimes.get(modo):
+                    print(f"    - [IA] Archivo de pesos de '{modo}' modificado, recargando...")
+                    _instalar(modo, _cargar(modo, ruta))
+            except Exception as e:
+                print(f"    - [IA] Error al recargar el modelo '{modo}', se mantiene el anterior: {e}")
+    finally:
+        _lock_recarga.release()
+
+def modo_modelo(modo: str) -> str:
+    """
+    Traduce el 'modo' de un mensaje al modelo que lo atiende ('auto' o 'peaton').
+    """
+    return 'auto' if modo == 'auto' else 'peaton'
+
+def version_modelo(modo: str) -> str:
+    """
+    Retorna la versión del modelo cargado para 'modo': nombre del archivo de pesos y su fecha de modificación.
+    """
+    return _versiones.get(modo_modelo(modo), 'desconocida')
+
+def bloqueo(modo: str):
+    """
+    Retorna el lock a tomar mientras se usa el modelo de 'modo' (por ejemplo, el consumo de imágenes y el de
+    videos en hilos distintos). Las sesiones de ONNX Runtime sí se pueden compartir, así que no se bloquean.
+    """
+    if backend(modo) in ('onnx', 'onnx-int8'):
+        return contextlib.nullcontext()
+    with _lock_bloqueos:
+        return _bloqueos.setdefault(modo_modelo(modo), threading.Lock())
+
+def obtener_modelo(modo: str):
+    """
+    Retorna el modelo ya cargado para el 'modo' del mensaje ('auto' usa el de vehiculo, el resto el de peaton).
+    """
+    if intervalo_revision > 0 and time.monotonic() - _ultima_revision > intervalo_revision:
+        revisar_cambios()
+    return _modelos[modo_modelo(modo)]
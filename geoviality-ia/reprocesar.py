@@ -0,0 +1,381 @@
+"""
+Reprocesamiento del historial de imágenes con una nueva versión de los modelos, sin pasar por RabbitMQ.
+
+Recorre el almacenamiento de imágenes junto con 'processed_geojson' (de cada imagen se necesita su punto
+y su 'modo'), corre la inferencia por lotes mientras las siguientes imágenes se leen y decodifican en
+paralelo, y guarda las nuevas detecciones en la colección 'reprocesos' como un conjunto con su versión,
+sin tocar los puntos ni las calles:
+
+    python reprocesar.py procesar --pesos-auto nuevo.pt --version v4
+    python reprocesar.py diferencias --version v4 --salida diferencias.json
+    python reprocesar.py promover --version v4
+    python reprocesar.py versiones
+
+'procesar' deja en un archivo de checkpoint las imágenes ya guardadas: si se corta, la misma orden
+sigue desde donde quedó. Corre con prioridad baja ('--nice') y pocos hilos ('--hilos') para no quitarle
+CPU a los workers que consumen las colas.
+
+'diferencias' compara el conjunto con los datos actuales sin escribir nada, y 'promover' lo aplica:
+reemplaza las detecciones de cada imagen y el tipo de cada punto, y corrige los contadores de sus calles.
+"""
+import os
+import re
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import dotenv
+
+dotenv.load_dotenv()
+
+from pymongo import ReplaceOne, UpdateOne
+
+COLECCION = 'reprocesos'
+# Operaciones por cada 'bulk_write' al promover
+TAMANO_ESCRITURA = 1000
+
+def argumentos(argv=None):
+    parser = argparse.ArgumentParser(description="Reprocesamiento del historial de imágenes con una nueva versión de los modelos")
+    subparsers = parser.add_subparsers(dest='orden', required=True)
+
+    procesar = subparsers.add_parser('procesar', help="Corre los modelos sobre las imágenes guardadas")
+    procesar.add_argument('--pesos-auto', help="Pesos del modelo de vehiculo (por defecto, los de 'configuracion.py')")
+    procesar.add_argument('--pesos-peaton', help="Pesos del modelo de peaton (por defecto, los de 'configuracion.py')")
+    procesar.add_argument('--version', help="Nombre del conjunto de resultados (por defecto, la versión de los modelos)")
+    procesar.add_argument('--confianza', type=float, help="Umbral de confianza (por defecto, el de 'configuracion.py')")
+    procesar.add_argument('--lote', type=int, default=16, help="Imágenes por llamada a 'predict'")
+    procesar.add_argument('--lectores', type=int, default=4, help="Hilos que leen y decodifican el lote siguiente")
+    procesar.add_argument('--hilos', type=int, default=max(1, (os.cpu_count() or 2) // 2), help="Hilos de inferencia de torch / ONNX Runtime")
+    procesar.add_argument('--nice', type=int, default=10, help="Cuanto bajar la prioridad del proceso")
+    procesar.add_argument('--pausa-ms', type=float, default=0.0, help="Espera entre lotes")
+    procesar.add_argument('--limite', type=int, help="Procesar a lo más esta cantidad de imágenes")
+    procesar.add_argument('--checkpoint', help="Archivo de checkpoint (por defecto, 'imgs/reproceso-<version>.txt')")
+
+    diferencias = subparsers.add_parser('diferencias', help="Compara un conjunto con los datos actuales, sin escribir")
+    diferencias.add_argument('--version', required=True)
+    diferencias.add_argument('--salida', help="Archivo donde guardar el informe JSON")
+
+    promover = subparsers.add_parser('promover', help="Aplica un conjunto a los puntos y calles")
+    promover.add_argument('--version', required=True)
+
+    subparsers.add_parser('versiones', help="Lista los conjuntos guardados")
+    return parser.parse_args(argv)
+
+class Checkpoint:
+    """
+    Ids de las imágenes cuyo resultado ya quedó guardado, uno por línea. Se agrega al archivo después
+    de cada escritura, así un corte pierde a lo más el lote en curso (que se vuelve a escribir igual).
+    """
+
+    def __init__(self, ruta: str):
+        self.ruta = ruta
+        self.hechas = set()
+        if os.path.exists(ruta):
+            with open(ruta) as f:
+                self.hechas = {linea.strip() for linea in f if linea.strip()}
+        os.makedirs(os.path.dirname(ruta) or '.', exist_ok=True)
+        self._archivo = open(ruta, 'a')
+
+    def agregar(self, ids: list[str]):
+        self._archivo.write(''.join(f"{id}\n" for id in ids))
+        self._archivo.flush()
+        os.fsync(self._archivo.fileno())
+        self.hechas.update(ids)
+
+    def cerrar(self):
+        self._archivo.close()
+
+def imagenes_de_puntos(db) -> dict:
+    """
+    Retorna {id de imagen: (id del punto, modo)} de todas las imágenes de 'processed_geojson'.
+    """
+    imagenes = {}
+    for punto in db.processed_geojson.find({}, {"properties.images": 1, "properties.modo": 1}):
+        propiedades = punto.get("properties", {})
+        for imagen in propiedades.get("images", []):
+            imagenes[imagen] = (punto["_id"], propiedades.get("modo", "auto"))
+    return imagenes
+
+def tareas(almacenamiento, imagenes: dict, hechas: set, limite: int | None = None) -> tuple[list, dict]:
+    """
+    Recorre el almacenamiento y retorna las imágenes por reprocesar ({'imagen', 'punto', 'modo'}) y un resumen.
+
+    Solo sirven las imágenes de algún punto: de las demás no se conoce su ubicación ni su 'modo'.
+    """
+    pendientes = []
+    resumen = {'en_almacenamiento': 0, 'sin_punto': 0, 'ya_procesadas': 0}
+    vistas = set()
+    for key in almacenamiento.listar():
+        if '/' in key or not key.endswith('.jpg') or key.startswith('video-'):
+            continue # Originales, videos y otros archivos que no son imágenes procesadas
+        imagen = key[:-len('.jpg')]
+        resumen['en_almacenamiento'] += 1
+        vistas.add(imagen)
+        if imagen not in imagenes:
+            resumen['sin_punto'] += 1
+        elif imagen in hechas:
+            resumen['ya_procesadas'] += 1
+        elif limite is None or len(pendientes) < limite:
+            punto, modo = imagenes[imagen]
+            pendientes.append({'imagen': imagen, 'punto': punto, 'modo': modo})
+    resumen['faltantes'] = len(imagenes.keys() - vistas) # En algún punto pero no en el almacenamiento
+    resumen['pendientes'] = len(pendientes)
+    return pendientes, resumen
+
+def nombre_archivo(version: str) -> str:
+    return re.sub(r'[^\w.-]+', '_', version)
+
+def bajar_prioridad(nice: int, hilos: int, modos):
+    """
+    Baja la prioridad del proceso y limita los hilos de inferencia, antes de cargar los modelos.
+    """
+    if nice and hasattr(os, 'nice'):
+        os.nice(nice)
+    import registro_modelos
+    import modelo_onnx
+    modelo_onnx.hilos = hilos
+    if registro_modelos.usa_torch(modos):
+        import torch
+        torch.set_num_threads(hilos)
+
+def leer(tarea: dict):
+    from almacenamiento import almacenamiento
+    from imagenes import decodificar_imagen
+    contenido = almacenamiento.leer(f"{tarea['imagen']}.jpg")
+    return tarea, decodificar_imagen(contenido) if contenido is not None else None
+
+def inferir(leidas: list, confianza, version: str) -> list:
+    """
+    Corre los modelos sobre un lote de (tarea, frame) y retorna las operaciones para 'reprocesos'.
+    """
+    import registro_modelos
+    import ia_predictor as ia
+    grupos = {}
+    for tarea, frame in leidas:
+        if frame is not None:
+            grupos.setdefault(registro_modelos.modo_modelo(tarea['modo']), []).append((tarea, frame))
+
+    fecha = datetime.now()
+    documentos = {
+        tarea['imagen']: {
+            '_id': f"{version}/{tarea['imagen']}", 'version': version, 'imagen': tarea['imagen'],
+            'punto': tarea['punto'], 'modo': tarea['modo'], 'decodificable': False,
+            'type': [], 'detecciones': None, 'fecha': fecha
+        }
+        for tarea, _ in leidas
+    }
+    for modo, items in grupos.items():
+        clases = ia.clases_modelo(registro_modelos.obtener_modelo(modo))
+        resultados = ia.detectar_lote([frame for _, frame in items], modo, confianza)
+        for (tarea, frame), result in zip(items, resultados):
+            detecciones = ia.resumir_detecciones(
+                ia.extraer_detecciones(result, clases), confianza, registro_modelos.version_modelo(modo), frame.shape[:2]
+            )
+            documento = documentos[tarea['imagen']]
+            documento['decodificable'] = True
+            documento['detecciones'] = detecciones
+            for caja in (detecciones or {}).get('cajas', []):
+                if caja['clase'] not in documento['type']:
+                    documento['type'].append(caja['clase'])
+    return [ReplaceOne({'_id': d['_id']}, d, upsert=True) for d in documentos.values()]
+
+def procesar(args, db):
+    import configuracion
+    import registro_modelos
+    from almacenamiento import almacenamiento
+
+    registro_modelos.intervalo_revision = 0 # Los pesos no cambian durante el reproceso
+    pesos = {'auto': args.pesos_auto or configuracion.modelo_IA_auto, 'peaton': args.pesos_peaton or configuracion.modelo_IA_peaton}
+    confianza = args.confianza if args.confianza is not None else configuracion.confianza
+
+    inicio = time.perf_counter()
+    imagenes = imagenes_de_puntos(db)
+    modos = {registro_modelos.modo_modelo(modo) for _, modo in imagenes.values()}
+    bajar_prioridad(args.nice, args.hilos, modos)
+    registro_modelos.cargar_modelos({modo: pesos[modo] for modo in modos})
+    version = args.version or '+'.join(f"{modo}={registro_modelos.version_modelo(modo)}" for modo in sorted(modos))
+
+    checkpoint = Checkpoint(args.checkpoint or os.path.join(os.getcwd(), 'imgs', f"reproceso-{nombre_archivo(version)}.txt"))
+    pendientes, resumen = tareas(almacenamiento, imagenes, checkpoint.hechas, args.limite)
+    print(f"    - [IA] Reproceso '{version}': {json.dumps(resumen)}")
+    db[COLECCION].create_index('version')
+    db[COLECCION].create_index('punto')
+
+    lotes = [pendientes[i:i + args.lote] for i in range(0, len(pendientes), args.lote)]
+    hechas = 0
+    with ThreadPoolExecutor(max(1, args.lectores)) as lectores:
+        # Mientras se infiere un lote, el siguiente ya se está leyendo y decodificando
+        siguiente = [lectores.submit(leer, tarea) for tarea in lotes[0]] if lotes else []
+        for i in range(len(lotes)):
+            leidas = [futuro.result() for futuro in siguiente]
+            if i + 1 < len(lotes):
+                siguiente = [lectores.submit(leer, tarea) for tarea in lotes[i + 1]]
+            operaciones = inferir(leidas, confianza, version)
+            db[COLECCION].bulk_write(operaciones, ordered=False)
+            checkpoint.agregar([tarea['imagen'] for tarea, _ in leidas])
+            hechas += len(leidas)
+            segundos = time.perf_counter() - inicio
+            print(f"    - [IA] Reproceso: {hechas}/{len(pendientes)} imágenes ({hechas / segundos:.1f} img/s).")
+            if args.pausa_ms:
+                time.sleep(args.pausa_ms / 1000)
+    checkpoint.cerrar()
+    print(f"    - [IA] Reproceso '{version}' terminado: {hechas} imágenes en {time.perf_counter() - inicio:.1f} s.")
+
+def clases_de(detecciones: dict | None) -> list[str]:
+    clases = []
+    for caja in (detecciones or {}).get('cajas', []):
+        if caja['clase'] not in clases:
+            clases.append(caja['clase'])
+    return clases
+
+def plan(db, version: str) -> tuple[list, dict]:
+    """
+    Compara el conjunto 'version' con los puntos actuales y retorna los cambios por punto
+    ({'punto', 'tipo_antes', 'tipo_despues', 'detecciones'}) y estadísticas por imagen.
+
+    El nuevo tipo de un punto es la unión de las clases de sus imágenes: las reprocesadas aportan
+    sus nuevas detecciones y las demás las que tenían (o, si no tenían cajas guardadas, el tipo actual).
+    """
+    nuevas = {}
+    for documento in db[COLECCION].find({'version': version}):
+        if documento.get('decodificable'):
+            nuevas.setdefault(documento['punto'], {})[documento['imagen']] = documento['detecciones']
+
+    estadisticas = {'imagenes': 0, 'iguales': 0, 'cambiadas': 0, 'sin_detecciones': 0, 'por_clase': {}}
+    cambios = []
+    ids = list(nuevas)
+    for i in range(0, len(ids), TAMANO_ESCRITURA):
+        for punto in db.processed_geojson.find({'_id': {'$in': ids[i:i + TAMANO_ESCRITURA]}}):
+            propiedades = punto['properties']
+            tipo_antes = list(propiedades.get('type') or [])
+            if isinstance(tipo_antes, str):
+                tipo_antes = [tipo_antes]
+            anteriores = propiedades.get('detecciones') or {}
+            reprocesadas = nuevas[punto['_id']]
+            tipo_despues = []
+            for imagen in propiedades.get('images', []):
+                if imagen in reprocesadas:
+                    clases = clases_de(reprocesadas[imagen])
+                    antes = clases_de(anteriores[imagen]) if imagen in anteriores else tipo_antes
+                    estadisticas['imagenes'] += 1
+                    estadisticas['iguales' if set(clases) == set(antes) else 'cambiadas'] += 1
+                    estadisticas['sin_detecciones'] += not clases
+                    for clase in set(clases) | set(antes):
+                        conteo = estadisticas['por_clase'].setdefault(clase, {'antes': 0, 'despues': 0})
+                        conteo['antes'] += clase in antes
+                        conteo['despues'] += clase in clases
+                elif imagen in anteriores:
+                    clases = clases_de(anteriores[imagen])
+                else:
+                    clases = tipo_antes
+                tipo_despues += [clase for clase in clases if clase not in tipo_despues]
+            cambios.append({
+                'punto': punto['_id'],
+                'tipo_antes': tipo_antes,
+                'tipo_despues': tipo_despues,
+                'detecciones': {imagen: reprocesadas[imagen] for imagen in reprocesadas if imagen in propiedades.get('images', [])}
+            })
+    return cambios, estadisticas
+
+def informe(cambios: list, estadisticas: dict) -> dict:
+    return {
+        'imagenes': estadisticas,
+        'puntos': {
+            'reprocesados': len(cambios),
+            'cambian_tipo': sum(set(c['tipo_antes']) != set(c['tipo_despues']) and bool(c['tipo_despues']) for c in cambios),
+            # Con el nuevo modelo no queda ninguna detección: 'promover' los deja como están
+            'sin_detecciones': [c['punto'] for c in cambios if not c['tipo_despues']],
+        }
+    }
+
+def diferencias(args, db):
+    cambios, estadisticas = plan(db, args.version)
+    resultado = informe(cambios, estadisticas)
+    texto = json.dumps(resultado, indent=2, ensure_ascii=False)
+    if args.salida:
+        with open(args.salida, 'w') as f:
+            f.write(texto)
+    print(texto)
+
+def calles_de_puntos(db) -> dict:
+    """
+    Retorna {id del punto: id de la calle} según las irregularidades que guarda cada calle en 'properties.images'.
+    """
+    calles = {}
+    for calle in db.streets.find({'properties.images.0': {'$exists': True}}, {'id': 1, 'properties.images': 1}):
+        for punto in calle['properties']['images']:
+            calles[punto] = calle['id']
+    return calles
+
+def promover(args, db):
+    """
+    Aplica el conjunto 'version': reemplaza las detecciones de las imágenes reprocesadas y el tipo de sus puntos,
+    y suma o resta en la calle de cada punto los tipos que se agregan o quitan.
+
+    Se puede repetir: cada calle guarda en 'properties.reprocesos' los puntos ya corregidos con esta versión
+    y no los vuelve a contar.
+    """
+    cambios, estadisticas = plan(db, args.version)
+    calles = calles_de_puntos(db)
+    ahora = datetime.now()
+    puntos = []
+    operaciones_calles = []
+    for cambio in cambios:
+        if not cambio['tipo_despues']:
+            continue
+        asignar = {'properties.type': cambio['tipo_despues'], 'properties.last_update': ahora, 'properties.reproceso': args.version}
+        quitar = {}
+        for imagen, detecciones in cambio['detecciones'].items():
+            if detecciones:
+                asignar[f"properties.detecciones.{imagen}"] = detecciones
+            else:
+                quitar[f"properties.detecciones.{imagen}"] = ""
+        actualizacion = {'$set': asignar}
+        if quitar:
+            actualizacion['$unset'] = quitar
+        puntos.append(UpdateOne({'_id': cambio['punto']}, actualizacion))
+
+        antes = {tipo.capitalize() for tipo in cambio['tipo_antes']}
+        despues = {tipo.capitalize() for tipo in cambio['tipo_despues']}
+        calle = calles.get(cambio['punto'])
+        if calle is not None and antes != despues:
+            marca = f"{args.version}/{cambio['punto']}"
+            incrementos = {f"properties.{tipo}": 1 for tipo in despues - antes}
+            incrementos.update({f"properties.{tipo}": -1 for tipo in antes - despues})
+            operaciones_calles.append(UpdateOne(
+                {'id': calle, 'properties.reprocesos': {'$ne': marca}},
+                {'$inc': incrementos, '$addToSet': {'properties.reprocesos': marca}, '$set': {'properties.last_update': ahora}}
+            ))
+
+    # Primero las calles: si se corta antes de escribir los puntos, al repetir se calcula el mismo cambio
+    # y la marca evita contarlo dos veces; al revés, el tipo del punto ya no mostraría la diferencia
+    for i in range(0, len(operaciones_calles), TAMANO_ESCRITURA):
+        db.streets.bulk_write(operaciones_calles[i:i + TAMANO_ESCRITURA], ordered=False)
+    for i in range(0, len(puntos), TAMANO_ESCRITURA):
+        db.processed_geojson.bulk_write(puntos[i:i + TAMANO_ESCRITURA], ordered=False)
+    db[COLECCION].update_many({'version': args.version}, {'$set': {'promovido': ahora}})
+    resultado = informe(cambios, estadisticas)
+    print(f"    - [IA] Conjunto '{args.version}' promovido: {len(puntos)} puntos actualizados y {len(operaciones_calles)} correcciones de calles, "
+          f"{len(resultado['puntos']['sin_detecciones'])} puntos sin detecciones se dejaron como estaban.")
+
+def versiones(db):
+    for fila in db[COLECCION].aggregate([
+        {'$group': {'_id': '$version', 'imagenes': {'$sum': 1}, 'desde': {'$min': '$fecha'}, 'hasta': {'$max': '$fecha'}, 'promovido': {'$max': '$promovido'}}},
+        {'$sort': {'hasta': -1}}
+    ]):
+        print(f"{fila['_id']}: {fila['imagenes']} imágenes, del {fila['desde']} al {fila['hasta']}"
+              + (f", promovido el {fila['promovido']}" if fila.get('promovido') else ""))
+
+if __name__ == '__main__':
+    args = argumentos()
+    from database import db
+    if args.orden == 'procesar':
+        procesar(args, db)
+    elif args.orden == 'diferencias':
+        diferencias(args, db)
+    elif args.orden == 'promover':
+        promover(args, db)
+    else:
+        versiones(db)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Los módulos del worker se importan por nombre, como al correr 'python main.py' desde 'geoviality-ia'
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
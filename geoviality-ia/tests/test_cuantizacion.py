@@ -0,0 +1,50 @@
+import numpy as np
+from cuantizacion import comparar_detecciones, fuera_de_tolerancia
+
+NOMBRES = {0: 'hoyo', 1: 'grieta'}
+
+def caja(*v):
+    return np.array(v, dtype=np.float32)
+
+def test_variante_que_coincide_queda_dentro_de_tolerancia():
+    por_imagen = [
+        {
+            'float': [(0, 0.90, caja(0, 0, 100, 100)), (1, 0.60, caja(200, 200, 260, 240))],
+            'int8': [(1, 0.58, caja(201, 200, 261, 240)), (0, 0.88, caja(0, 0, 100, 98))],
+        },
+        {'float': [], 'int8': []},
+    ]
+    resultado = comparar_detecciones(por_imagen, NOMBRES)
+    assert resultado['clases'] == {
+        'hoyo': {'float': 1, 'int8': 1, 'coincidencias': 1, 'acuerdo': 1.0},
+        'grieta': {'float': 1, 'int8': 1, 'coincidencias': 1, 'acuerdo': 1.0},
+    }
+    assert resultado['diferencia_confianza_media'] == 0.02
+    # IoU: 9800 / 10000 = 0.98 y 2360 / 2440 = 0.9672
+    assert resultado['iou_medio'] == round((0.98 + 2360 / 2440) / 2, 4)
+    assert fuera_de_tolerancia(resultado) == []
+
+def test_detecciones_perdidas_o_corridas_quedan_fuera_de_tolerancia():
+    por_imagen = [{
+        'float': [(0, 0.90, caja(0, 0, 100, 100)), (0, 0.80, caja(300, 300, 400, 400)), (1, 0.70, caja(0, 200, 100, 300))],
+        # La segunda 'hoyo' se pierde, 'grieta' queda con otra clase y la confianza de la primera cae
+        'int8': [(0, 0.70, caja(0, 0, 100, 100)), (0, 0.70, caja(0, 200, 100, 300))],
+    }]
+    resultado = comparar_detecciones(por_imagen, NOMBRES)
+    assert resultado['clases']['hoyo'] == {'float': 2, 'int8': 2, 'coincidencias': 1, 'acuerdo': 0.5}
+    assert resultado['clases']['grieta'] == {'float': 1, 'int8': 0, 'coincidencias': 0, 'acuerdo': 0.0}
+    assert resultado['diferencia_confianza_media'] == 0.2
+    problemas = fuera_de_tolerancia(resultado)
+    assert len(problemas) == 3
+    assert any("'hoyo'" in p for p in problemas) and any("'grieta'" in p for p in problemas)
+    assert any('confianza' in p for p in problemas)
+
+def test_iou_bajo_el_minimo_no_coincide():
+    por_imagen = [{'float': [(0, 0.9, caja(0, 0, 100, 100))], 'int8': [(0, 0.9, caja(60, 0, 160, 100))]}]
+    resultado = comparar_detecciones(por_imagen, NOMBRES, iou_minimo=0.5)
+    assert resultado['clases']['hoyo']['coincidencias'] == 0
+    assert resultado['iou_medio'] is None
+    # Con un mínimo más bajo coincide, pero el IoU medio (0.25) queda bajo la tolerancia
+    resultado = comparar_detecciones(por_imagen, NOMBRES, iou_minimo=0.2)
+    assert resultado['iou_medio'] == 0.25
+    assert fuera_de_tolerancia(resultado) == ["IoU medio 0.250 < 0.8"]
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+from modelo_onnx import letterbox, nms, ModeloONNX
+
+def test_letterbox_sin_escala_rellena_arriba_y_abajo():
+    frame = np.zeros((480, 640, 3), dtype=np.uint8)
+    imagen, escala, relleno = letterbox(frame, (640, 640))
+    assert imagen.shape == (640, 640, 3)
+    assert escala == 1
+    assert relleno == (0, 80)
+    assert (imagen[:80] == 114).all() and (imagen[560:] == 114).all()
+    assert (imagen[80:560] == 0).all()
+
+def test_letterbox_escala_y_relleno_impar():
+    frame = np.zeros((101, 200, 3), dtype=np.uint8)
+    imagen, escala, relleno = letterbox(frame, (640, 640))
+    assert imagen.shape == (640, 640, 3)
+    assert escala == pytest.approx(3.2)
+    # 101 * 3.2 = 323.2 -> 323 filas de imagen, 317 de relleno: 158 arriba y 159 abajo
+    assert relleno == (0, 158)
+    assert (imagen[:158] == 114).all() and (imagen[481:] == 114).all()
+    assert (imagen[158:481] == 0).all()
+
+def test_nms_por_umbral_de_iou():
+    cajas = np.array([[0, 0, 10, 10], [1, 1, 11, 11], [20, 20, 30, 30]], dtype=np.float32)
+    puntajes = np.array([0.9, 0.8, 0.95], dtype=np.float32)
+    # IoU entre las dos primeras: 81 / 119 = 0.68
+    assert nms(cajas, puntajes, 0.5).tolist() == [2, 0]
+    assert nms(cajas, puntajes, 0.7).tolist() == [2, 0, 1]
+
+def _modelo():
+    modelo = ModeloONNX.__new__(ModeloONNX)
+    modelo.names = {0: 'hoyo', 1: 'grieta'}
+    modelo.tamano = (640, 640)
+    return modelo
+
+def test_postprocesar_vuelve_al_frame_original():
+    frame = np.zeros((100, 200, 3), dtype=np.uint8) # letterbox: escala 3.2, relleno (0, 160)
+    candidatos = np.array([
+        # cx, cy, w, h, puntaje hoyo, puntaje grieta
+        [320, 320, 64, 32, 0.10, 0.90], # grieta en (90, 45, 110, 55)
+        [322, 320, 64, 32, 0.05, 0.80], # se superpone con la anterior, misma clase: la quita el NMS
+        [320, 320, 64, 32, 0.60, 0.20], # misma caja pero otra clase: se conserva
+        [630, 320, 40, 32, 0.70, 0.00], # se sale del borde derecho: se recorta a 200
+        [100, 300, 10, 10, 0.10, 0.20], # bajo la confianza
+    ], dtype=np.float32).T
+    resultado = _modelo()._postprocesar(candidatos, frame, 3.2, (0, 160), conf=0.25)
+
+    assert resultado.orig_shape == (100, 200)
+    assert [int(d.cls.item()) for d in resultado.boxes] == [1, 0, 0]
+    np.testing.assert_allclose([d.conf.item() for d in resultado.boxes], [0.9, 0.7, 0.6], rtol=1e-6)
+    np.testing.assert_allclose(
+        np.concatenate([d.xyxy for d in resultado.boxes]),
+        [[90, 45, 110, 55], [610 / 3.2, 45, 200, 55], [90, 45, 110, 55]],
+        rtol=1e-5
+    )
+
+def test_preprocesar_rgb_chw_normalizado():
+    frame = np.zeros((640, 640, 3), dtype=np.uint8)
+    frame[..., 0] = 255 # Azul en BGR
+    entrada, transformaciones = _modelo().preprocesar([frame, frame])
+    assert entrada.shape == (2, 3, 640, 640) and entrada.dtype == np.float32
+    assert transformaciones == [(1.0, (0, 0))] * 2
+    assert (entrada[:, 2] == 1).all() and (entrada[:, :2] == 0).all()
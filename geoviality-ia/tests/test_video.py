@@ -0,0 +1,19 @@
+import json
+from datetime import datetime, timedelta, timezone
+from models import VideoQueue
+
+# Tal como lo publica la API: 'VideoQueue(...).model_dump_json()' con una fecha UTC
+MENSAJE_API = '{"id":"v1","key":"video-v1.mp4","track":[[0.0,-33.4,-70.6],[10.0,-33.401,-70.6]],"date":"2024-05-01T12:00:00Z","modo":"auto","user":"ana"}'
+
+def test_fecha_utc_con_z_del_mensaje_de_la_api():
+    data = json.loads(MENSAJE_API)
+    inicio = VideoQueue(**data).date
+    assert inicio == datetime(2024, 5, 1, 12, tzinfo=timezone.utc)
+    assert inicio + timedelta(seconds=2.5) == datetime(2024, 5, 1, 12, 0, 2, 500000, tzinfo=timezone.utc)
+
+def test_fecha_con_fraccion_y_desfase():
+    data = json.loads(MENSAJE_API)
+    data['date'] = "2024-05-01T12:00:00.500000Z"
+    assert VideoQueue(**data).date == datetime(2024, 5, 1, 12, 0, 0, 500000, tzinfo=timezone.utc)
+    data['date'] = "2024-05-01T08:00:00-04:00"
+    assert VideoQueue(**data).date == datetime(2024, 5, 1, 12, tzinfo=timezone.utc)
@@ -0,0 +1,240 @@
+import os
+import json
+import time
+import tempfile
+import threading
+import functools
+from datetime import datetime, timedelta
+import cv2
+import numpy as np
+import pika
+import colas
+import metricas
+import ia_predictor as ia
+from funcs import finalizar_imagen
+from models import VideoQueue
+from almacenamiento import almacenamiento
+from indice_irregularidades import distancia_m
+
+# Qué frames del video pasan a la IA: 'distancia' (uno cada 'VIDEO_DISTANCIA_M' metros recorridos según el track),
+# 'escena' (cuando la imagen cambia más que 'VIDEO_UMBRAL_ESCENA') o 'ambos' (cualquiera de los dos)
+muestreo = os.getenv('VIDEO_MUESTREO', 'distancia').lower()
+distancia_muestreo = float(os.getenv('VIDEO_DISTANCIA_M', 10))
+# Diferencia media (0-255) entre miniaturas en gris de 64x36 para considerar que cambió la escena
+umbral_escena = float(os.getenv('VIDEO_UMBRAL_ESCENA', 25))
+# Para detectar cambios de escena se mira uno de cada 'VIDEO_PASO_ESCENA' frames
+paso_escena = int(os.getenv('VIDEO_PASO_ESCENA', 5))
+# Frames muestreados por llamada a 'predict' (es lo único que se guarda en memoria además del frame actual)
+tamano_lote = int(os.getenv('VIDEO_LOTE', os.getenv('IA_LOTE_TAMANO', 8)))
+
+TAMANO_MINIATURA = (64, 36)
+
+def _miniatura(frame: np.ndarray) -> np.ndarray:
+    gris = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(gris, TAMANO_MINIATURA, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+class Track:
+    """
+    Track GPS del video: puntos (segundos desde el inicio del video, latitud, longitud) ordenados por tiempo.
+    """
+
+    def __init__(self, puntos: list):
+        puntos = np.array(sorted(puntos), dtype=np.float64).reshape(-1, 3)
+        if len(puntos) < 2:
+            raise ValueError("El track GPS necesita al menos 2 puntos")
+        self.tiempos = puntos[:, 0]
+        self.latitudes = puntos[:, 1]
+        self.longitudes = puntos[:, 2]
+
+    def cubre(self, t: float) -> bool:
+        return self.tiempos[0] <= t <= self.tiempos[-1]
+
+    def posicion(self, t: float) -> tuple[float, float]:
+        """
+        Retorna (longitud, latitud) en el segundo 't', interpolando linealmente entre los puntos del track.
+        """
+        return float(np.interp(t, self.tiempos, self.longitudes)), float(np.interp(t, self.tiempos, self.latitudes))
+
+def frames_muestreados(ruta: str, track: Track):
+    """
+    Recorre el video de 'ruta' sin cargarlo entero y entrega (indice, segundo, longitud, latitud, frame)
+    de los frames elegidos según 'VIDEO_MUESTREO'.
+
+    Los frames que no se eligen solo se avanzan ('grab'); se decodifican a imagen ('retrieve') solo los
+    elegidos y, en modo escena, uno de cada 'VIDEO_PASO_ESCENA'. Los frames fuera del track se saltan.
+    """
+    captura = cv2.VideoCapture(ruta)
+    if not captura.isOpened():
+        raise ValueError(f"No se pudo abrir el video '{ruta}'")
+    fps = captura.get(cv2.CAP_PROP_FPS) or 30
+    por_distancia = muestreo in ('distancia', 'ambos')
+    por_escena = muestreo in ('escena', 'ambos')
+    ultima_posicion = None
+    ultima_miniatura = None
+    indice = -1
+    try:
+        while captura.grab():
+            indice += 1
+            t = captura.get(cv2.CAP_PROP_POS_MSEC) / 1000 or indice / fps
+            if not track.cubre(t):
+                continue
+            lon, lat = track.posicion(t)
+            elegido = por_distancia and (
+                ultima_posicion is None or distancia_m(lon, lat, *ultima_posicion) >= distancia_muestreo
+            )
+            frame = None
+            miniatura = None
+            if por_escena and (elegido or indice % paso_escena == 0):
+                ok, frame = captura.retrieve()
+                if not ok:
+                    continue
+                miniatura = _miniatura(frame)
+                if ultima_miniatura is None or np.abs(miniatura - ultima_miniatura).mean() >= umbral_escena:
+                    elegido = True
+            if not elegido:
+                continue
+            if frame is None:
+                ok, frame = captura.retrieve()
+                if not ok:
+                    continue
+            ultima_posicion = (lon, lat)
+            if por_escena:
+                ultima_miniatura = miniatura if miniatura is not None else _miniatura(frame)
+            yield indice, t, lon, lat, frame
+    finally:
+        captura.release()
+
+def _procesar_lote(lote: list, data: dict, inicio: datetime, confianza, path_post: str, path_csv: str) -> int:
+    """
+    Corre la inferencia de los frames de 'lote', guarda las irregularidades y los frames con detecciones
+    (cada uno como una imagen más, con la posición interpolada del track) y retorna cuantos tuvieron detecciones.
+    """
+    items = []
+    for indice, t, lon, lat, frame in lote:
+        diccionario = {
+            'id': f"{data['id']}-{indice:06d}",
+            'latitude': lat,
+            'longitude': lon,
+            'date': inicio + timedelta(seconds=t),
+            'type': [],
+            'modo': data['modo'],
+            'user': data['user'],
+        }
+        items.append((frame, path_post + diccionario['id'] + '.jpg', diccionario))
+    resultados, errores = ia.ia_lote(items, path_csv, confianza)
+    error = next((e for e in errores if e is not None), None)
+    if error is not None:
+        raise error
+
+    con_detecciones = 0
+    for (frame, _, diccionario), result in zip(items, resultados):
+        if result is False:
+            imagen = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, 90])[1].tobytes()
+            finalizar_imagen(diccionario, imagen, result)
+            con_detecciones += 1
+    return con_detecciones
+
+def procesar_video(data: dict, confianza, path_post: str, path_csv: str) -> dict:
+    """
+    Procesa el video 'key' del almacenamiento con su track GPS ('track': [[segundo, latitud, longitud], ...]).
+
+    La memoria usada no depende del largo del video: se decodifica de a un frame y solo se juntan
+    hasta 'VIDEO_LOTE' frames muestreados antes de pasarlos a la IA.
+
+    Retorna {'muestreados', 'con_detecciones', 'segundos'}.
+    """
+    inicio_proceso = time.perf_counter()
+    track = Track(data['track'])
+    inicio = VideoQueue(**data).date
+    ruta = almacenamiento.ruta(data['key'])
+    temporal = None
+    if ruta is None:
+        # Almacenamiento sin archivos locales (S3): se baja a un archivo temporal
+        temporal = tempfile.NamedTemporaryFile(suffix=os.path.splitext(data['key'])[1], delete=False)
+        temporal.close()
+        almacenamiento.descargar(data['key'], temporal.name)
+        ruta = temporal.name
+
+    muestreados = 0
+    con_detecciones = 0
+    try:
+        lote = []
+        for muestra in frames_muestreados(ruta, track):
+            lote.append(muestra)
+            muestreados += 1
+            if len(lote) >= tamano_lote:
+                con_detecciones += _procesar_lote(lote, data, inicio, confianza, path_post, path_csv)
+                lote = []
+        if lote:
+            con_detecciones += _procesar_lote(lote, data, inicio, confianza, path_post, path_csv)
+    finally:
+        if temporal is not None:
+            os.remove(temporal.name)
+
+    resumen = {
+        'muestreados': muestreados,
+        'con_detecciones': con_detecciones,
+        'segundos': round(time.perf_counter() - inicio_proceso, 1),
+    }
+    print(f"    - [IA] Video '{data['id']}' procesado: {resumen['muestreados']} frames muestreados, "
+          f"{resumen['con_detecciones']} con detecciones, en {resumen['segundos']} s.")
+    return resumen
+
+def _eliminar_video(data: dict):
+    """
+    Borra el video del almacenamiento una vez que ya no se va a procesar más (sus frames quedan en la BD).
+    """
+    try:
+        almacenamiento.eliminar(data['key'])
+    except Exception as e:
+        print(f"    - [IA] No se pudo eliminar el video '{data['key']}' del almacenamiento: {e}")
+
+def _consumir(confianza, path_post: str, path_csv: str):
+    """
+    Consume la cola de videos con su propia conexión. Cada video se procesa en un hilo aparte mientras
+    este hilo atiende la conexión (heartbeats), y se confirma al terminar.
+    """
+    while True:
+        try:
+            connection = pika.BlockingConnection(pika.ConnectionParameters('rabbitmq'))
+            break
+        except pika.exceptions.AMQPConnectionError:
+            print("    - [IA] No se pudo conectar a RabbitMQ para videos, reintentando en 5 segundos...")
+            time.sleep(5)
+    channel = connection.channel()
+    colas.declarar(channel)
+    channel.basic_qos(prefetch_count=1) # Un video a la vez por worker
+
+    def procesar(method, body):
+        data = json.loads(body)
+        try:
+            procesar_video(data, confianza, path_post, path_csv)
+        except Exception as e:
+            # Se devuelve a la cola una vez: los frames ya inferidos no se vuelven a correr (ver 'idempotencia')
+            print(f"    - [IA] Error al procesar el video '{data.get('id')}': {e}")
+            connection.add_callback_threadsafe(
+                functools.partial(channel.basic_nack, delivery_tag=method.delivery_tag, requeue=not method.redelivered)
+            )
+            metricas.mensajes.labels('error').inc()
+            if method.redelivered:
+                _eliminar_video(data) # Se descartó y no se vuelve a leer
+            return
+        connection.add_callback_threadsafe(functools.partial(channel.basic_ack, delivery_tag=method.delivery_tag))
+        metricas.mensajes.labels('ok').inc()
+        _eliminar_video(data)
+
+    channel.basic_consume(
+        queue=colas.cola(colas.RUTA_VIDEOS),
+        on_message_callback=lambda ch, method, properties, body: threading.Thread(
+            target=procesar, args=(method, body), name='video', daemon=True
+        ).start()
+    )
+    print(f"    - [IA] Consumiendo videos (muestreo por {muestreo}).")
+    while True:
+        connection.process_data_events(time_limit=1)
+
+def iniciar(confianza, path_post: str, path_csv: str):
+    """
+    Inicia el consumo de videos en segundo plano (si 'video' está en 'IA_RUTAS').
+    """
+    threading.Thread(target=_consumir, args=(confianza, path_post, path_csv), name='videos', daemon=True).start()